@@ -0,0 +1,202 @@
+'''
+MP3 metadata read from the file itself: duration, bitrate and sample rate
+from the MPEG frame headers (with the Xing/Info or VBRI header of VBR
+files), title/artist/album from the ID3 tags, and a sha256 checksum.
+
+Only the standard library is used and the application is not imported, so
+probe() can run in the job process pool.
+'''
+import hashlib
+import os
+import struct
+
+CHUNK = 1 << 16
+#how far past the tags to look for the first frame
+SYNC_WINDOW = 1 << 16
+
+# kbps by (MPEG 1 or not, layer)
+BITRATES = {
+    (True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384,
+                416, 448],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320,
+                384],
+    (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256,
+                320],
+    (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224,
+                 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+# Hz by the version bits of the header
+SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000],
+                0: [11025, 12000, 8000]}
+# text frames kept, ID3v2.3/2.4 and ID3v2.2 names
+TAGS = {'TIT2': 'title', 'TPE1': 'artist', 'TALB': 'album',
+        'TT2': 'title', 'TP1': 'artist', 'TAL': 'album'}
+ENCODINGS = ['latin-1', 'utf-16', 'utf-16-be', 'utf-8']
+
+
+def _syncsafe(data):
+  return data[0] << 21 | data[1] << 14 | data[2] << 7 | data[3]
+
+
+def _text(data):
+  if not data:
+    return None
+  encoding = ENCODINGS[data[0]] if data[0] < len(ENCODINGS) else 'latin-1'
+  text = data[1:].decode(encoding, 'replace')
+  return text.split('\x00')[0].strip() or None
+
+
+#size of the ID3v2 tag at the start of data (0 without one) and its frames
+def _id3v2(data):
+  if len(data) < 10 or data[:3] != b'ID3':
+    return 0, {}
+  major, flags = data[3], data[5]
+  size = 10 + _syncsafe(data[6:10]) + (10 if flags & 0x10 else 0)
+  tags, pos, end = {}, 10, min(size, len(data))
+  if flags & 0x40 and major >= 3:
+    #extended header, its size is syncsafe from v2.4 on
+    ext = data[10:14]
+    pos += _syncsafe(ext) if major >= 4 else struct.unpack('>I', ext)[0] + 4
+  head = 6 if major == 2 else 10
+  while pos + head <= end:
+    if major == 2:
+      name = data[pos:pos + 3].decode('latin-1')
+      length = int.from_bytes(data[pos + 3:pos + 6], 'big')
+    else:
+      name = data[pos:pos + 4].decode('latin-1')
+      raw = data[pos + 4:pos + 8]
+      length = _syncsafe(raw) if major >= 4 else struct.unpack('>I', raw)[0]
+    if not name.strip('\x00') or length <= 0:
+      break
+    body = data[pos + head:pos + head + length]
+    if name in TAGS:
+      tags[TAGS[name]] = _text(body)
+    elif name in ('TLEN', 'TLE'):
+      tags['tlen'] = _text(body)
+    pos += head + length
+  return size, tags
+
+
+#(version bits, layer, bitrate kbps, sample rate, padding, mono) of the frame
+#header at data[pos:pos+4], None when it is not one
+def _frame_header(data, pos):
+  if pos + 4 > len(data):
+    return None
+  b1, b2, b3 = data[pos + 1], data[pos + 2], data[pos + 3]
+  if data[pos] != 0xFF or b1 & 0xE0 != 0xE0:
+    return None
+  version, layer = (b1 >> 3) & 3, 4 - ((b1 >> 1) & 3)
+  index, rate = b2 >> 4, (b2 >> 2) & 3
+  if version == 1 or layer == 4 or index in (0, 15) or rate == 3:
+    return None
+  bitrate = BITRATES[(version == 3, layer)][index]
+  return (version, layer, bitrate, SAMPLE_RATES[version][rate], (b2 >> 1) & 1,
+          b3 >> 6 == 3)
+
+
+def _samples_per_frame(version, layer):
+  if layer == 1:
+    return 384
+  return 1152 if layer == 2 or version == 3 else 576
+
+
+def _frame_length(header):
+  version, layer, bitrate, sample_rate, padding, _ = header
+  if layer == 1:
+    return (12000 * bitrate // sample_rate + padding) * 4
+  return (_samples_per_frame(version, layer) // 8 * 1000 * bitrate //
+          sample_rate + padding)
+
+
+#first frame header at or after start, checked against the frame after it
+def _first_frame(data, start):
+  pos = data.find(b'\xff', start)
+  while pos != -1:
+    header = _frame_header(data, pos)
+    if header:
+      following = pos + _frame_length(header)
+      if following + 4 > len(data) or _frame_header(data, following):
+        return pos, header
+    pos = data.find(b'\xff', pos + 1)
+  return None, None
+
+
+#(frames, bytes) of a Xing/Info or VBRI header in the first frame
+def _vbr_header(data, pos, header):
+  version, _, _, _, _, mono = header
+  side = (17 if mono else 32) if version == 3 else (9 if mono else 17)
+  xing = pos + 4 + side
+  if data[xing:xing + 4] in (b'Xing', b'Info'):
+    flags = struct.unpack('>I', data[xing + 4:xing + 8])[0]
+    at, frames, size = xing + 8, None, None
+    if flags & 1:
+      frames = struct.unpack('>I', data[at:at + 4])[0]
+      at += 4
+    if flags & 2:
+      size = struct.unpack('>I', data[at:at + 4])[0]
+    return frames, size
+  vbri = pos + 36
+  if data[vbri:vbri + 4] == b'VBRI':
+    size, frames = struct.unpack('>II', data[vbri + 10:vbri + 18])
+    return frames, size
+  return None, None
+
+
+def _id3v1(f, file_size):
+  if file_size < 128:
+    return {}
+  f.seek(file_size - 128)
+  data = f.read(128)
+  if data[:3] != b'TAG':
+    return {}
+  fields = {'title': data[3:33], 'artist': data[33:63], 'album': data[63:93]}
+  return {
+      key: value.split(b'\x00')[0].decode('latin-1').strip() or None
+      for key, value in fields.items()
+  }
+
+
+def checksum(path):
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(CHUNK), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+#metadata of the MP3 file at path. ValueError when it has no MPEG audio
+def probe(path):
+  file_size = os.path.getsize(path)
+  with open(path, 'rb') as f:
+    data = f.read(10)
+    tag_size, tags = _id3v2(data)
+    f.seek(0)
+    data = f.read(tag_size + SYNC_WINDOW)
+    if tag_size:
+      tag_size, tags = _id3v2(data)
+    v1 = _id3v1(f, file_size)
+  pos, header = _first_frame(data, tag_size)
+  if header is None:
+    raise ValueError('no MPEG audio frame found')
+  version, layer, bitrate, sample_rate, _, _ = header
+  frames, size = _vbr_header(data, pos, header)
+  audio = (size or file_size - pos - (128 if v1 else 0))
+  if frames:
+    duration = frames * _samples_per_frame(version, layer) / sample_rate
+    bitrate = round(audio * 8 / duration / 1000) if duration else bitrate
+  else:
+    duration = audio * 8 / (bitrate * 1000)
+  if (tags.get('tlen') or '').isdigit() and not frames:
+    #a length tag beats estimating a stream that may not be constant bitrate
+    duration = int(tags['tlen']) / 1000
+  return {
+      'duration': round(duration, 3),
+      'bitrate': bitrate,
+      'sample_rate': sample_rate,
+      'checksum': checksum(path),
+      'title': tags.get('title') or v1.get('title'),
+      'artist': tags.get('artist') or v1.get('artist'),
+      'album': tags.get('album') or v1.get('album'),
+  }
@@ -0,0 +1,62 @@
+'''
+Move pictures saved before the artwork store into it.
+
+Rows still pointing at files under static/albums, static/playlists or
+static/profile are given the content hashed copy of the file and its
+renditions, like a new upload would. The old files are left where they are.
+
+Run with: python backfill_artwork.py [--dry-run]
+'''
+import argparse
+import os
+import sys
+
+from sqlalchemy import update
+
+from main import _artwork_columns, app, db, store_artwork, use_rendition
+
+# folder under static -> kind of picture
+FOLDERS = {'albums': 'album', 'playlists': 'playlist', 'profile': 'profile'}
+
+
+def legacy_pictures(kind, folder):
+  found = set()
+  for col in _artwork_columns()[kind]:
+    found.update(
+        picture for (picture, ) in db.session.query(col).filter(
+            col.like(f'../static/{folder}/%')).distinct())
+  return sorted(found)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument('--dry-run', action='store_true')
+  args = parser.parse_args()
+  moved = missing = 0
+  with app.app_context():
+    for folder, kind in FOLDERS.items():
+      for picture in legacy_pictures(kind, folder):
+        path = os.path.join(app.root_path, picture[len('../'):])
+        if not os.path.isfile(path):
+          print(f'missing {picture}')
+          missing += 1
+          continue
+        if args.dry_run:
+          print(f'would move {picture}')
+          continue
+        with open(path, 'rb') as f:
+          stored = store_artwork(f.read(), path)
+        for col in _artwork_columns()[kind]:
+          db.session.execute(
+              update(col.class_).where(col == picture).values(
+                  {col.key: stored}))
+        db.session.commit()
+        use_rendition(stored, kind)
+        print(f'{picture} -> {stored}')
+        moved += 1
+  print(f'{moved} moved, {missing} missing')
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,323 @@
+'''
+Synthetic data generator and route benchmark for main.py.
+
+  python bench.py generate --songs 100000 --plays 1000000
+  python bench.py run
+  python bench.py run --save      (write bench_baseline.json)
+  python bench.py run --check     (fail on regressions against it)
+
+The benchmark database is DATABASE_URL, instance/bench.db by default, and is
+wiped by generate. Rows are written with batched core inserts, one
+transaction per batch, with the secondary indexes built after the load, and
+the derived tables (rating aggregates, play counts, search index, song
+similarities, trending scores) are rebuilt once at the end.
+
+run drives the routes through Flask's test client and reports p50/p99
+latency and the number of queries per request, read from the X-SQL-Profile
+header. --check compares the routes in CHECKED against the saved baseline.
+'''
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///bench.db")
+os.environ["SQL_PROFILE"] = "1"
+os.environ.setdefault("PLAY_LOG_DURABILITY", "sync")
+
+from datetime import datetime, timedelta  # noqa: E402
+
+from sqlalchemy import insert  # noqa: E402
+
+from main import (  # noqa: E402
+  PLAYLIST_GAP,
+  Admin,
+  Album,
+  Artist,
+  Playlist,
+  Ratings,
+  Song,
+  SongLog,
+  User,
+  app,
+  create_missing_indexes,
+  db,
+  init_search_index,
+  migrate,
+  playlist_song,
+  rebuild_play_counts,
+  rebuild_rating_aggregates,
+  rebuild_recommendations,
+  rebuild_search_index,
+  rebuild_trending,
+)
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'bench_baseline.json')
+BATCH = 50000
+
+# routes whose numbers are compared with the baseline by --check
+CHECKED = ['home', 'search_results', 'admin_dashboard', 'profile']
+# a route regresses when its p50 grows past baseline * SLOWER + SLACK_MS or
+# it issues more queries than the baseline did
+SLOWER = 1.5
+SLACK_MS = 2.0
+
+WORDS = ['love', 'night', 'blue', 'river', 'fire', 'dream', 'summer', 'rain']
+
+
+#insert rows (dicts) in batches straight through the DBAPI cursor, with the
+#statement compiled once and values converted by the column types
+def batched(table, rows):
+  dialect = db.engine.dialect
+  columns = list(table.columns)
+  processors = [(column.name, column.type.bind_processor(dialect))
+                for column in columns]
+  statement = str(insert(table).compile(dialect=dialect))
+
+  def convert(row):
+    values = [(name, row.get(name)) for name, _ in processors]
+    values = [
+        processor(value) if processor and value is not None else value
+        for (_, processor), (_, value) in zip(processors, values, strict=True)
+    ]
+    if dialect.positional:
+      return tuple(values)
+    return dict(zip((name for name, _ in processors), values, strict=True))
+
+  def write(batch):
+    with db.engine.begin() as conn:
+      conn.exec_driver_sql(statement, batch)
+
+  batch = []
+  for row in rows:
+    batch.append(convert(row))
+    if len(batch) == BATCH:
+      write(batch)
+      batch = []
+  if batch:
+    write(batch)
+
+
+def generate(args):
+  rnd = random.Random(args.seed)
+  now = datetime.now()
+
+  def when(days=60):
+    return now - timedelta(seconds=rnd.randrange(days * 86400))
+
+  #plays and ratings favour a few popular songs like real traffic does
+  def popular_song():
+    return int(args.songs * rnd.random()**3) + 1
+
+  start = time.perf_counter()
+  db.drop_all()
+  db.create_all()
+  migrate()
+  init_search_index()
+  #secondary indexes are dropped while loading and built once at the end,
+  #which is much cheaper than maintaining them row by row
+  with db.engine.begin() as conn:
+    for table in db.metadata.sorted_tables:
+      for index in table.indexes:
+        index.drop(conn)
+  users = [f'user{x}' for x in range(args.users)]
+  artists = users[:args.artists]
+  batched(User.__table__, ({
+      'username': name,
+      'email': f'{name}@example.com',
+      'password': 'pass',
+      'creator': x < args.artists,
+      'profile_picture': '../static/artist.png',
+      'time': when()
+  } for x, name in enumerate(users)))
+  batched(Artist.__table__, ({
+      'username': name,
+      'profile_picture': '../static/artist.png',
+      'time': when()
+  } for name in artists))
+  batched(Album.__table__, ({
+      'id': x + 1,
+      'name': f'Album {x}',
+      'artist_name': artists[x % len(artists)],
+      'album_picture': '../static/album_icon.png',
+      'time': when()
+  } for x in range(args.albums)))
+  batched(Song.__table__, ({
+      'id': x + 1,
+      'name': f'Song {x} {rnd.choice(WORDS)}',
+      'artist_name': artists[(x % args.albums) % len(artists)],
+      'album_id': x % args.albums + 1,
+      'path': '',
+      'song_image': '../static/music_icon.png',
+      'time': when()
+  } for x in range(args.songs)))
+  batched(Playlist.__table__, ({
+      'id': x + 1,
+      'name': f'Playlist {x} {rnd.choice(WORDS)}',
+      'username': users[x % len(users)],
+      'playlist_picture': '../static/playlist_icon.png'
+  } for x in range(args.playlists)))
+  batched(playlist_song, ({
+      'playlist_id': x % args.playlists + 1,
+      'song_id': popular_song(),
+      'position': (x // args.playlists + 1) * PLAYLIST_GAP
+  } for x in range(args.playlists * 20)))
+  batched(Ratings.__table__, ({
+      'song_id': popular_song(),
+      'username': rnd.choice(users),
+      'rating': rnd.randint(1, 5),
+      'time': when()
+  } for _ in range(args.ratings)))
+  batched(SongLog.__table__, ({
+      'song_id': popular_song(),
+      'username': rnd.choice(users),
+      'time': when()
+  } for _ in range(args.plays)))
+  db.session.add(Admin(username='admin', password='pass'))
+  db.session.commit()
+  with db.engine.begin() as conn:
+    create_missing_indexes(conn)
+  loaded = time.perf_counter()
+  rebuild_rating_aggregates()
+  rebuild_play_counts()
+  rebuild_search_index()
+  rebuild_recommendations()
+  rebuild_trending()
+  print(f'loaded in {loaded - start:.1f}s, derived tables rebuilt in '
+        f'{time.perf_counter() - loaded:.1f}s')
+
+
+# (name, method, url, logged in user, admin, form data)
+def routes():
+  user = 'user0'
+  listener = User.query.filter_by(creator=False).first().username
+  album = Album.query.filter_by(artist_name=user).first().id
+  playlist = Playlist.query.first().id
+  return [
+      ('index', 'GET', '/', None, False, None),
+      ('login', 'POST', '/login', None, False, {
+          'username': user,
+          'password': 'pass'
+      }),
+      ('home', 'GET', '/home', user, False, None),
+      ('search_results', 'GET', '/search_results/love', user, False, None),
+      ('profile', 'GET', f'/profile/{user}', listener, False, None),
+      ('profile_listener', 'GET', f'/profile/{listener}', user, False, None),
+      ('reg_creator', 'GET', '/creator', listener, False, None),
+      ('view_album', 'GET', f'/album/{album}', user, False, None),
+      ('view_playlist', 'GET', f'/playlist/{playlist}', user, False, None),
+      ('create_song', 'GET', f'/{user}/create/song', user, False, None),
+      ('create_album', 'GET', f'/{user}/create/album', user, False, None),
+      ('create_playlist', 'GET', f'/{user}/create/playlist', user, False,
+       None),
+      ('edit_playlist', 'GET', f'/{user}/edit/playlist/{playlist}', user,
+       False, None),
+      ('edit_album', 'GET', f'/{user}/edit/album/{album}', user, False, None),
+      ('song_rating', 'POST', f'/rating/1/{user}/4', user, False, None),
+      ('song_clicked', 'POST', f'/song_clicked/1/{user}', user, False, None),
+      ('stream_song', 'GET', '/stream/1', user, False, None),
+      ('api_album', 'GET', f'/api/album/{album}', None, False, None),
+      ('api_playlist', 'GET', f'/api/playlist/{playlist}', None, False, None),
+      ('api_artist', 'GET', f'/api/artist/{user}', None, False, None),
+      ('api_trending', 'GET', '/api/trending/song?window=7d', None, False,
+       None),
+      ('api_autocomplete', 'GET', '/api/autocomplete?q=lo', None, False, None),
+      ('retrieve_time', 'GET', '/time/User,Artist,Album,Song,SongLog,Ratings',
+       None, True, None),
+      ('admin_dashboard', 'GET', '/admin', None, True, None),
+      ('plays_daily', 'GET', '/plays/daily', None, True, None),
+      ('detail_artist', 'GET', '/detail/artist', None, True, None),
+      ('detail_album', 'GET', '/detail/album', None, True, None),
+      ('detail_user', 'GET', '/detail/user', None, True, None),
+      ('detail_song', 'GET', '/detail/song', None, True, None),
+  ]
+
+
+def percentile(samples, fraction):
+  samples = sorted(samples)
+  return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def run(args):
+  client = app.test_client()
+  with app.app_context():
+    todo = routes()
+  results = {}
+  for name, method, url, username, admin, data in todo:
+    with client.session_transaction() as sess:
+      sess['username'] = username
+      sess['admin'] = admin
+    latencies, queries = [], 0
+    for _ in range(args.requests):
+      form = dict(data) if data else None
+      start = time.perf_counter()
+      response = client.open(url, method=method, data=form)
+      latencies.append((time.perf_counter() - start) * 1000)
+      header = response.headers.get('X-SQL-Profile', 'queries=0')
+      queries = int(header.split(';')[0].split('=')[1])
+      if response.status_code >= 500:
+        sys.exit(f'{name}: {url} answered {response.status_code}')
+    results[name] = {
+        'p50_ms': round(percentile(latencies, 0.5), 2),
+        'p99_ms': round(percentile(latencies, 0.99), 2),
+        'queries': queries
+    }
+    print(f'{name:18} p50 {results[name]["p50_ms"]:9.2f}ms  '
+          f'p99 {results[name]["p99_ms"]:9.2f}ms  '
+          f'{queries:4d} queries')
+  if args.save:
+    with open(BASELINE, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+    print(f'baseline written to {BASELINE}')
+  if args.check:
+    return check(results)
+  return 0
+
+
+def check(results):
+  with open(BASELINE) as f:
+    baseline = json.load(f)
+  failed = 0
+  for name in CHECKED:
+    before, now = baseline[name], results[name]
+    if now['p50_ms'] > before['p50_ms'] * SLOWER + SLACK_MS:
+      print(f'REGRESSION {name}: p50 {before["p50_ms"]}ms -> '
+            f'{now["p50_ms"]}ms')
+      failed += 1
+    if now['queries'] > before['queries']:
+      print(f'REGRESSION {name}: {before["queries"]} -> {now["queries"]} '
+            'queries per request')
+      failed += 1
+  print(f'{failed} regressions')
+  return 1 if failed else 0
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  commands = parser.add_subparsers(dest='command', required=True)
+  gen = commands.add_parser('generate', help='load synthetic data')
+  gen.add_argument('--users', type=int, default=5000)
+  gen.add_argument('--artists', type=int, default=500)
+  gen.add_argument('--albums', type=int, default=2000)
+  gen.add_argument('--songs', type=int, default=20000)
+  gen.add_argument('--playlists', type=int, default=2000)
+  gen.add_argument('--ratings', type=int, default=100000)
+  gen.add_argument('--plays', type=int, default=1000000)
+  gen.add_argument('--seed', type=int, default=1)
+  bench = commands.add_parser('run', help='benchmark the routes')
+  bench.add_argument('--requests', type=int, default=50)
+  bench.add_argument('--save', action='store_true')
+  bench.add_argument('--check', action='store_true')
+  args = parser.parse_args()
+  with app.app_context():
+    if args.command == 'generate':
+      generate(args)
+      return 0
+  return run(args)
+
+
+if __name__ == '__main__':
+  sys.exit(main())
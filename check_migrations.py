@@ -0,0 +1,63 @@
+'''
+Migration check for main.py.
+
+A copy of instance/music_app.db, which has the schema the app was first
+shipped with, is opened as the database, so importing main runs every
+migration step on it. Every table, column and index of the current models
+must exist afterwards, and running the migrations again must change nothing.
+
+Run with: python check_migrations.py
+'''
+import os
+import shutil
+import sys
+import tempfile
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance',
+                        'music_app.db')
+DB_DIR = tempfile.mkdtemp()
+shutil.copy(BASELINE, os.path.join(DB_DIR, 'baseline.db'))
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(DB_DIR, "baseline.db")
+
+from sqlalchemy import inspect  # noqa: E402
+
+from main import MIGRATIONS, SchemaVersion, app, db, migrate  # noqa: E402
+
+
+#what the models declare and the database lacks, as messages
+def missing(conn):
+  found = []
+  schema = inspect(conn)
+  tables = set(schema.get_table_names())
+  for table in db.metadata.sorted_tables:
+    if table.name not in tables:
+      found.append(f'missing table {table.name}')
+      continue
+    columns = {column['name'] for column in schema.get_columns(table.name)}
+    found.extend(f'missing column {table.name}.{column.name}'
+                 for column in table.columns if column.name not in columns)
+    indexes = {index['name'] for index in schema.get_indexes(table.name)}
+    found.extend(f'missing index {index.name}' for index in table.indexes
+                 if index.name not in indexes)
+  return found
+
+
+def main():
+  failures = []
+  with app.app_context():
+    with db.engine.connect() as conn:
+      failures += missing(conn)
+      version = conn.execute(db.select(SchemaVersion.version)).scalar()
+    if version != len(MIGRATIONS):
+      failures.append(f'schema version {version}, expected {len(MIGRATIONS)}')
+    migrate()
+    with db.engine.connect() as conn:
+      failures += [f'{each} after migrating again' for each in missing(conn)]
+  for failure in failures:
+    print(f'FAIL {failure}')
+  print(f'{len(MIGRATIONS)} migrations, {len(failures)} failures')
+  return 1 if failures else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,62 @@
+'''
+Compact old plays out of SongLog.
+
+The plays of each day older than SONG_LOG_RETENTION_DAYS are written to a
+gzipped csv under SONG_LOG_ARCHIVE_DIR (YYYY/MM/YYYY-MM-DD.csv.gz), counted
+into the daily plays of their songs and users and deleted from SongLog, at
+most SONG_LOG_DELETE_BATCH rows per transaction so the play log is never
+locked for long. An interrupted run is finished by running it again. Meant to
+be run daily from cron.
+
+Run with: python compact_song_log.py [--days N] [--dry-run]
+'''
+import argparse
+import sys
+import time
+
+from sqlalchemy import func
+
+from main import (
+  SongLog,
+  app,
+  compact_song_log_day,
+  db,
+  next_compactable_day,
+  song_log_cutoff,
+)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument('--days',
+                      type=int,
+                      help='keep this many days instead of '
+                      'SONG_LOG_RETENTION_DAYS')
+  parser.add_argument('--dry-run', action='store_true')
+  args = parser.parse_args()
+  start = time.perf_counter()
+  moved = days = 0
+  with app.app_context():
+    cutoff = song_log_cutoff(args.days)
+    if args.dry_run:
+      count, oldest = db.session.execute(
+          db.select(func.count(), func.min(SongLog.time)).where(
+              SongLog.time < cutoff)).one()
+      print(f'{count} plays before {cutoff:%Y-%m-%d} to compact')
+      if oldest:
+        print(f'the oldest on {oldest:%Y-%m-%d}')
+      return 0
+    day = next_compactable_day(cutoff)
+    while day is not None:
+      count = compact_song_log_day(day)
+      moved += count
+      days += 1
+      print(f'{day:%Y-%m-%d}: {count} plays compacted')
+      day = next_compactable_day(cutoff)
+  print(f'{moved} plays of {days} days before {cutoff:%Y-%m-%d} compacted '
+        f'in {time.perf_counter() - start:.1f}s')
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,302 @@
+'''
+Bulk import of a back catalog of MP3 files.
+
+Tracks are read from a directory tree of artist/album/track.mp3, or from a
+manifest CSV with path, artist, album and title columns (and an optional
+email column for the artists' accounts) whose paths are relative to the
+manifest. Missing users, artists and albums are created as the tracks need
+them. A pool of threads hashes the audio, copies it into the audio store (or
+hard links it with --link) and reads its duration and bitrate, and the rows
+of --batch tracks are written in one transaction.
+
+A track is identified by its artist, album and title. Tracks already in the
+catalog are skipped before their files are read, so an interrupted import is
+resumed by running it again.
+
+Run with: python import_catalog.py DIRECTORY [--link]
+          python import_catalog.py --manifest tracks.csv [--link]
+'''
+import argparse
+import csv
+import errno
+import hashlib
+import os
+import re
+import secrets
+import sys
+import tempfile
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import audio_meta
+from main import (
+  AUDIO_DIR,
+  AUDIO_TYPES,
+  Album,
+  Artist,
+  AudioBlob,
+  Song,
+  User,
+  _audio_file,
+  app,
+  audio_reference,
+  db,
+  invalidate_shelves,
+  upsert,
+)
+
+Track = namedtuple('Track', ['path', 'artist', 'album', 'title', 'email'])
+# the stored file of a track and what was read from it
+Stored = namedtuple('Stored', ['track', 'digest', 'size', 'meta'])
+
+#leading track numbers of file names, "01 - ", "1. " or "01_"
+TRACK_NUMBER = re.compile(r'^\d+\s*[-._)]?\s*')
+
+
+def _title(filename):
+  stem = os.path.splitext(filename)[0]
+  return TRACK_NUMBER.sub('', stem).strip() or stem
+
+
+#tracks of an artist/album/track tree, in path order
+def walk_tracks(root):
+  for artist in sorted(os.listdir(root)):
+    artist_dir = os.path.join(root, artist)
+    if not os.path.isdir(artist_dir):
+      continue
+    for album in sorted(os.listdir(artist_dir)):
+      album_dir = os.path.join(artist_dir, album)
+      if not os.path.isdir(album_dir):
+        continue
+      for filename in sorted(os.listdir(album_dir)):
+        if filename.lower().endswith(AUDIO_TYPES):
+          yield Track(os.path.join(album_dir, filename), artist.strip(),
+                      album.strip(), _title(filename), None)
+
+
+def read_manifest(manifest):
+  base = os.path.dirname(os.path.abspath(manifest))
+  with open(manifest, newline='', encoding='utf-8') as f:
+    for row in csv.DictReader(f):
+      yield Track(os.path.join(base, row['path']), row['artist'].strip(),
+                  row['album'].strip(),
+                  (row.get('title') or '').strip() or _title(row['path']),
+                  (row.get('email') or '').strip() or None)
+
+
+#put a file into the audio store under its digest, returning (digest, size).
+#A copy is hashed as it is written to a temporary file next to the store, so
+#storing it is a rename like an upload. A link only has to be hashed
+def store_file(path, link):
+  if link:
+    digest = audio_meta.checksum(path)
+    target = _audio_file(digest)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+      os.link(path, target)
+      return digest, os.path.getsize(path)
+    except FileExistsError:
+      return digest, os.path.getsize(path)
+    except OSError as e:
+      if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+        raise
+      #another file system, or links are not allowed: copy it after all
+  digest, size = hashlib.sha256(), 0
+  with open(path, 'rb') as src, tempfile.NamedTemporaryFile(
+      dir=AUDIO_DIR, prefix='.import-', delete=False) as tmp:
+    try:
+      for chunk in iter(lambda: src.read(audio_meta.CHUNK), b''):
+        digest.update(chunk)
+        size += len(chunk)
+        tmp.write(chunk)
+    except BaseException:
+      os.remove(tmp.name)
+      raise
+  digest = digest.hexdigest()
+  target = _audio_file(digest)
+  if os.path.exists(target):
+    os.remove(tmp.name)
+  else:
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    os.replace(tmp.name, target)
+  return digest, size
+
+
+#store a track's file and read its metadata, run in the thread pool
+def prepare(track, link):
+  digest, size = store_file(track.path, link)
+  try:
+    meta = audio_meta.probe(_audio_file(digest))
+  except ValueError:
+    meta = None
+  return Stored(track, digest, size, meta)
+
+
+#the tracks of a batch that are not in the catalog yet, once each
+def new_tracks(tracks):
+  artists = {track.artist for track in tracks}
+  albums = {track.album for track in tracks}
+  seen = set(
+      db.session.execute(
+          db.select(Album.artist_name, Album.name, Song.name).join(
+              Song, Song.album_id == Album.id).where(
+                  Album.artist_name.in_(artists), Album.name.in_(albums))))
+  todo = []
+  for track in tracks:
+    key = (track.artist, track.album, track.title)
+    if key not in seen:
+      seen.add(key)
+      todo.append(track)
+  return todo
+
+
+#users and artist profiles of the batch's artists, creating what is missing.
+#An existing user the catalog credits is made a creator, which is reported
+def ensure_artists(tracks, now):
+  emails = {track.artist: track.email for track in tracks}
+  users = {
+      user.username: user
+      for user in User.query.filter(User.username.in_(emails))
+  }
+  artists = {
+      artist.username
+      for artist in Artist.query.filter(Artist.username.in_(emails))
+  }
+  for name, email in emails.items():
+    user = users.get(name)
+    if user is None:
+      #nobody knows the password, the label signs in once it is reset
+      user = User(username=name,
+                  email=email or f'{name}@catalog.invalid',
+                  password=secrets.token_hex(16),
+                  creator=True,
+                  profile_picture='../static/artist.png',
+                  time=now)
+      db.session.add(user)
+    elif not user.creator:
+      print(f'existing user {name} made a creator for their tracks')
+      user.creator = True
+    if name not in artists:
+      db.session.add(
+          Artist(username=name,
+                 profile_picture=user.profile_picture,
+                 time=now))
+
+
+#(artist, album name) -> Album of the batch, creating what is missing
+def ensure_albums(tracks, now):
+  albums = {
+      (album.artist_name, album.name): album
+      for album in Album.query.filter(
+          Album.artist_name.in_({track.artist for track in tracks}),
+          Album.name.in_({track.album for track in tracks}))
+  }
+  for track in tracks:
+    key = (track.artist, track.album)
+    if key not in albums:
+      albums[key] = Album(name=track.album,
+                          artist_name=track.artist,
+                          album_picture='../static/album_icon.png',
+                          time=now)
+      db.session.add(albums[key])
+  db.session.flush()
+  return albums
+
+
+#write the rows of a batch of stored tracks in one transaction
+def write_batch(stored, link):
+  now = datetime.now()
+  tracks = [each.track for each in stored]
+  ensure_artists(tracks, now)
+  albums = ensure_albums(tracks, now)
+  refs = {}
+  for each in stored:
+    count, size = refs.get(each.digest, (0, each.size))
+    refs[each.digest] = (count + 1, size)
+  stmt = upsert(AudioBlob)
+  db.session.execute(
+      stmt.on_conflict_do_update(
+          index_elements=['digest'],
+          set_={'ref_count': AudioBlob.ref_count + stmt.excluded.ref_count}),
+      [{
+          'digest': digest,
+          'size': size,
+          'ref_count': count
+      } for digest, (count, size) in refs.items()])
+  #the rows hold on to the files from here on. Put back the ones removed
+  #since they were stored, when the last song using them was deleted
+  for each in stored:
+    if not os.path.exists(_audio_file(each.digest)):
+      store_file(each.track.path, link)
+  for each in stored:
+    album = albums[(each.track.artist, each.track.album)]
+    meta = each.meta or {}
+    db.session.add(
+        Song(name=each.track.title,
+             artist_name=each.track.artist,
+             album_id=album.id,
+             path=audio_reference(each.digest),
+             audio_digest=each.digest,
+             song_image=album.album_picture
+             if album.album_picture != '../static/album_icon.png' else
+             '../static/music_icon.png',
+             time=now,
+             duration=meta.get('duration'),
+             bitrate=meta.get('bitrate'),
+             checksum=meta.get('checksum')))
+  db.session.commit()
+
+
+def batches(tracks, size):
+  batch = []
+  for track in tracks:
+    batch.append(track)
+    if len(batch) == size:
+      yield batch
+      batch = []
+  if batch:
+    yield batch
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument('directory', nargs='?')
+  parser.add_argument('--manifest')
+  parser.add_argument('--link', action='store_true',
+                      help='hard link the files instead of copying them')
+  parser.add_argument('--batch', type=int, default=1000)
+  parser.add_argument('--workers', type=int, default=8)
+  args = parser.parse_args()
+  if bool(args.directory) == bool(args.manifest):
+    parser.error('give either a directory or --manifest')
+  tracks = (read_manifest(args.manifest)
+            if args.manifest else walk_tracks(args.directory))
+  start = time.perf_counter()
+  imported = skipped = failed = 0
+  os.makedirs(AUDIO_DIR, exist_ok=True)
+  with app.app_context(), ThreadPoolExecutor(args.workers) as pool:
+    for batch in batches(tracks, args.batch):
+      todo = new_tracks(batch)
+      skipped += len(batch) - len(todo)
+      futures = [(track, pool.submit(prepare, track, args.link))
+                 for track in todo]
+      stored = []
+      for track, future in futures:
+        try:
+          stored.append(future.result())
+        except OSError as e:
+          print(f'failed {track.path}: {e}')
+          failed += 1
+      if stored:
+        write_batch(stored, args.link)
+      imported += len(stored)
+      print(f'{imported} imported, {skipped} skipped, {failed} failed '
+            f'({time.perf_counter() - start:.1f}s)')
+    invalidate_shelves()
+  return 1 if failed else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
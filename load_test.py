@@ -0,0 +1,201 @@
+'''
+Load test of concurrent reads and play-log writes.
+
+Reader and writer processes share one database like gunicorn workers do.
+Writers log plays with PLAY_LOG_DURABILITY=sync (one commit per play) and
+post ratings, readers fetch pages. Latency and failed requests are reported
+for both sides.
+
+  python load_test.py              (WAL and the read engine, the default)
+  python load_test.py --legacy     (rollback journal and a single engine)
+
+The database is DATABASE_URL, a scratch SQLite file by default.
+'''
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+
+def options(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument('--seconds', type=float, default=10)
+  parser.add_argument('--readers', type=int, default=4)
+  parser.add_argument('--writers', type=int, default=2)
+  parser.add_argument('--legacy', action='store_true')
+  return parser.parse_args(argv)
+
+
+#worker processes import this module again, so the settings have to be in
+#place before main is imported
+ARGS = options(sys.argv[1:])
+if ARGS.legacy:
+  os.environ["SQLITE_JOURNAL_MODE"] = "DELETE"
+  os.environ["DATABASE_READ_SPLIT"] = "0"
+if "DATABASE_URL" not in os.environ:
+  os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(
+      tempfile.mkdtemp(), "load.db")
+os.environ["PLAY_LOG_DURABILITY"] = "sync"
+
+from datetime import datetime  # noqa: E402
+
+from main import (  # noqa: E402
+  Album,
+  Artist,
+  Ratings,
+  Song,
+  User,
+  app,
+  db,
+  init_search_index,
+  migrate,
+  rebuild_play_counts,
+  rebuild_rating_aggregates,
+  rebuild_search_index,
+  record_plays,
+)
+
+USERS = 50
+SONGS = 500
+
+
+def seed():
+  now = datetime.now()
+  db.drop_all()
+  db.create_all()
+  migrate()
+  init_search_index()
+  for x in range(USERS):
+    db.session.add(
+        User(username=f'user{x}',
+             email=f'user{x}@example.com',
+             password='pass',
+             creator=x < 10,
+             profile_picture='../static/artist.png',
+             time=now))
+    if x < 10:
+      db.session.add(
+          Artist(username=f'user{x}',
+                 profile_picture='../static/artist.png',
+                 time=now))
+  for x in range(50):
+    db.session.add(
+        Album(name=f'Album {x} love',
+              artist_name=f'user{x % 10}',
+              album_picture='../static/album_icon.png',
+              time=now))
+  db.session.flush()
+  for x in range(SONGS):
+    db.session.add(
+        Song(name=f'Song {x} love',
+             artist_name=f'user{x % 50 % 10}',
+             album_id=x % 50 + 1,
+             path='',
+             song_image='../static/music_icon.png',
+             time=now))
+  db.session.flush()
+  for x in range(2000):
+    db.session.add(
+        Ratings(song_id=x % SONGS + 1,
+                username=f'user{x % USERS}',
+                rating=x % 5 + 1,
+                time=now))
+  db.session.commit()
+  record_plays([{
+      'song_id': x % SONGS + 1,
+      'username': f'user{x % USERS}',
+      'time': now
+  } for x in range(20000)])
+  rebuild_rating_aggregates()
+  rebuild_play_counts()
+  rebuild_search_index()
+
+
+def reads(n):
+  return [
+      '/home', f'/album/{n % 50 + 1}', f'/api/album/{n % 50 + 1}',
+      '/search_results/love', f'/profile/user{n % 10}'
+  ]
+
+
+def writes(n):
+  song, user = n * 7 % SONGS + 1, f'user{n % USERS}'
+  return [('POST', f'/song_clicked/{song}/{user}'),
+          ('POST', f'/rating/{song}/{user}/{n % 5 + 1}')]
+
+
+#run requests between start and deadline, sending (kind, latencies,
+#failures) back
+def worker(kind, number, start, deadline, results):
+  logging.disable(logging.CRITICAL)
+  client = app.test_client()
+  with client.session_transaction() as sess:
+    sess['username'] = f'user{number % USERS}'
+    sess['admin'] = False
+  latencies, failed, n = [], 0, number
+  time.sleep(max(0, start - time.time()))
+  try:
+    while time.time() < deadline:
+      requests = ([('GET', url) for url in reads(n)]
+                  if kind == 'read' else writes(n))
+      for method, url in requests:
+        sent = time.perf_counter()
+        response = client.open(url, method=method)
+        latencies.append((time.perf_counter() - sent) * 1000)
+        if response.status_code >= 500:
+          failed += 1
+      n += 1
+  finally:
+    results.put((kind, latencies, failed))
+
+
+def report(kind, latencies, failed, seconds):
+  latencies.sort()
+  if not latencies:
+    print(f'{kind}: no requests')
+    return
+
+  def at(fraction):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+  print(f'{kind:6} {len(latencies) / seconds:8.1f} req/s  p50 {at(0.5):8.2f}ms  '
+        f'p99 {at(0.99):8.2f}ms  max {latencies[-1]:8.2f}ms  '
+        f'{failed} failed')
+
+
+def main():
+  with app.app_context():
+    seed()
+  context = multiprocessing.get_context('spawn')
+  results = context.Queue()
+  #leave the workers time to start before the clock runs
+  start = time.time() + 5
+  deadline = start + ARGS.seconds
+  workers = [
+      context.Process(target=worker, args=('read', x, start, deadline, results))
+      for x in range(ARGS.readers)
+  ] + [
+      context.Process(target=worker, args=('write', x, start, deadline, results))
+      for x in range(ARGS.writers)
+  ]
+  for process in workers:
+    process.start()
+  collected = {'read': ([], 0), 'write': ([], 0)}
+  for _ in workers:
+    kind, latencies, failed = results.get()
+    collected[kind] = (collected[kind][0] + latencies,
+                       collected[kind][1] + failed)
+  for process in workers:
+    process.join()
+  print('legacy journal, single engine' if ARGS.legacy else
+        'WAL, separate read engine')
+  for kind, (latencies, failed) in collected.items():
+    report(kind, latencies, failed, ARGS.seconds)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -1,170 +1,3693 @@
-from flask import Flask, flash, redirect, render_template, request, url_for, session, jsonify, make_response
-from flask_sqlalchemy import SQLAlchemy
+import atexit
+import base64
+import bisect
+import contextlib
+import csv
+import glob
+import gzip
+import hashlib
+import itertools
+import json
+import math
+import multiprocessing
 import os
+import queue
+import re
+import shutil
+import tempfile
+import threading
+import time
+from array import array
+from collections import Counter, OrderedDict, namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta
-from sqlalchemy import desc, func
 
-'''
-Flask application for a music streaming platoform.
+from flask import (
+  Flask,
+  Request,
+  abort,
+  flash,
+  g,
+  has_request_context,
+  jsonify,
+  make_response,
+  redirect,
+  render_template,
+  request,
+  send_file,
+  send_from_directory,
+  session,
+  url_for,
+)
+from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from markupsafe import Markup
+from sqlalchemy import (
+  and_,
+  bindparam,
+  case,
+  cast,
+  column,
+  delete,
+  desc,
+  event,
+  exists,
+  func,
+  insert,
+  inspect,
+  or_,
+  table,
+  text,
+  update,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.orm import joinedload
+
+import audio_meta
+
+try:
+  from PIL import Image, ImageOps, features
+except ImportError:
+  #without Pillow pictures are kept as uploaded
+  Image = None
+try:
+  import redis
+except ImportError:
+  #without redis the fragment cache is kept per process
+  redis = None
+try:
+  import numpy
+  from scipy import sparse
+except ImportError:
+  #without NumPy and SciPy the similarity table is rebuilt song by song
+  numpy = sparse = None
+
+'''
+Flask application for a music streaming platoform.
+'''
+#Initialization
+
+app = Flask(__name__)
+app.secret_key = 'your_secret_key_here'
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get(
+    "DATABASE_URL", "sqlite:///music_app.db")
+#let a fronting nginx/apache send audio files through X-Sendfile
+app.config["USE_X_SENDFILE"] = os.environ.get("USE_X_SENDFILE") == "1"
+#how long browsers may reuse streamed audio before revalidating
+app.config["AUDIO_MAX_AGE"] = int(os.environ.get("AUDIO_MAX_AGE", 86400))
+#"buffered" queues play events and writes them in batches, "sync" commits
+#each play before answering like before
+app.config["PLAY_LOG_DURABILITY"] = os.environ.get("PLAY_LOG_DURABILITY",
+                                                   "buffered")
+app.config["PLAY_LOG_BATCH_SIZE"] = int(
+    os.environ.get("PLAY_LOG_BATCH_SIZE", 500))
+app.config["PLAY_LOG_FLUSH_SECONDS"] = float(
+    os.environ.get("PLAY_LOG_FLUSH_SECONDS", 2))
+#events waiting while the database can not be written, the oldest are dropped
+#past this many
+app.config["PLAY_LOG_MAX_QUEUE"] = int(
+    os.environ.get("PLAY_LOG_MAX_QUEUE", 100000))
+#how long the admin timeline counts are reused before being recounted
+app.config["TIMELINE_CACHE_SECONDS"] = float(
+    os.environ.get("TIMELINE_CACHE_SECONDS", 30))
+#how long browsers keep artwork, whose names change with their content
+app.config["ARTWORK_MAX_AGE"] = int(
+    os.environ.get("ARTWORK_MAX_AGE", 365 * 86400))
+#how many signed in users each process keeps in its identity cache, and for
+#how long
+app.config["IDENTITY_CACHE_SIZE"] = int(
+    os.environ.get("IDENTITY_CACHE_SIZE", 1024))
+app.config["IDENTITY_CACHE_SECONDS"] = float(
+    os.environ.get("IDENTITY_CACHE_SECONDS", 30))
+#fragment cache, see FragmentCache. CACHE_URL (redis://...) shares it between
+#processes
+app.config["CACHE_URL"] = os.environ.get("CACHE_URL")
+app.config["FRAGMENT_CACHE_SIZE"] = int(
+    os.environ.get("FRAGMENT_CACHE_SIZE", 2048))
+#how long the home page shelves are kept, the ones everybody sees and the
+#per user ones
+app.config["SHELF_CACHE_SECONDS"] = float(
+    os.environ.get("SHELF_CACHE_SECONDS", 300))
+app.config["USER_SHELF_CACHE_SECONDS"] = float(
+    os.environ.get("USER_SHELF_CACHE_SECONDS", 60))
+#similar songs kept per song for recommendations, and how often the songs
+#played since are brought up to date
+app.config["RECOMMEND_NEIGHBORS"] = int(
+    os.environ.get("RECOMMEND_NEIGHBORS", 50))
+app.config["RECOMMEND_UPDATE_SECONDS"] = float(
+    os.environ.get("RECOMMEND_UPDATE_SECONDS", 60))
+#how often each process rebuilds its autocomplete index from the database
+app.config["AUTOCOMPLETE_REBUILD_SECONDS"] = float(
+    os.environ.get("AUTOCOMPLETE_REBUILD_SECONDS", 600))
+#SongLog rows older than SONG_LOG_RETENTION_DAYS are moved to gzipped daily
+#archives under SONG_LOG_ARCHIVE_DIR by compact_song_log.py, deleting at
+#most SONG_LOG_DELETE_BATCH rows per transaction
+app.config["SONG_LOG_RETENTION_DAYS"] = int(
+    os.environ.get("SONG_LOG_RETENTION_DAYS", 90))
+app.config["SONG_LOG_ARCHIVE_DIR"] = os.environ.get(
+    "SONG_LOG_ARCHIVE_DIR", os.path.join(app.instance_path, "song_log"))
+app.config["SONG_LOG_DELETE_BATCH"] = int(
+    os.environ.get("SONG_LOG_DELETE_BATCH", 5000))
+#windows of the trending charts, in the admin timeline's "24h,7d" notation
+app.config["TRENDING_WINDOWS"] = os.environ.get("TRENDING_WINDOWS", "24h,7d")
+#background jobs run in a pool of JOB_WORKERS processes, see JobRunner. A
+#failed job is retried up to JOB_MAX_ATTEMPTS times, waiting
+#JOB_RETRY_SECONDS and twice as long after each further failure
+app.config["JOB_WORKERS"] = int(os.environ.get("JOB_WORKERS", 2))
+app.config["JOB_MAX_ATTEMPTS"] = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
+app.config["JOB_RETRY_SECONDS"] = float(os.environ.get("JOB_RETRY_SECONDS", 30))
+app.config["JOB_POLL_SECONDS"] = float(os.environ.get("JOB_POLL_SECONDS", 5))
+#a job running longer than this is taken to be lost with its process and
+#queued again
+app.config["JOB_TIMEOUT"] = float(os.environ.get("JOB_TIMEOUT", 600))
+#record the SQL issued by each request, see SQLProfiler
+app.config["SQL_PROFILE"] = os.environ.get("SQL_PROFILE") == "1"
+#connection pool of each engine, per worker process
+_pool = {
+    "pool_size": int(os.environ.get("DB_POOL_SIZE", 5)),
+    "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+    "pool_timeout": float(os.environ.get("DB_POOL_TIMEOUT", 30))
+}
+if not app.config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite"):
+  _pool["pool_pre_ping"] = True
+if ":memory:" not in app.config["SQLALCHEMY_DATABASE_URI"]:
+  app.config["SQLALCHEMY_ENGINE_OPTIONS"] = _pool
+#sqlite runs in WAL mode so readers and the writer do not block each other,
+#and a writer waits up to SQLITE_BUSY_TIMEOUT ms for the lock instead of
+#failing with "database is locked"
+app.config["SQLITE_JOURNAL_MODE"] = os.environ.get("SQLITE_JOURNAL_MODE", "WAL")
+app.config["SQLITE_BUSY_TIMEOUT"] = int(
+    os.environ.get("SQLITE_BUSY_TIMEOUT", 5000))
+#GET requests read through a separate pool of read only connections, on a
+#replica when DATABASE_READ_URL is set or else on the main database
+app.config["DATABASE_READ_SPLIT"] = os.environ.get("DATABASE_READ_SPLIT",
+                                                   "1") == "1"
+_read_url = os.environ.get("DATABASE_READ_URL",
+                           app.config["SQLALCHEMY_DATABASE_URI"])
+if app.config["DATABASE_READ_SPLIT"] and ":memory:" not in _read_url:
+  _read_pool = dict(_pool,
+                    pool_size=int(
+                        os.environ.get("DB_READ_POOL_SIZE",
+                                       _pool["pool_size"])))
+  app.config["SQLALCHEMY_BINDS"] = {"read": dict(_read_pool, url=_read_url)}
+
+
+#sends the queries of GET requests to the read engine. Anything outside a
+#request like the play log writer uses the main one, and so does a session
+#from its first write on (a flush, an INSERT/UPDATE/DELETE or a SELECT .. FOR
+#UPDATE), so a GET that writes reads what it wrote
+class RoutingSession(Session):
+
+  def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+    if self._flushing or getattr(clause, 'is_dml', False) or getattr(
+        clause, '_for_update_arg', None) is not None:
+      self.info['writing'] = True
+    if (bind is None and not self.info.get('writing')
+        and "read" in self._db.engines and has_request_context()
+        and request.method in ("GET", "HEAD")):
+      return self._db.engines["read"]
+    return super().get_bind(mapper, clause, bind, **kwargs)
+
+
+db = SQLAlchemy(app, session_options={"class_": RoutingSession})
+
+
+def sqlite_pragmas(read_only):
+
+  def connect(dbapi_connection, _connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f'PRAGMA busy_timeout={app.config["SQLITE_BUSY_TIMEOUT"]}')
+    if read_only:
+      cursor.execute('PRAGMA query_only=ON')
+    else:
+      cursor.execute(f'PRAGMA journal_mode={app.config["SQLITE_JOURNAL_MODE"]}')
+    if app.config["SQLITE_JOURNAL_MODE"].upper() == 'WAL':
+      #commits stay atomic in WAL mode without syncing every transaction
+      cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+  return connect
+
+
+with app.app_context():
+  for key, engine in db.engines.items():
+    if engine.dialect.name == 'sqlite':
+      event.listen(engine, 'connect', sqlite_pragmas(read_only=key == 'read'))
+
+#Models
+
+class User(db.Model):
+  username = db.Column(db.String(80),
+                       unique=True,
+                       nullable=False,
+                       primary_key=True)
+  email = db.Column(db.String(120), unique=True, nullable=False)
+  password = db.Column(db.String(120), nullable=False)
+  creator = db.Column(db.Boolean, default=False, nullable=False)
+  profile_picture = db.Column(db.String(120), index=True)
+  artist = db.relationship("Artist",
+                           backref="user",
+                           uselist=False,
+                           cascade="all, delete-orphan")
+  playlist = db.relationship("Playlist",
+                           backref="user",
+                           cascade="all, delete-orphan")
+  time = db.Column(db.DateTime)
+  __table_args__ = (db.Index('ix_user_time', 'time', 'username'), )
+
+#table for one to many relationship between playlist and songs
+#position orders the songs of a playlist, see the ordered playlists section
+playlist_song =db.Table(
+    'playlist_song',
+    db.Column('playlist_id', db.Integer, db.ForeignKey('playlist.id')),
+    db.Column('song_id', db.Integer, db.ForeignKey('song.id')),
+    db.Column('position', db.BigInteger),
+    db.Index('ix_playlist_song_playlist_id', 'playlist_id'),
+    db.Index('ix_playlist_song_position', 'playlist_id', 'position'),
+    db.Index('ix_playlist_song_song', 'playlist_id', 'song_id'),
+    db.Index('ix_playlist_song_song_id', 'song_id'))
+#distance between the positions of songs appended to a playlist
+PLAYLIST_GAP = 1 << 16
+
+
+class Playlist(db.Model):
+  id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+  name = db.Column(db.String(255))
+  username = db.Column(db.String(80),
+                       db.ForeignKey('user.username'),
+                       index=True)
+  songs = db.relationship('Song',
+                          secondary='playlist_song',
+                          order_by=playlist_song.c.position)
+  playlist_picture = db.Column(db.String(120), index=True)
+
+
+class Artist(db.Model):
+  username = db.Column(db.String(80),
+                       db.ForeignKey('user.username'),
+                       primary_key=True)
+  profile_picture = db.Column(db.String(120), index=True)
+  time = db.Column(db.DateTime)
+  albums = db.relationship("Album",
+                           backref="artist",
+                           cascade="all, delete-orphan")
+  __table_args__ = (db.Index('ix_artist_time', 'time', 'username'), )
+
+
+class Album(db.Model):
+  id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+  name = db.Column(db.String(255))
+  artist_name = db.Column(db.String(80),
+                          db.ForeignKey('artist.username'),
+                          index=True)
+  album_picture = db.Column(db.String(120), index=True)
+  time = db.Column(db.DateTime, index=True)
+  songs = db.relationship('Song',
+                          backref='album',
+                          cascade='all, delete-orphan')
+  __table_args__ = (db.Index('ix_album_name', 'name', 'id'), )
+
+
+class Song(db.Model):
+  id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+  name = db.Column(db.String(255))
+  artist_name = db.Column(db.String(80),
+                          db.ForeignKey('artist.username'),
+                          index=True)
+  album_id = db.Column(db.Integer, db.ForeignKey('album.id'), index=True)
+  path = db.Column(db.String(255), index=True)
+  song_image = db.Column(db.String(120), index=True)
+  time = db.Column(db.DateTime)
+  audio_digest = db.Column(db.String(64), db.ForeignKey('audio_blob.digest'))
+  #read from the file by the audio_metadata job, seconds and kbps
+  duration = db.Column(db.Float)
+  bitrate = db.Column(db.Integer)
+  checksum = db.Column(db.String(64))
+  __table_args__ = (db.Index('ix_song_name', 'name', 'id'),
+                    db.Index('ix_song_time', 'time', 'id'))
+
+#an uploaded audio file, stored once under the sha256 of its content, and
+#the number of songs using it
+class AudioBlob(db.Model):
+  digest = db.Column(db.String(64), primary_key=True)
+  size = db.Column(db.Integer, nullable=False)
+  ref_count = db.Column(db.Integer, nullable=False, default=0)
+
+
+#record of all ratings that are submitted by users
+class Ratings(db.Model):
+  id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+  song_id = db.Column(db.Integer, db.ForeignKey('song.id'))
+  username = db.Column(db.String, db.ForeignKey('user.username'))
+  rating = db.Column(db.Integer)
+  time = db.Column(db.DateTime)
+  __table_args__ = (db.Index('ix_ratings_song_user', 'song_id', 'username'),
+                    db.Index('ix_ratings_user_song', 'username', 'song_id'))
+
+#running sum and count of the ratings submitted for a song
+class SongRating(db.Model):
+  song_id = db.Column(db.Integer, db.ForeignKey('song.id'), primary_key=True)
+  rating_sum = db.Column(db.Integer, default=0, nullable=False)
+  rating_count = db.Column(db.Integer, default=0, nullable=False)
+  rating = db.Column(db.Float, default=0, nullable=False)
+
+#sum of the average ratings of the rated songs in an album, and how many there are
+class AlbumRating(db.Model):
+  album_id = db.Column(db.Integer, db.ForeignKey('album.id'), primary_key=True)
+  rating_sum = db.Column(db.Float, default=0, nullable=False)
+  rating_count = db.Column(db.Integer, default=0, nullable=False)
+  rating = db.Column(db.Float, default=0, nullable=False)
+
+#same rollup as AlbumRating over all the songs of an artist
+class ArtistRating(db.Model):
+  artist_name = db.Column(db.String(80),
+                          db.ForeignKey('artist.username'),
+                          primary_key=True)
+  rating_sum = db.Column(db.Float, default=0, nullable=False)
+  rating_count = db.Column(db.Integer, default=0, nullable=False)
+  rating = db.Column(db.Float, default=0, nullable=False)
+
+#rating indexes used by the leaderboard, highest rating first and ties by key
+db.Index('ix_song_rating_rank', SongRating.rating.desc(), SongRating.song_id)
+db.Index('ix_album_rating_rank', AlbumRating.rating.desc(),
+         AlbumRating.album_id)
+db.Index('ix_artist_rating_rank', ArtistRating.rating.desc(),
+         ArtistRating.artist_name)
+
+#record of songs played by users
+class SongLog(db.Model):
+  id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+  song_id = db.Column(db.Integer, db.ForeignKey('song.id'))
+  username = db.Column(db.String(80), db.ForeignKey('user.username'))
+  time = db.Column(db.DateTime)
+  __table_args__ = (db.Index('ix_song_log_user_time', 'username', 'time'),
+                    db.Index('ix_song_log_user_song', 'username', 'song_id'),
+                    db.Index('ix_song_log_song', 'song_id'),
+                    db.Index('ix_song_log_time', 'time'))
+
+#how often and when last a user played a song, rolled up from SongLog as
+#plays are logged
+class PlayCount(db.Model):
+  username = db.Column(db.String(80),
+                       db.ForeignKey('user.username'),
+                       primary_key=True)
+  song_id = db.Column(db.Integer, db.ForeignKey('song.id'), primary_key=True)
+  play_count = db.Column(db.Integer, default=0, nullable=False)
+  last_played = db.Column(db.DateTime)
+  __table_args__ = (db.Index('ix_play_count_recent', 'username',
+                             'last_played'),
+                    db.Index('ix_play_count_top', 'username', 'play_count',
+                             'last_played'),
+                    db.Index('ix_play_count_song', 'song_id', 'last_played'))
+
+
+#plays of each song and by each user per day, for the SongLog rows compacted
+#into the archive, see compact_song_log_day
+class DailySongPlays(db.Model):
+  song_id = db.Column(db.Integer, db.ForeignKey('song.id'), primary_key=True)
+  day = db.Column(db.Date, primary_key=True)
+  plays = db.Column(db.Integer, default=0, nullable=False)
+  __table_args__ = (db.Index('ix_daily_song_plays_day', 'day'), )
+
+
+class DailyUserPlays(db.Model):
+  username = db.Column(db.String(80),
+                       db.ForeignKey('user.username'),
+                       primary_key=True)
+  day = db.Column(db.Date, primary_key=True)
+  plays = db.Column(db.Integer, default=0, nullable=False)
+
+
+#decayed play counts of songs, albums and artists over each trending window
+#(span), see record_trending. ref is the song or album id or the artist name
+class TrendingScore(db.Model):
+  kind = db.Column(db.String(10), primary_key=True)
+  span = db.Column(db.String(10), primary_key=True)
+  ref = db.Column(db.String(80), primary_key=True)
+  score = db.Column(db.Float, nullable=False)
+  __table_args__ = (db.Index('ix_trending_rank', 'kind', 'span', 'score'), )
+
+
+#the songs most like each song by who played and rated them, the cosine
+#similarity of their columns in the user x song interaction matrix
+class SongSimilarity(db.Model):
+  song_id = db.Column(db.Integer, db.ForeignKey('song.id'), primary_key=True)
+  similar_id = db.Column(db.Integer, db.ForeignKey('song.id'), primary_key=True)
+  score = db.Column(db.Float, nullable=False)
+  __table_args__ = (db.Index('ix_song_similarity_similar', 'similar_id'), )
+
+
+#length of each song's column in that matrix
+class SongVector(db.Model):
+  song_id = db.Column(db.Integer, db.ForeignKey('song.id'), primary_key=True)
+  norm = db.Column(db.Float, nullable=False)
+
+
+#names of songs, albums, playlists and artists, mirrored into the search_fts
+#full text index by the triggers created in init_search_index
+class SearchEntry(db.Model):
+  id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+  kind = db.Column(db.String(10), nullable=False)
+  ref = db.Column(db.String(80), nullable=False)
+  name = db.Column(db.String(255))
+  __table_args__ = (db.UniqueConstraint('kind', 'ref'), )
+
+
+class Admin(db.Model):
+  username = db.Column(db.String(80), primary_key=True)
+  password = db.Column(db.String(80))
+
+#work for the background job runner. payload holds the arguments of the
+#task and the context its result is applied with, as json
+class Job(db.Model):
+  id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+  kind = db.Column(db.String(40), nullable=False)
+  payload = db.Column(db.Text, nullable=False)
+  #queued, running, done or failed
+  status = db.Column(db.String(10), nullable=False, default='queued')
+  attempts = db.Column(db.Integer, nullable=False, default=0)
+  result = db.Column(db.Text)
+  error = db.Column(db.Text)
+  created = db.Column(db.DateTime)
+  run_after = db.Column(db.DateTime)
+  started = db.Column(db.DateTime)
+  finished = db.Column(db.DateTime)
+  __table_args__ = (db.Index('ix_job_status', 'status', 'run_after', 'id'), )
+
+
+#number of migrations applied to the database
+class SchemaVersion(db.Model):
+  version = db.Column(db.Integer, primary_key=True)
+
+#Migrations
+
+#db.create_all() only creates missing tables. Changes to tables that already
+#exist are made by the steps below, each runs once and in order, new steps
+#are appended at the end
+
+MIGRATIONS = []
+
+
+def migration(step):
+  MIGRATIONS.append(step)
+  return step
+
+
+def _columns(conn, table_name):
+  return {column['name'] for column in inspect(conn).get_columns(table_name)}
+
+
+def add_column(conn, column):
+  if column.name in _columns(conn, column.table.name):
+    return
+  preparer = conn.dialect.identifier_preparer
+  conn.execute(
+      text(f'ALTER TABLE {preparer.format_table(column.table)} ADD COLUMN '
+           f'{preparer.format_column(column)} '
+           f'{column.type.compile(conn.dialect)}'))
+
+
+#indexes on columns a later step adds are left to the create_missing_indexes
+#of that step
+def create_missing_indexes(conn):
+  tables = set(inspect(conn).get_table_names())
+  for model_table in db.metadata.sorted_tables:
+    if model_table.name not in tables:
+      continue
+    columns = _columns(conn, model_table.name)
+    for index in model_table.indexes:
+      if all(col.name in columns for col in index.columns):
+        index.create(conn, checkfirst=True)
+
+
+@migration
+def add_ratings_time(conn):
+  add_column(conn, Ratings.__table__.c.time)
+
+
+@migration
+def add_aggregate_rating(conn):
+  #the aggregates only hold derived data, so older copies are recreated
+  #empty and rebuilt from Ratings on startup
+  for model in (SongRating, AlbumRating, ArtistRating):
+    if 'rating' not in _columns(conn, model.__tablename__):
+      model.__table__.drop(conn)
+      model.__table__.create(conn)
+
+
+@migration
+def add_lookup_indexes(conn):
+  create_missing_indexes(conn)
+
+
+@migration
+def add_listing_indexes(conn):
+  create_missing_indexes(conn)
+
+
+@migration
+def add_song_audio_digest(conn):
+  #songs uploaded before the audio store keep their own file and no digest
+  add_column(conn, Song.__table__.c.audio_digest)
+
+
+@migration
+def add_song_metadata(conn):
+  for name in ('duration', 'bitrate', 'checksum'):
+    add_column(conn, Song.__table__.c[name])
+
+
+@migration
+def add_recommendation_indexes(conn):
+  create_missing_indexes(conn)
+
+
+#songs already in playlists keep the order they were added in
+@migration
+def add_playlist_song_position(conn):
+  add_column(conn, playlist_song.c.position)
+  last, positions = {}, []
+  for playlist_id, song_id in conn.execute(
+      db.select(playlist_song.c.playlist_id, playlist_song.c.song_id)):
+    last[playlist_id] = last.get(playlist_id, 0) + PLAYLIST_GAP
+    positions.append({
+        'list': playlist_id,
+        'song': song_id,
+        'position': last[playlist_id]
+    })
+  if positions:
+    conn.execute(
+        update(playlist_song).where(
+            playlist_song.c.playlist_id == bindparam('list'),
+            playlist_song.c.song_id == bindparam('song')).values(
+                position=bindparam('position')), positions)
+  create_missing_indexes(conn)
+
+
+#rows are deleted by song and pictures looked up by name, see delete_catalog
+@migration
+def add_delete_indexes(conn):
+  create_missing_indexes(conn)
+
+
+#old plays are picked by time when they are compacted
+@migration
+def add_song_log_time_index(conn):
+  create_missing_indexes(conn)
+
+
+#files saved before the audio store are looked up by path, see
+#remove_unused_legacy_files
+@migration
+def add_song_path_index(conn):
+  create_missing_indexes(conn)
+
+
+def migrate():
+  with db.engine.begin() as conn:
+    #take the write lock first so workers starting together migrate one
+    #after the other
+    if conn.dialect.name == 'postgresql':
+      conn.execute(text('LOCK TABLE schema_version IN EXCLUSIVE MODE'))
+    else:
+      conn.execute(SchemaVersion.__table__.update().values(
+          version=SchemaVersion.version))
+    current = conn.execute(db.select(SchemaVersion.version)).scalar()
+    if current is None:
+      conn.execute(insert(SchemaVersion).values(version=0))
+      current = 0
+    for step in MIGRATIONS[current:]:
+      step(conn)
+    conn.execute(
+        SchemaVersion.__table__.update().values(version=len(MIGRATIONS)))
+
+
+
+with app.app_context():
+  # db.drop_all()
+  db.create_all()
+  migrate()
+  #  admin=Admin(username="ABC", password="pass")
+  #  db.session.add(admin)
+  #  db.session.commit()
+
+
+
+
+# General utility functions
+
+#rating aggregates are kept in SongRating/AlbumRating/ArtistRating so that
+#reading a rating costs one lookup per entity instead of a scan of Ratings
+
+def _rating_average(agg):
+  return agg.rating_sum / agg.rating_count if agg and agg.rating_count else 0
+
+#load the aggregate rows for the given keys in batches of IN queries
+def _load_aggregates(model, column, keys):
+  keys = list({key for key in keys if key is not None})
+  found = {}
+  for i in range(0, len(keys), 500):
+    for agg in model.query.filter(column.in_(keys[i:i + 500])):
+      found[getattr(agg, column.key)] = agg
+  return found
+
+#recompute the album and artist rollups from the per song aggregates,
+#for the given albums/artists or for all of them when everything is set
+def refresh_rating_rollups(album_ids=(), artist_names=(), everything=False):
+  rollups = ((AlbumRating, AlbumRating.album_id, Song.album_id, album_ids),
+             (ArtistRating, ArtistRating.artist_name, Song.artist_name,
+              artist_names))
+  for model, col, group, keys in rollups:
+    rows = db.session.query(
+        group, func.sum(SongRating.rating_sum * 1.0 / SongRating.rating_count),
+        func.count()).join(Song, Song.id == SongRating.song_id).filter(
+            SongRating.rating_sum > 0, group.isnot(None)).group_by(group)
+    if everything:
+      existing = {getattr(agg, col.key): agg for agg in model.query.all()}
+    else:
+      keys = {key for key in keys if key is not None}
+      if not keys:
+        continue
+      rows = rows.filter(group.in_(keys))
+      existing = _load_aggregates(model, col, keys)
+    for key, total, leng in rows.all():
+      agg = existing.pop(key, None)
+      if agg is None:
+        agg = model(**{col.key: key})
+        db.session.add(agg)
+      agg.rating_sum = total
+      agg.rating_count = leng
+      agg.rating = round(total / leng, 2)
+    for agg in existing.values():
+      db.session.delete(agg)
+
+#apply a new or changed rating of a song to the aggregates
+def record_rating(song, rating, old_rating=None):
+  agg = db.session.get(SongRating, song.id)
+  if agg is None:
+    agg = SongRating(song_id=song.id, rating_sum=0, rating_count=0)
+    db.session.add(agg)
+  if old_rating is None:
+    agg.rating_sum += rating
+    agg.rating_count += 1
+  else:
+    agg.rating_sum += rating - old_rating
+  agg.rating = round(_rating_average(agg), 2)
+  db.session.flush()
+  refresh_rating_rollups([song.album_id], [song.artist_name])
+
+#rebuild every aggregate from the Ratings table
+def rebuild_rating_aggregates():
+  SongRating.query.delete()
+  rows = db.session.query(Ratings.song_id, func.sum(Ratings.rating),
+                          func.count()).join(
+                              Song, Song.id == Ratings.song_id).group_by(
+                                  Ratings.song_id)
+  db.session.add_all(
+      SongRating(song_id=song_id,
+                 rating_sum=total,
+                 rating_count=leng,
+                 rating=round(total / leng, 2)) for song_id, total, leng in rows)
+  db.session.flush()
+  refresh_rating_rollups(everything=True)
+  db.session.commit()
+
+#function to add rating to songs
+def add_rating_songs(songs, sort=True):
+  aggs = _load_aggregates(SongRating, SongRating.song_id,
+                          [song.id for song in songs])
+  for song in songs:
+    song.rating = round(_rating_average(aggs.get(song.id)), 2)
+
+  if sort:
+    songs.sort(key=lambda x: x.rating, reverse=True)
+  return songs
+
+#function to add rating to albums
+def add_rating_album(album, sort=True):
+  aggs = _load_aggregates(AlbumRating, AlbumRating.album_id,
+                          [alb.id for alb in album])
+  for alb in album:
+    alb.rating = round(_rating_average(aggs.get(alb.id)), 2)
+  if sort:
+    album.sort(key=lambda x: x.rating, reverse=True)
+  return album
+
+#function to add rating to artists
+def add_rating_artist(artists, sort=True):
+  aggs = _load_aggregates(ArtistRating, ArtistRating.artist_name,
+                          [art.username for art in artists])
+  for art in artists:
+    art.rating = round(_rating_average(aggs.get(art.username)), 2)
+  if sort:
+    artists.sort(key=lambda x: x.rating, reverse=True)
+  return artists
+
+#highest rated songs, albums and artists. The ranking is read through the
+#rating indexes of the aggregate tables and kept in memory until a write
+#invalidates it, unrated entries pad the list in id order like the old sort
+class Leaderboard:
+
+  def __init__(self, size=50, ttl=30):
+    self.size = size
+    self.ttl = ttl
+    self.ranked = {}
+
+  def _kinds(self):
+    return {
+        'song': (Song, Song.id, SongRating, SongRating.song_id),
+        'album': (Album, Album.id, AlbumRating, AlbumRating.album_id),
+        'artist': (Artist, Artist.username, ArtistRating,
+                   ArtistRating.artist_name)
+    }
+
+  def invalidate(self):
+    self.ranked.clear()
+
+  def _rank(self, kind, size):
+    model, pk, agg, key = self._kinds()[kind]
+    ranked = db.session.query(key, agg.rating).filter(agg.rating > 0).order_by(
+        agg.rating.desc(), key).limit(size).all()
+    if len(ranked) < size:
+      rated = exists().where(key == pk, agg.rating > 0)
+      ranked += [(k, 0) for (k, ) in db.session.query(pk).filter(
+          ~rated).order_by(pk).limit(size - len(ranked))]
+    return ranked
+
+  #top n (key, rating) pairs. fresh reads them again instead of using a
+  #ranking up to ttl seconds old, which only knows this process' writes
+  def ranking(self, kind, n, fresh=False):
+    if n > self.size:
+      return self._rank(kind, n)
+    cached = self.ranked.get(kind)
+    if fresh or cached is None or cached[0] < datetime.now():
+      cached = (datetime.now() + timedelta(seconds=self.ttl),
+                self._rank(kind, self.size))
+      self.ranked[kind] = cached
+    return cached[1][:n]
+
+  #top n entries with their rating attached, like the add_rating helpers
+  def top(self, kind, n, fresh=False):
+    model, pk = self._kinds()[kind][:2]
+    ranked = self.ranking(kind, n, fresh)
+    found = {
+        getattr(obj, pk.key): obj
+        for obj in model.query.filter(pk.in_([k for k, _ in ranked]))
+    }
+    top = []
+    for k, rating in ranked:
+      if k in found:
+        found[k].rating = rating
+        top.append(found[k])
+    return top
+
+
+leaderboard = Leaderboard()
+
+#admin listings and song pickers are paged with keyset cursors. A page is read
+#through an index from just after the last row of the previous page, so a
+#deep page costs the same as the first one. The cursor is that last row's
+#sort key, encoded for the url
+
+LISTING_PAGE_SIZE = 50
+
+
+#kind -> (model, key, {sort: (column, descending)})
+def _listings():
+  return {
+      'song': (Song, Song.id, {
+          'name': (Song.name, False),
+          'newest': (Song.time, True)
+      }),
+      'album': (Album, Album.id, {
+          'name': (Album.name, False),
+          'newest': (Album.time, True)
+      }),
+      'artist': (Artist, Artist.username, {
+          'name': (Artist.username, False),
+          'newest': (Artist.time, True)
+      }),
+      'user': (User, User.username, {
+          'name': (User.username, False),
+          'newest': (User.time, True)
+      })
+  }
+
+
+def listing_sorts(kind):
+  sorts = list(_listings()[kind][2])
+  if kind in leaderboard._kinds():
+    sorts.append('rating')
+  return sorts
+
+
+def encode_cursor(values):
+  values = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+  return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+#values of a cursor for the given columns, ValueError if it is not one
+def decode_cursor(cursor, columns):
+  try:
+    values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+  except (TypeError, UnicodeError, ValueError):
+    raise ValueError('bad cursor') from None
+  if not isinstance(values, list) or len(values) != len(columns):
+    raise ValueError('bad cursor')
+  return [
+      datetime.fromisoformat(value) if value is not None and isinstance(
+          col.type, db.DateTime) else value
+      for col, value in zip(columns, values, strict=True)
+  ]
+
+
+#rows coming after values in an order of (column, descending) pairs. The
+#range on the first column lets the database seek the index to the cursor
+def _after(order, values):
+  later = []
+  for i, ((col, descending),
+          value) in enumerate(zip(order, values, strict=True)):
+    same = [c == v for (c, _), v in zip(order[:i], values[:i], strict=True)]
+    later.append(and_(*same, col < value if descending else col > value))
+  (first, descending), value = order[0], values[0]
+  return and_(first <= value if descending else first >= value, or_(*later))
+
+
+#rated rows by rating through the aggregate's rating index, then the unrated
+#ones by key. The cursor of an unrated row has no rating
+def _rating_page(kind, values, size, options):
+  model, pk, agg, key = leaderboard._kinds()[kind]
+  rows = []
+  if values is None or values[0] is not None:
+    order = [(agg.rating, True), (key, False)]
+    query = db.session.query(model, agg.rating).join(agg, key == pk).filter(
+        agg.rating > 0).options(*options)
+    if values is not None:
+      query = query.filter(_after(order, values))
+    rows = [(obj, [rating, getattr(obj, pk.key)]) for obj, rating in query.
+            order_by(agg.rating.desc(), key).limit(size)]
+    values = None
+  if len(rows) < size:
+    rated = exists().where(key == pk, agg.rating > 0)
+    query = model.query.filter(~rated).options(*options)
+    if values is not None:
+      query = query.filter(pk > values[1])
+    rows += [(obj, [None, getattr(obj, pk.key)])
+             for obj in query.order_by(pk).limit(size - len(rows))]
+  return rows
+
+
+#one page of a listing and the cursor of the next page (None on the last
+#one). Ratings are attached to songs, albums and artists
+def listing_page(kind, sort='name', cursor=None, size=LISTING_PAGE_SIZE,
+                 options=()):
+  model, pk, sorts = _listings()[kind]
+  if sort not in listing_sorts(kind):
+    raise ValueError('unknown sort')
+  if sort == 'rating':
+    agg = leaderboard._kinds()[kind][2]
+    values = decode_cursor(cursor, [agg.rating, pk]) if cursor else None
+    rows = _rating_page(kind, values, size + 1, options)
+  else:
+    col, descending = sorts[sort]
+    order = [(col, descending), (pk, descending)]
+    query = model.query.options(*options)
+    if cursor:
+      query = query.filter(_after(order, decode_cursor(cursor, [col, pk])))
+    query = query.order_by(*[c.desc() if d else c for c, d in order])
+    rows = [(obj, [getattr(obj, col.key), getattr(obj, pk.key)])
+            for obj in query.limit(size + 1)]
+  next_cursor = encode_cursor(rows[size - 1][1]) if len(rows) > size else None
+  page = [obj for obj, _ in rows[:size]]
+  if kind == 'song':
+    add_rating_songs(page, sort=False)
+  elif kind == 'album':
+    add_rating_album(page, sort=False)
+  elif kind == 'artist':
+    add_rating_artist(page, sort=False)
+  return page, next_cursor
+
+
+#listing page for the sort and after (cursor) arguments of the request
+def requested_page(kind, default_sort, options=()):
+  sort = request.args.get('sort', default_sort)
+  try:
+    rows, next_cursor = listing_page(kind,
+                                     sort,
+                                     request.args.get('after'),
+                                     options=options)
+  except ValueError:
+    abort(400)
+  return {
+      'rows': rows,
+      'sort': sort,
+      'sorts': listing_sorts(kind),
+      'next_cursor': next_cursor
+  }
+
+
+#read API. Albums, playlists and artist profiles are read as plain dicts
+#with projection queries joined to the rating aggregates, a fixed number of
+#queries however many songs there are. Songs come highest rated first like
+#add_rating_songs sorts them, except in playlists which keep their order
+
+
+def _song_select():
+  return db.select(Song.id, Song.name, Song.artist_name, Song.album_id,
+                   Song.song_image, Song.duration,
+                   func.coalesce(SongRating.rating, 0).label('rating')).outerjoin(
+                       SongRating, SongRating.song_id == Song.id)
+
+
+def _read_songs(statement, sort=True):
+  songs = [dict(row._mapping) for row in db.session.execute(statement)]
+  if sort:
+    songs.sort(key=lambda song: song['rating'], reverse=True)
+  return songs
+
+
+def _read_one(statement):
+  row = db.session.execute(statement).first()
+  return dict(row._mapping) if row else None
+
+
+def read_album(album_id):
+  album = _read_one(
+      db.select(Album.id, Album.name, Album.artist_name, Album.album_picture,
+                func.coalesce(AlbumRating.rating, 0).label('rating')).outerjoin(
+                    AlbumRating,
+                    AlbumRating.album_id == Album.id).where(Album.id == album_id))
+  if album is not None:
+    album['songs'] = _read_songs(_song_select().where(
+        Song.album_id == album['id']).order_by(Song.id))
+  return album
+
+
+def read_playlist(playlist_id):
+  playlist = _read_one(
+      db.select(Playlist.id, Playlist.name, Playlist.username,
+                Playlist.playlist_picture).where(Playlist.id == playlist_id))
+  if playlist is not None:
+    playlist['songs'] = _read_songs(
+        _song_select().join(playlist_song,
+                            playlist_song.c.song_id == Song.id).where(
+                                playlist_song.c.playlist_id ==
+                                playlist['id']).order_by(
+                                    playlist_song.c.position),
+        sort=False)
+  return playlist
+
+
+def read_artist(username):
+  artist = _read_one(
+      db.select(Artist.username, Artist.profile_picture,
+                func.coalesce(ArtistRating.rating, 0).label('rating')).outerjoin(
+                    ArtistRating, ArtistRating.artist_name ==
+                    Artist.username).where(Artist.username == username))
+  if artist is None:
+    return None
+  albums = db.session.execute(
+      db.select(Album.id, Album.name, Album.album_picture,
+                func.coalesce(AlbumRating.rating, 0).label('rating')).outerjoin(
+                    AlbumRating, AlbumRating.album_id == Album.id).where(
+                        Album.artist_name == username).order_by(Album.id))
+  artist['albums'] = sorted([dict(row._mapping) for row in albums],
+                            key=lambda album: album['rating'],
+                            reverse=True)
+  artist['songs'] = _read_songs(_song_select().where(
+      Song.artist_name == username).order_by(Song.id))
+  artist['playlists'] = read_playlists(username)
+  return artist
+
+
+def read_playlists(username):
+  return [
+      dict(row._mapping) for row in db.session.execute(
+          db.select(Playlist.id, Playlist.name, Playlist.playlist_picture).where(
+              Playlist.username == username).order_by(Playlist.id))
+  ]
+
+
+#json response carrying an ETag of its body. Clients may keep it but have
+#to revalidate, and get a 304 when it has not changed
+def cached_json(data):
+  response = jsonify(data)
+  response.add_etag()
+  response.cache_control.public = True
+  response.cache_control.no_cache = True
+  return response.make_conditional(request)
+
+#ordered playlists. Songs appended to a playlist are given positions
+#PLAYLIST_GAP apart, and a song put between two others takes the middle of
+#their positions. An edit reads the neighbours it needs through the
+#(playlist_id, position) index and writes only the rows it changes, however
+#long the playlist is. When two neighbours have no room left between them
+#the playlist is numbered again, after at least 16 songs put in one spot
+
+
+def _playlist_position(playlist_id, song_id):
+  return db.session.execute(
+      db.select(playlist_song.c.position).where(
+          playlist_song.c.playlist_id == playlist_id,
+          playlist_song.c.song_id == song_id)).scalar()
+
+
+#first position of the playlist after the given one (from the start when it
+#is None), None past the end
+def _next_position(playlist_id, position):
+  stmt = db.select(func.min(playlist_song.c.position)).where(
+      playlist_song.c.playlist_id == playlist_id)
+  if position is not None:
+    stmt = stmt.where(playlist_song.c.position > position)
+  return db.session.execute(stmt).scalar()
+
+
+def renumber_playlist(playlist_id):
+  song_ids = db.session.execute(
+      db.select(playlist_song.c.song_id).where(
+          playlist_song.c.playlist_id == playlist_id).order_by(
+              playlist_song.c.position)).scalars().all()
+  db.session.execute(
+      update(playlist_song).where(
+          playlist_song.c.playlist_id == playlist_id,
+          playlist_song.c.song_id == bindparam('song')).values(
+              position=bindparam('position')),
+      [{
+          'song': song_id,
+          'position': (x + 1) * PLAYLIST_GAP
+      } for x, song_id in enumerate(song_ids)])
+
+
+#position for a song going right after the song after, at the start when
+#after is None
+def _slot(playlist_id, after):
+  before = None
+  if after is not None:
+    before = _playlist_position(playlist_id, after)
+    if before is None:
+      raise ValueError(f'song {after} is not in the playlist')
+  following = _next_position(playlist_id, before)
+  if following is None:
+    return PLAYLIST_GAP if before is None else before + PLAYLIST_GAP
+  if before is None:
+    return following - PLAYLIST_GAP
+  if following - before > 1:
+    return (before + following) // 2
+  renumber_playlist(playlist_id)
+  return _slot(playlist_id, after)
+
+
+def _song_id(value):
+  if not isinstance(value, int) or isinstance(value, bool):
+    raise ValueError(f'{value!r} is not a song id')
+  return value
+
+
+#add the songs to the end of a playlist in the order given, leaving out the
+#ones it has and the ones that do not exist
+def append_playlist_songs(playlist_id, song_ids):
+  song_ids = list(dict.fromkeys(_song_id(song_id) for song_id in song_ids))
+  if not song_ids:
+    return 0
+  present = set(
+      db.session.execute(
+          db.select(playlist_song.c.song_id).where(
+              playlist_song.c.playlist_id == playlist_id,
+              playlist_song.c.song_id.in_(song_ids))).scalars())
+  known = set(
+      db.session.execute(
+          db.select(Song.id).where(Song.id.in_(song_ids))).scalars())
+  song_ids = [
+      song_id for song_id in song_ids
+      if song_id in known and song_id not in present
+  ]
+  if not song_ids:
+    return 0
+  last = db.session.execute(
+      db.select(func.max(playlist_song.c.position)).where(
+          playlist_song.c.playlist_id == playlist_id)).scalar() or 0
+  db.session.execute(insert(playlist_song), [{
+      'playlist_id': playlist_id,
+      'song_id': song_id,
+      'position': last + (x + 1) * PLAYLIST_GAP
+  } for x, song_id in enumerate(song_ids)])
+  return len(song_ids)
+
+
+def remove_playlist_songs(playlist_id, song_ids):
+  return db.session.execute(
+      delete(playlist_song).where(
+          playlist_song.c.playlist_id == playlist_id,
+          playlist_song.c.song_id.in_([_song_id(song_id)
+                                       for song_id in song_ids]))).rowcount
+
+
+#put a song right after another one of the playlist (at the start when after
+#is None). A song not in the playlist is added
+def place_playlist_song(playlist_id, song_id, after):
+  song_id = _song_id(song_id)
+  if after is not None:
+    after = _song_id(after)
+  if after == song_id:
+    raise ValueError(f'song {song_id} can not follow itself')
+  if db.session.get(Song, song_id) is None:
+    raise ValueError(f'song {song_id} does not exist')
+  remove_playlist_songs(playlist_id, [song_id])
+  db.session.execute(
+      insert(playlist_song).values(playlist_id=playlist_id,
+                                   song_id=song_id,
+                                   position=_slot(playlist_id, after)))
+
+
+#apply a list of operations to a playlist, in order:
+#  {"op": "add", "song_id": 5, "after": 3}   (after omitted: at the end,
+#                                              null: at the start)
+#  {"op": "append", "song_ids": [5, 6, 7]}
+#  {"op": "move", "song_id": 5, "after": null}   (after as for add)
+#  {"op": "remove", "song_id": 5}
+#ValueError when one of them can not be applied
+def edit_playlist_songs(playlist_id, ops):
+  if not isinstance(ops, list):
+    raise ValueError('ops has to be a list')
+  for op in ops:
+    kind = op.get('op') if isinstance(op, dict) else None
+    if kind == 'append':
+      if not isinstance(op.get('song_ids', []), list):
+        raise ValueError('song_ids has to be a list')
+      append_playlist_songs(playlist_id, op.get('song_ids', []))
+    elif kind in ('add', 'move'):
+      song_id = _song_id(op.get('song_id'))
+      present = _playlist_position(playlist_id, song_id) is not None
+      if kind == 'add' and present:
+        raise ValueError(f'song {song_id} is in the playlist')
+      if kind == 'move' and not present:
+        raise ValueError(f'song {song_id} is not in the playlist')
+      if 'after' in op:
+        place_playlist_song(playlist_id, song_id, op['after'])
+      else:
+        remove_playlist_songs(playlist_id, [song_id])
+        if not append_playlist_songs(playlist_id, [song_id]):
+          raise ValueError(f'song {song_id} does not exist')
+    elif kind == 'remove':
+      if not remove_playlist_songs(playlist_id, [op.get('song_id')]):
+        raise ValueError(f'song {op.get("song_id")} is not in the playlist')
+    else:
+      raise ValueError(f'unknown operation {op!r}')
+
+
+#full text search. SearchEntry rows are kept in step with the catalog from
+#the session's after_flush hook, so every create, edit and delete path
+#(including ORM cascades) updates the index in the same transaction
+
+SEARCH_PAGE_SIZE = 12
+
+
+def _search_kinds():
+  return {
+      'song': (Song, Song.id, 'name'),
+      'album': (Album, Album.id, 'name'),
+      'playlist': (Playlist, Playlist.id, 'name'),
+      'artist': (Artist, Artist.username, 'username')
+  }
+
+
+def _search_kind_of(obj):
+  for kind, (model, _, _) in _search_kinds().items():
+    if isinstance(obj, model):
+      return kind
+  return None
+
+
+#create the fts5 table and the triggers feeding it from search_entry
+def init_search_index():
+  if db.engine.dialect.name != 'sqlite':
+    return
+  with db.engine.begin() as conn:
+    conn.execute(
+        text("CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5("
+             "name, content='search_entry', content_rowid='id', "
+             "prefix='2 3')"))
+    conn.execute(
+        text("CREATE TRIGGER IF NOT EXISTS search_entry_ai AFTER INSERT ON "
+             "search_entry BEGIN INSERT INTO search_fts(rowid, name) "
+             "VALUES (new.id, new.name); END"))
+    conn.execute(
+        text("CREATE TRIGGER IF NOT EXISTS search_entry_ad AFTER DELETE ON "
+             "search_entry BEGIN INSERT INTO search_fts(search_fts, rowid, "
+             "name) VALUES ('delete', old.id, old.name); END"))
+    conn.execute(
+        text("CREATE TRIGGER IF NOT EXISTS search_entry_au AFTER UPDATE ON "
+             "search_entry BEGIN INSERT INTO search_fts(search_fts, rowid, "
+             "name) VALUES ('delete', old.id, old.name); "
+             "INSERT INTO search_fts(rowid, name) VALUES (new.id, new.name); "
+             "END"))
+
+
+def _write_search_entries(conn, removed, added):
+  table = SearchEntry.__table__
+  for kind, ref in removed:
+    conn.execute(
+        delete(table).where(table.c.kind == kind, table.c.ref == str(ref)))
+  if added:
+    conn.execute(insert(table), [{
+        'kind': kind,
+        'ref': str(ref),
+        'name': name
+    } for kind, ref, name in added])
+
+
+@event.listens_for(db.session, 'after_flush')
+def sync_search_index(session, _flush_context):
+  removed, added = [], []
+  for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+    kind = _search_kind_of(obj)
+    if kind is None:
+      continue
+    model, pk, field = _search_kinds()[kind]
+    ref = getattr(obj, pk.key)
+    removed.append((kind, ref))
+    if obj not in session.deleted:
+      added.append((kind, ref, getattr(obj, field)))
+  if removed:
+    _write_search_entries(session.connection(), removed, added)
+
+
+#rebuild the whole index from the catalog tables
+def rebuild_search_index():
+  with db.engine.begin() as conn:
+    conn.execute(delete(SearchEntry.__table__))
+    for kind, (model, pk, field) in _search_kinds().items():
+      rows = conn.execute(db.select(pk, getattr(model, field))).all()
+      _write_search_entries(conn, [], [(kind, ref, name) for ref, name in rows])
+    if db.engine.dialect.name == 'sqlite':
+      conn.execute(text("INSERT INTO search_fts(search_fts) VALUES ('rebuild')"))
+
+
+#turn free text into an fts5 query matching every word as a prefix
+def _search_query(term):
+  return ' '.join(f'"{word}"*' for word in re.findall(r'\w+', term.lower()))
+
+
+#search the catalog, returning the matches of each kind for one page in
+#relevance order and the total number of matches of each kind
+def search_catalog(term, page=1, per_page=SEARCH_PAGE_SIZE):
+  kinds = _search_kinds()
+  hits = {kind: [] for kind in kinds}
+  totals = dict.fromkeys(kinds, 0)
+  query = _search_query(term)
+  if not query:
+    return hits, totals
+  entry = SearchEntry.__table__
+  if db.engine.dialect.name == 'sqlite':
+    fts = table('search_fts', column('rowid'), column('rank'))
+    matches = db.select(entry.c.kind, entry.c.ref).join_from(
+        entry, fts, fts.c.rowid == entry.c.id).where(
+            text('search_fts MATCH :query').bindparams(query=query))
+    ranked = matches.order_by(fts.c.rank)
+  else:
+    matches = db.select(entry.c.kind, entry.c.ref).where(
+        entry.c.name.ilike(f'%{term}%'))
+    ranked = matches.order_by(entry.c.name)
+  found = matches.subquery()
+  counts = db.select(found.c.kind, func.count()).group_by(found.c.kind)
+  for kind, count in db.session.execute(counts):
+    totals[kind] = count
+  for kind, (model, pk, _) in kinds.items():
+    if not totals[kind]:
+      continue
+    refs = [
+        ref for _, ref in db.session.execute(
+            ranked.where(entry.c.kind == kind).limit(per_page).offset(
+                (page - 1) * per_page))
+    ]
+    if pk.type.python_type is int:
+      refs = [int(ref) for ref in refs]
+    objs = {getattr(obj, pk.key): obj for obj in model.query.filter(pk.in_(refs))}
+    hits[kind] = [objs[ref] for ref in refs if ref in objs]
+  return hits, totals
+
+
+#type-ahead suggestions. Every word of the song, album, playlist and artist
+#names is kept in memory in a sorted list that a prefix is looked up in with
+#bisect, so suggesting never touches the database. Matches come most played
+#first: a song by its plays, an album or artist by the plays of its songs and
+#a playlist by those of the songs in it. Catalog changes and plays are
+#applied to the index of the process committing them once they commit, and
+#every AUTOCOMPLETE_REBUILD_SECONDS the index is rebuilt from the database in
+#the background, which is when other processes' changes show up
+
+AUTOCOMPLETE_LIMIT = 20
+#a prefix of more entries than this is answered from the cached top
+#AUTOCOMPLETE_DEPTH of its matches, kept in order as plays come in. Further
+#words of a query narrow down that top, not all the matches
+AUTOCOMPLETE_SCAN = 500
+AUTOCOMPLETE_DEPTH = 200
+
+
+def _name_words(name):
+  return tuple(sorted(set(re.findall(r'\w+', (name or '').lower()))))
+
+
+class AutocompleteIndex:
+
+  def __init__(self, rebuild_seconds):
+    self.rebuild_seconds = rebuild_seconds
+    self.lock = threading.Lock()
+    #sorted distinct words, and the entries ((kind, ref)) having each
+    self.words = []
+    self.postings = {}
+    #(kind, ref) -> [name, weight, words, parents]
+    self.entries = {}
+    #prefix -> top entries of a broad prefix
+    self.tops = {}
+    self.built = None
+    #changes committed while a rebuild reads the database, replayed on the
+    #new index. Plays in there may be counted twice
+    self.journal = None
+
+  def _rank(self, key):
+    entry = self.entries[key]
+    return (-entry[1], entry[0])
+
+  def _forget(self, words):
+    for word in words:
+      for end in range(1, len(word) + 1):
+        self.tops.pop(word[:end], None)
+
+  def _drop(self, key):
+    entry = self.entries.pop(key, None)
+    if entry is None:
+      return None
+    for word in entry[2]:
+      keys = self.postings[word]
+      keys.discard(key)
+      if not keys:
+        del self.postings[word]
+        del self.words[bisect.bisect_left(self.words, word)]
+    self._forget(entry[2])
+    return entry
+
+  def _put(self, key, name, weight=None, parents=()):
+    old = self._drop(key)
+    if weight is None:
+      weight = old[1] if old else 0
+    words = _name_words(name)
+    self.entries[key] = [name, weight, words, parents]
+    for word in words:
+      if word not in self.postings:
+        self.postings[word] = set()
+        bisect.insort(self.words, word)
+      self.postings[word].add(key)
+    self._forget(words)
+
+  def _add_weight(self, key, weight):
+    entry = self.entries.get(key)
+    if entry is None:
+      return
+    entry[1] += weight
+    rank = self._rank(key)
+    for word in entry[2]:
+      for end in range(1, len(word) + 1):
+        top = self.tops.get(word[:end])
+        if top is None:
+          continue
+        if key in top:
+          top.sort(key=self._rank)
+        elif rank < self._rank(top[-1]):
+          top[-1] = key
+          top.sort(key=self._rank)
+
+  def _apply(self, changes):
+    for change in changes:
+      if change[0] == 'put':
+        self._put(*change[1:])
+      elif change[0] == 'drop':
+        self._drop(change[1])
+      else:
+        for song_id, plays in change[1].items():
+          key = ('song', song_id)
+          entry = self.entries.get(key)
+          if entry is None:
+            continue
+          for owner in (key, ) + entry[3]:
+            self._add_weight(owner, plays)
+
+  #apply committed changes: ('put', key, name, weight, parents),
+  #('drop', key) and ('plays', {song_id: plays})
+  def apply(self, changes):
+    with self.lock:
+      self._apply(changes)
+      if self.journal is not None:
+        self.journal.extend(changes)
+
+  #entries of the words starting with prefix, best first. Broad prefixes are
+  #cut to their top and cached
+  def _matches(self, prefix):
+    if prefix in self.tops:
+      return self.tops[prefix]
+    found = set()
+    at = bisect.bisect_left(self.words, prefix)
+    while at < len(self.words) and self.words[at].startswith(prefix):
+      found.update(self.postings[self.words[at]])
+      at += 1
+    found = sorted(found, key=self._rank)
+    if len(found) > AUTOCOMPLETE_SCAN:
+      found = self.tops[prefix] = found[:AUTOCOMPLETE_DEPTH]
+    return found
+
+  #up to limit (kind, ref, name) entries every word of the query starts a
+  #word of. The longest word is looked up, the others filter its matches
+  def suggest(self, query, limit=8):
+    words = re.findall(r'\w+', query.lower())
+    if not words:
+      return []
+    self.rebuild_later()
+    longest = max(words, key=len)
+    words.remove(longest)
+    found = []
+    with self.lock:
+      for key in self._matches(longest):
+        entry = self.entries[key]
+        if all(
+            any(own.startswith(word) for own in entry[2]) for word in words):
+          found.append((key[0], key[1], entry[0]))
+          if len(found) == limit:
+            break
+    return found
+
+  #read every entry and its weight from the database and swap them in
+  def rebuild(self):
+    with self.lock:
+      if self.journal is None:
+        self.journal = []
+    try:
+      fresh = AutocompleteIndex(self.rebuild_seconds)
+      for key, name, weight, parents in _autocomplete_entries():
+        fresh._put(key, name, weight, parents)
+    except Exception:
+      with self.lock:
+        self.journal = None
+      raise
+    with self.lock:
+      fresh._apply(self.journal)
+      self.words, self.postings = fresh.words, fresh.postings
+      self.entries, self.tops = fresh.entries, fresh.tops
+      self.journal = None
+      self.built = time.monotonic()
+
+  def _rebuild_in_background(self):
+    with app.app_context():
+      try:
+        self.rebuild()
+      except Exception:
+        app.logger.exception('could not rebuild the autocomplete index')
+
+  #start a background rebuild when the index is older than rebuild_seconds
+  def rebuild_later(self):
+    if self.built is None or self.journal is not None or (
+        time.monotonic() - self.built < self.rebuild_seconds):
+      return
+    with self.lock:
+      if self.journal is not None:
+        return
+      #taken now so no other request starts one too
+      self.journal = []
+    threading.Thread(target=self._rebuild_in_background,
+                     name='autocomplete',
+                     daemon=True).start()
+
+
+#(key, name, weight, parents) of every entry of the catalog
+def _autocomplete_entries():
+  plays = dict(
+      db.session.execute(
+          db.select(PlayCount.song_id,
+                    func.sum(PlayCount.play_count)).group_by(
+                        PlayCount.song_id)).all())
+  albums, artists, playlists = {}, {}, {}
+  songs = db.session.execute(
+      db.select(Song.id, Song.name, Song.album_id, Song.artist_name)).all()
+  for song_id, name, album_id, artist_name in songs:
+    weight = plays.get(song_id, 0)
+    albums[album_id] = albums.get(album_id, 0) + weight
+    artists[artist_name] = artists.get(artist_name, 0) + weight
+    yield (('song', song_id), name, weight, _song_parents(album_id,
+                                                          artist_name))
+  for album_id, name in db.session.execute(db.select(Album.id, Album.name)):
+    yield ('album', album_id), name, albums.get(album_id, 0), ()
+  for (username, ) in db.session.execute(db.select(Artist.username)):
+    yield ('artist', username), username, artists.get(username, 0), ()
+  for playlist_id, song_id in db.session.execute(
+      db.select(playlist_song.c.playlist_id, playlist_song.c.song_id)):
+    playlists[playlist_id] = playlists.get(playlist_id, 0) + plays.get(
+        song_id, 0)
+  for playlist_id, name in db.session.execute(
+      db.select(Playlist.id, Playlist.name)):
+    yield ('playlist', playlist_id), name, playlists.get(playlist_id, 0), ()
+
+
+#the album and artist a song's plays count towards
+def _song_parents(album_id, artist_name):
+  return tuple(key for key in (('album', album_id), ('artist', artist_name))
+               if key[1] is not None)
+
+
+autocomplete = AutocompleteIndex(app.config["AUTOCOMPLETE_REBUILD_SECONDS"])
+
+
+@event.listens_for(db.session, 'after_flush')
+def queue_autocomplete_changes(session, _flush_context):
+  changes = session.info.setdefault('autocomplete', [])
+  for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+    kind = _search_kind_of(obj)
+    if kind is None:
+      continue
+    model, pk, field = _search_kinds()[kind]
+    key = (kind, getattr(obj, pk.key))
+    if obj in session.deleted:
+      changes.append(('drop', key))
+    else:
+      parents = _song_parents(obj.album_id,
+                              obj.artist_name) if kind == 'song' else ()
+      changes.append(('put', key, getattr(obj, field), None, parents))
+
+
+@event.listens_for(db.session, 'after_commit')
+def _apply_autocomplete_changes(session):
+  changes = session.info.pop('autocomplete', None)
+  plays = session.info.pop('song_plays', None)
+  if plays:
+    changes = (changes or []) + [('plays', plays)]
+  if changes:
+    autocomplete.apply(changes)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_autocomplete_changes(session):
+  session.info.pop('autocomplete', None)
+  session.info.pop('song_plays', None)
+
+
+#artwork. An uploaded picture is stored once under the hash of its content,
+#and a background thread adds a square thumbnail and medium rendition when
+#Pillow is installed, then points the rows at the medium one. Hashed names
+#never change content, so they are cached for ARTWORK_MAX_AGE
+
+ARTWORK_DIR = os.path.join(app.root_path, 'static', 'artwork')
+ARTWORK_SIZES = {'thumb': 160, 'medium': 480}
+ARTWORK_TYPES = ('.png', '.jpg', '.jpeg', '.gif', '.webp')
+_artwork_pool = ThreadPoolExecutor(max_workers=2,
+                                   thread_name_prefix='artwork')
+
+
+#columns showing a picture, updated together when its renditions are ready
+def _artwork_columns():
+  return {
+      'album': [Album.album_picture, Song.song_image],
+      'playlist': [Playlist.playlist_picture],
+      'profile': [User.profile_picture, Artist.profile_picture]
+  }
+
+
+def _write_atomic(path, write):
+  with tempfile.NamedTemporaryFile(dir=ARTWORK_DIR, delete=False) as f:
+    write(f)
+  os.replace(f.name, path)
+
+
+def _rendition_type():
+  return ('WEBP', '.webp') if features.check('webp') else ('JPEG', '.jpg')
+
+
+def _rendition(name, size):
+  return f'{name.split(".")[0]}-{size}{_rendition_type()[1]}'
+
+
+#store the bytes of a picture, returning its reference (the medium rendition
+#when the same picture was stored before)
+def store_artwork(data, filename):
+  ext = os.path.splitext(filename or '')[1].lower()
+  name = hashlib.sha256(data).hexdigest()[:32] + (ext if ext in ARTWORK_TYPES
+                                                  else '.png')
+  os.makedirs(ARTWORK_DIR, exist_ok=True)
+  if not os.path.exists(os.path.join(ARTWORK_DIR, name)):
+    _write_atomic(os.path.join(ARTWORK_DIR, name), lambda f: f.write(data))
+  else:
+    #keeps the file from being removed as unused, see remove_unused_artwork
+    os.utime(os.path.join(ARTWORK_DIR, name))
+  if Image is not None and os.path.exists(
+      os.path.join(ARTWORK_DIR, _rendition(name, 'medium'))):
+    return '../artwork/' + _rendition(name, 'medium')
+  return '../artwork/' + name
+
+
+#make the renditions of a stored picture, returning the medium one's
+#reference. None when there is nothing to do
+def render_artwork(picture):
+  name = picture.rsplit('/', 1)[-1]
+  if Image is None or not picture.startswith('../artwork/') or '-' in name:
+    return None
+  fmt = _rendition_type()[0]
+  with Image.open(os.path.join(ARTWORK_DIR, name)) as img:
+    img = ImageOps.exif_transpose(img)
+    img = img.convert('RGBA' if fmt == 'WEBP' and 'A' in img.getbands()
+                      else 'RGB')
+    for size, pixels in ARTWORK_SIZES.items():
+      path = os.path.join(ARTWORK_DIR, _rendition(name, size))
+      if not os.path.exists(path):
+        rendition = ImageOps.fit(img, (pixels, pixels), Image.LANCZOS)
+        _write_atomic(path,
+                      lambda f, rendition=rendition: rendition.save(
+                          f, fmt, quality=80))
+  return '../artwork/' + _rendition(name, 'medium')
+
+
+#point every row showing the picture at its medium rendition
+def use_rendition(picture, kind):
+  medium = render_artwork(picture)
+  if medium is None:
+    return
+  for col in _artwork_columns()[kind]:
+    db.session.execute(
+        update(col.class_).where(col == picture).values({col.key: medium}))
+  db.session.commit()
+  invalidate_shelves()
+
+
+def _render_in_background(picture, kind):
+  with app.app_context():
+    try:
+      use_rendition(picture, kind)
+    except Exception:
+      app.logger.exception('could not render %s', picture)
+
+
+#called once the rows pointing at picture are committed
+def render_artwork_later(picture, kind):
+  if Image is not None:
+    _artwork_pool.submit(_render_in_background, picture, kind)
+
+
+#url of a picture at a size, thumb or medium. Pictures without renditions
+#are shown as they are
+@app.template_filter('artwork')
+def artwork_url(picture, size='medium'):
+  if not picture:
+    return picture
+  if picture.startswith('../artwork/'):
+    name = picture[len('../artwork/'):]
+    if name.split('.')[0].endswith('-medium'):
+      name = name.replace('-medium.', f'-{size}.')
+    return url_for('artwork', name=name)
+  if picture.startswith('../static/'):
+    return url_for('static', filename=picture[len('../static/'):])
+  return picture
+
+
+#audio. An uploaded song is stored once under the sha256 of its content in
+#AUDIO_DIR, and AudioBlob counts the songs using each file. Uploads are
+#hashed while they are spooled to a temporary file next to the store, so
+#storing one is a rename. A song row and its reference to the file are
+#committed together, and the file is removed when its last song is deleted
+
+AUDIO_DIR = os.path.join(app.root_path, 'static', 'audio', 'blobs')
+AUDIO_TYPES = ('.mp3', )
+
+
+#file upload written to a temporary file in AUDIO_DIR and hashed as it
+#arrives
+class SpooledUpload:
+
+  def __init__(self):
+    os.makedirs(AUDIO_DIR, exist_ok=True)
+    with contextlib.ExitStack() as stack:
+      self.file = stack.enter_context(
+          tempfile.NamedTemporaryFile(dir=AUDIO_DIR,
+                                      prefix='.upload-',
+                                      delete=False))
+      stack.callback(self._remove)
+      self.hash = hashlib.sha256()
+      self.size = 0
+      #closed and removed by discard from here on
+      self.stack = stack.pop_all()
+
+  def write(self, data):
+    self.hash.update(data)
+    self.size += len(data)
+    return self.file.write(data)
+
+  def __getattr__(self, name):
+    return getattr(self.file, name)
+
+  def _remove(self):
+    self.file.close()
+    if os.path.exists(self.file.name):
+      os.remove(self.file.name)
+
+  #close and remove the temporary file unless it was moved into the store
+  def discard(self):
+    self.stack.close()
+
+
+#audio uploads are parsed straight into a SpooledUpload instead of werkzeug's
+#temporary file, other uploads are left to werkzeug
+class UploadRequest(Request):
+
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.spooled_uploads = []
+
+  def _get_file_stream(self, total_content_length, content_type,
+                       filename=None, content_length=None):
+    if (os.path.splitext(filename or '')[1].lower() not in AUDIO_TYPES
+        and not (content_type or '').startswith('audio/')):
+      return super()._get_file_stream(total_content_length, content_type,
+                                      filename, content_length)
+    upload = SpooledUpload()
+    self.spooled_uploads.append(upload)
+    return upload
+
+
+app.request_class = UploadRequest
+
+
+@app.teardown_request
+def discard_uploads(_exc):
+  for upload in request.spooled_uploads:
+    upload.discard()
+
+
+def _audio_file(digest):
+  return os.path.join(AUDIO_DIR, digest[:2], digest + '.mp3')
+
+
+#Song.path of a stored file
+def audio_reference(digest):
+  return f'../static/audio/blobs/{digest[:2]}/{digest}.mp3'
+
+
+#add a reference to an uploaded file and return its digest. Runs in the
+#transaction adding the song, the file is moved into the store once that
+#commits if it is not there by then: removing the last reference
+#concurrently either commits first, file and all, or waits for the upserted
+#AudioBlob row and finds it used. When the transaction rolls back the upload
+#is left to discard_uploads
+def store_audio(upload):
+  spooled = upload.stream
+  if not isinstance(spooled, SpooledUpload):
+    spooled = SpooledUpload()
+    request.spooled_uploads.append(spooled)
+    shutil.copyfileobj(upload.stream, spooled)
+  spooled.file.close()
+  digest = spooled.hash.hexdigest()
+  stmt = upsert(AudioBlob).values(digest=digest,
+                                  size=spooled.size,
+                                  ref_count=1)
+  db.session.execute(
+      stmt.on_conflict_do_update(
+          index_elements=['digest'],
+          set_={'ref_count': AudioBlob.ref_count + 1}))
+  path = _audio_file(digest)
+  if not os.path.exists(path):
+    db.session.info.setdefault('stored_audio', {})[path] = spooled.file.name
+  return digest
+
+
+@event.listens_for(db.session, 'after_commit')
+def _move_stored_audio(session):
+  for path, name in session.info.pop('stored_audio', {}).items():
+    try:
+      if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(name, path)
+    except OSError:
+      app.logger.exception('could not move %s into the store', name)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_stored_audio(session):
+  session.info.pop('stored_audio', None)
+
+
+#deleted songs (including ORM cascades) give up their reference in the
+#transaction deleting them, the files are looked at once that commits
+@event.listens_for(db.session, 'after_flush')
+def release_audio(session, _flush_context):
+  released = {}
+  for obj in session.deleted:
+    if isinstance(obj, Song) and obj.audio_digest:
+      released[obj.audio_digest] = released.get(obj.audio_digest, 0) + 1
+    elif isinstance(obj, Song) and obj.path:
+      session.info.setdefault('released_files', set()).add(obj.path)
+  for digest, count in released.items():
+    session.connection().execute(
+        update(AudioBlob).where(AudioBlob.digest == digest).values(
+            ref_count=AudioBlob.ref_count - count))
+  if released:
+    session.info.setdefault('released_audio', set()).update(released)
+
+
+#delete the files of the given digests that no song uses any more. Each file
+#is removed before the deletion of its row commits, so an upload adding a
+#reference meanwhile waits for the row and then puts the file back
+def remove_unused_audio(digests):
+  table = AudioBlob.__table__
+  for digest in digests:
+    with db.engine.begin() as conn:
+      gone = conn.execute(
+          delete(table).where(table.c.digest == digest,
+                              table.c.ref_count <= 0)).rowcount
+      if gone and os.path.exists(_audio_file(digest)):
+        os.remove(_audio_file(digest))
+
+
+#play logging
+
+#INSERT .. ON CONFLICT statement for the dialect in use
+def upsert(model):
+  if db.engine.dialect.name == 'postgresql':
+    return postgresql.insert(model)
+  return sqlite.insert(model)
+
+
+#write a batch of play events ({song_id, username, time}) to SongLog and
+#fold them into the per user PlayCount rollup. Plays of songs that do not
+#exist, or were deleted while the play was queued, are dropped
+def record_plays(events):
+  songs = set(
+      db.session.scalars(
+          db.select(Song.id).where(
+              Song.id.in_({play['song_id'] for play in events}))))
+  events = [play for play in events if play['song_id'] in songs]
+  if not events:
+    return
+  db.session.execute(insert(SongLog), events)
+  db.session.info.setdefault('played_by', set()).update(
+      play['username'] for play in events)
+  db.session.info.setdefault('played_songs', set()).update(
+      play['song_id'] for play in events)
+  db.session.info.setdefault('song_plays', Counter()).update(
+      play['song_id'] for play in events)
+  record_trending(events)
+  _add_play_counts(events)
+
+
+#fold play events into PlayCount
+def _add_play_counts(events):
+  plays = {}
+  for play in events:
+    key = (play['username'], play['song_id'])
+    count, last = plays.get(key, (0, play['time']))
+    plays[key] = (count + 1, max(last, play['time']))
+  if not plays:
+    return
+  stmt = upsert(PlayCount)
+  stmt = stmt.on_conflict_do_update(
+      index_elements=['username', 'song_id'],
+      set_={
+          'play_count':
+          PlayCount.play_count + stmt.excluded.play_count,
+          'last_played':
+          case((PlayCount.last_played > stmt.excluded.last_played,
+                PlayCount.last_played),
+               else_=stmt.excluded.last_played)
+      })
+  db.session.execute(stmt, [{
+      'username': username,
+      'song_id': song_id,
+      'play_count': count,
+      'last_played': last
+  } for (username, song_id), (count, last) in plays.items()])
+
+
+#rebuild the PlayCount rollup from the whole of SongLog, and the plays
+#compacted out of it from the archive
+def rebuild_play_counts():
+  PlayCount.query.delete()
+  db.session.execute(
+      insert(PlayCount).from_select(
+          ['username', 'song_id', 'play_count', 'last_played'],
+          db.select(SongLog.username, SongLog.song_id, func.count(),
+                    func.max(SongLog.time)).where(
+                        SongLog.username.isnot(None),
+                        SongLog.song_id.isnot(None)).group_by(
+                            SongLog.username, SongLog.song_id)))
+  if _archive_files():
+    #archived plays of songs and users deleted since are left out
+    songs = set(db.session.execute(db.select(Song.id)).scalars())
+    users = set(db.session.execute(db.select(User.username)).scalars())
+    _add_play_counts([
+        row for row in archived_plays()
+        if row['song_id'] in songs and row['username'] in users
+    ])
+  db.session.commit()
+
+
+#play events queued in memory and flushed to SongLog as one bulk insert by
+#a background thread, when batch_size events are waiting or every
+#flush_seconds, so /song_clicked never waits on a commit. When a batch can
+#not be written its events are written one at a time: an event failing on
+#its own (a song deleted meanwhile, say) is logged and dropped, and while
+#the database can not be written at all the events wait, max_queue of them
+#at most
+class PlayLogBuffer:
+
+  def __init__(self, batch_size, flush_seconds, max_queue):
+    self.batch_size = batch_size
+    self.flush_seconds = flush_seconds
+    self.max_queue = max_queue
+    self.events = []
+    self.lock = threading.Lock()
+    self.wake = threading.Event()
+    self.stopped = threading.Event()
+    self.thread = None
+    self.pid = None
+
+  def add(self, play):
+    with self.lock:
+      self.events.append(play)
+      self._trim()
+      full = len(self.events) >= self.batch_size
+    self._ensure_thread()
+    if full:
+      self.wake.set()
+
+  def _ensure_thread(self):
+    #started lazily and per process, so forked workers get their own
+    if self.thread is None or self.pid != os.getpid():
+      with self.lock:
+        if self.thread is None or self.pid != os.getpid():
+          self.pid = os.getpid()
+          self.thread = threading.Thread(target=self._run,
+                                         name='play-log-flush',
+                                         daemon=True)
+          self.thread.start()
+
+  def _run(self):
+    while not self.stopped.is_set():
+      self.wake.wait(self.flush_seconds)
+      self.wake.clear()
+      self.flush()
+
+  #drop the oldest events past max_queue, called holding the lock
+  def _trim(self):
+    if len(self.events) > self.max_queue:
+      dropped = len(self.events) - self.max_queue
+      del self.events[:dropped]
+      app.logger.error('play log queue full, dropped %d play events', dropped)
+
+  #write events in one transaction, the exception when that failed
+  def _write(self, events):
+    try:
+      record_plays(events)
+      db.session.commit()
+    except Exception as e:
+      db.session.rollback()
+      return e
+    return None
+
+  #the database, not the events, failed: locked, unreachable or out of
+  #connections
+  @staticmethod
+  def _unavailable(error):
+    return isinstance(error, (OperationalError, PoolTimeoutError))
+
+  def flush(self):
+    with self.lock:
+      events, self.events = self.events, []
+    if not events:
+      return 0
+    with app.app_context():
+      error = self._write(events)
+      if error is None:
+        return len(events)
+      written, waiting = 0, events
+      if not self._unavailable(error):
+        app.logger.warning('could not write %d play events (%s), writing '
+                           'them one at a time', len(events), error)
+        waiting = []
+        for x, play in enumerate(events):
+          error = self._write([play])
+          if error is None:
+            written += 1
+          elif self._unavailable(error):
+            waiting = events[x:]
+            break
+          else:
+            app.logger.error('dropped play event %r: %s', play, error)
+      if waiting:
+        app.logger.error('could not write %d play events: %s', len(waiting),
+                         error)
+        with self.lock:
+          self.events[:0] = waiting
+          self._trim()
+    return written
+
+  #drain whatever is queued, called at interpreter shutdown
+  def stop(self):
+    self.stopped.set()
+    self.wake.set()
+    if self.thread is not None and self.thread.is_alive():
+      self.thread.join(timeout=self.flush_seconds + 5)
+    self.flush()
+
+
+#play log retention. SongLog rows older than SONG_LOG_RETENTION_DAYS are
+#compacted a day at a time: the day's rows are written to a gzipped csv
+#archive, then moved out of the live table in batches, each batch deleted
+#and added to the DailySongPlays and DailyUserPlays counts of its day in one
+#short transaction. A play is always in exactly one of SongLog and the daily
+#counts, and writing a day's archive again keeps the rows already in it, so
+#an interrupted compaction is finished by running it again. PlayCount keeps
+#every play, compacted or not
+
+ARCHIVE_FIELDS = ['id', 'song_id', 'username', 'time']
+
+
+def _archive_file(day):
+  return os.path.join(app.config["SONG_LOG_ARCHIVE_DIR"], f'{day:%Y}',
+                      f'{day:%m}', f'{day:%Y-%m-%d}.csv.gz')
+
+
+#(day, path) of the archives of the days between start and end (datetimes,
+#either open), oldest first
+def _archive_files(start=None, end=None):
+  found = []
+  for path in sorted(
+      glob.glob(
+          os.path.join(app.config["SONG_LOG_ARCHIVE_DIR"], '*', '*',
+                       '*.csv.gz'))):
+    day = datetime.strptime(os.path.basename(path)[:10], '%Y-%m-%d')
+    if (start is None or day + timedelta(days=1) > start) and (end is None or
+                                                               day < end):
+      found.append((day.date(), path))
+  return found
+
+
+def _read_archive(path):
+  with gzip.open(path, 'rt', newline='') as f:
+    for row in csv.DictReader(f):
+      yield {
+          'id': int(row['id']),
+          'song_id': int(row['song_id']) if row['song_id'] else None,
+          'username': row['username'] or None,
+          'time': datetime.fromisoformat(row['time'])
+      }
+
+
+#the play events archived between start and end, oldest day first, as
+#{id, song_id, username, time}
+def archived_plays(start=None, end=None):
+  for _, path in _archive_files(start, end):
+    for row in _read_archive(path):
+      if (start is None or row['time'] >= start) and (end is None or
+                                                      row['time'] < end):
+        yield row
+
+
+#midnight of the first day whose plays stay in SongLog, keeping days days
+#or SONG_LOG_RETENTION_DAYS
+def song_log_cutoff(days=None):
+  today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+  return today - timedelta(
+      days=app.config["SONG_LOG_RETENTION_DAYS"] if days is None else days)
+
+
+#the oldest day before cutoff with plays left in SongLog, None when there is
+#none
+def next_compactable_day(cutoff):
+  first = db.session.execute(
+      db.select(func.min(SongLog.time)).where(SongLog.time < cutoff)).scalar()
+  return first.date() if first else None
+
+
+#write the rows of a day to its archive next to what it holds already,
+#returning their ids
+def _write_archive(day, rows):
+  path = _archive_file(day)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  archived, ids = set(), array('q')
+  with (tempfile.NamedTemporaryFile(dir=os.path.dirname(path),
+                                    prefix='.archive-',
+                                    delete=False) as tmp,
+        gzip.open(tmp, 'wt', newline='') as f):
+    writer = csv.writer(f)
+    writer.writerow(ARCHIVE_FIELDS)
+    if os.path.exists(path):
+      for row in _read_archive(path):
+        archived.add(row['id'])
+        writer.writerow([
+            row['id'], row['song_id'], row['username'],
+            row['time'].isoformat()
+        ])
+    for row in rows:
+      ids.append(row.id)
+      if row.id not in archived:
+        writer.writerow(
+            [row.id, row.song_id, row.username,
+             row.time.isoformat()])
+  os.replace(tmp.name, path)
+  return ids
+
+
+def _add_daily_plays(model, key, day, counts):
+  if not counts:
+    return
+  stmt = upsert(model)
+  stmt = stmt.on_conflict_do_update(
+      index_elements=[key, 'day'],
+      set_={'plays': model.plays + stmt.excluded.plays})
+  db.session.execute(stmt, [{
+      key: ref,
+      'day': day,
+      'plays': plays
+  } for ref, plays in counts.items()])
+
+
+#delete the rows of a day with these ids from SongLog and count them into
+#the daily plays, in one transaction. Rows deleted since they were archived
+#(with their song or user) are not counted
+def _move_plays(day, ids):
+  moved = db.session.execute(
+      delete(SongLog).where(SongLog.id.in_(ids)).returning(
+          SongLog.song_id, SongLog.username).execution_options(
+              synchronize_session=False)).all()
+  songs = Counter(song_id for song_id, _ in moved if song_id is not None)
+  users = Counter(username for _, username in moved if username is not None)
+  #plays of songs and users deleted by hand since are left out
+  if songs:
+    songs = {
+        song_id: songs[song_id]
+        for song_id in db.session.execute(
+            db.select(Song.id).where(Song.id.in_(songs))).scalars()
+    }
+  if users:
+    users = {
+        username: users[username]
+        for username in db.session.execute(
+            db.select(User.username).where(User.username.in_(
+                users))).scalars()
+    }
+  _add_daily_plays(DailySongPlays, 'song_id', day, songs)
+  _add_daily_plays(DailyUserPlays, 'username', day, users)
+  db.session.commit()
+  return len(moved)
+
+
+#archive the plays of a day and move them out of SongLog, returning how
+#many were moved
+def compact_song_log_day(day):
+  start = datetime(day.year, day.month, day.day)
+  rows = db.session.execute(
+      db.select(SongLog.id, SongLog.song_id, SongLog.username,
+                SongLog.time).where(
+                    SongLog.time >= start,
+                    SongLog.time < start + timedelta(days=1)).order_by(
+                        SongLog.id).execution_options(yield_per=50000))
+  ids = _write_archive(day, rows)
+  db.session.commit()
+  batch = app.config["SONG_LOG_DELETE_BATCH"]
+  moved = 0
+  for x in range(0, len(ids), batch):
+    moved += _move_plays(day, ids[x:x + batch].tolist())
+  return moved
+
+
+#plays per day from start to end (dates, end excluded) of a song, of a user
+#or of every song, as (day, plays) pairs oldest first. Compacted days are
+#read from the daily counts and the rest from SongLog
+def daily_plays(start, end, song_id=None, username=None):
+  if song_id is not None and username is not None:
+    raise ValueError('daily plays are kept per song or per user, not both')
+  if username is not None:
+    daily, live = DailyUserPlays, [SongLog.username == username]
+    daily_where = [DailyUserPlays.username == username]
+  else:
+    #every play has a song, which keeps this to the time index
+    daily, live, daily_where = DailySongPlays, [], []
+    if song_id is not None:
+      live = [SongLog.song_id == song_id]
+      daily_where = [DailySongPlays.song_id == song_id]
+  days = Counter()
+  for day, plays in db.session.execute(
+      db.select(daily.day, func.sum(daily.plays)).where(
+          *daily_where, daily.day >= start,
+          daily.day < end).group_by(daily.day)):
+    days[day] += plays
+  day = func.date(SongLog.time)
+  for played, plays in db.session.execute(
+      db.select(day, func.count()).where(
+          *live, SongLog.time >= datetime.combine(start, datetime.min.time()),
+          SongLog.time < datetime.combine(end, datetime.min.time())).group_by(
+              day)):
+    days[datetime.strptime(str(played)[:10], '%Y-%m-%d').date()] += plays
+  return sorted(days.items())
+
+
+#background jobs. Work that should not hold up a request is queued in the
+#Job table, in the transaction of the change it belongs to, and run in a
+#process pool. Each web process has a dispatcher thread claiming queued jobs
+#with a conditional update, so a job runs once however many processes there
+#are, and applying the results. Jobs survive restarts since they live in the
+#database
+
+#kind -> (task run in the pool, function applying its result)
+JOB_KINDS = {}
+
+
+#register the function applying the results of a kind of job. The task is
+#run in another process, so it has to be importable there without main
+def job_kind(kind, task):
+
+  def register(apply):
+    JOB_KINDS[kind] = (task, apply)
+    return apply
+
+  return register
+
+
+#queue task(*args) in the current transaction, its result is applied with
+#apply(result, **context). The runner is woken once this commits
+def enqueue_job(kind, *args, **context):
+  now = datetime.now()
+  job = Job(kind=kind,
+            payload=json.dumps({
+                'args': list(args),
+                'context': context
+            }),
+            status='queued',
+            attempts=0,
+            created=now,
+            run_after=now)
+  db.session.add(job)
+  db.session.info['jobs_queued'] = True
+  return job
+
+
+@event.listens_for(db.session, 'after_commit')
+def _wake_job_runner(session):
+  if session.info.pop('jobs_queued', False):
+    job_runner.start()
+    job_runner.wake.set()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_queued_jobs(session):
+  session.info.pop('jobs_queued', None)
+
+
+def job_info(job):
+  return {
+      'id': job.id,
+      'kind': job.kind,
+      'status': job.status,
+      'attempts': job.attempts,
+      'result': json.loads(job.result) if job.result else None,
+      'error': job.error,
+      'created': job.created.isoformat() if job.created else None,
+      'finished': job.finished.isoformat() if job.finished else None
+  }
+
+
+#the dispatcher thread of a process and its pool. Tasks raising ValueError
+#were given input they can not handle and fail right away, other errors are
+#retried
+class JobRunner:
+
+  def __init__(self, workers, poll_seconds, max_attempts, retry_seconds,
+               timeout):
+    self.workers = workers
+    self.poll_seconds = poll_seconds
+    self.max_attempts = max_attempts
+    self.retry_seconds = retry_seconds
+    self.timeout = timeout
+    self.lock = threading.Lock()
+    self.wake = threading.Event()
+    self.stopped = threading.Event()
+    self.done = queue.Queue()
+    self.running = set()
+    self.thread = None
+    self.pid = None
+    self.pool = None
+
+  def start(self):
+    #started lazily and per process like the play log buffer
+    if self.thread is None or self.pid != os.getpid():
+      with self.lock:
+        if self.thread is None or self.pid != os.getpid():
+          self.pid = os.getpid()
+          self.pool = None
+          self.running = set()
+          self.thread = threading.Thread(target=self._run,
+                                         name='job-runner',
+                                         daemon=True)
+          self.thread.start()
+
+  def _run(self):
+    while not self.stopped.is_set():
+      with app.app_context():
+        try:
+          self._finish_done()
+          self._submit(self._claim(self.workers - len(self.running)))
+        except Exception:
+          db.session.rollback()
+          app.logger.exception('job runner failed')
+      self.wake.wait(self.poll_seconds)
+      self.wake.clear()
+
+  def _claim(self, slots):
+    now = datetime.now()
+    #jobs left running by a process that went away
+    lost = db.session.execute(
+        db.select(Job.id).where(
+            Job.status == 'running',
+            Job.started < now - timedelta(seconds=self.timeout))).scalars().all()
+    if lost:
+      db.session.execute(
+          update(Job).where(Job.id.in_(lost), Job.status == 'running').values(
+              status='queued', run_after=now))
+    claimed = []
+    if slots > 0:
+      candidates = db.session.execute(
+          db.select(Job.id, Job.kind, Job.payload).where(
+              Job.status == 'queued', Job.run_after <= now).order_by(
+                  Job.run_after, Job.id).limit(slots)).all()
+      for job in candidates:
+        if db.session.execute(
+            update(Job).where(Job.id == job.id,
+                              Job.status == 'queued').values(
+                                  status='running',
+                                  attempts=Job.attempts + 1,
+                                  started=now)).rowcount:
+          claimed.append(job)
+    db.session.commit()
+    return claimed
+
+  def _submit(self, jobs):
+    for job in jobs:
+      payload = json.loads(job.payload)
+      self.running.add(job.id)
+      try:
+        if job.kind not in JOB_KINDS:
+          raise ValueError(f'unknown job kind {job.kind}')
+        if self.pool is None:
+          #spawned workers only import the task's module (and re-run an
+          #unguarded __main__, so scripts need the usual __main__ guard)
+          self.pool = ProcessPoolExecutor(
+              max_workers=self.workers,
+              mp_context=multiprocessing.get_context('spawn'))
+        future = self.pool.submit(JOB_KINDS[job.kind][0], *payload['args'])
+      except Exception as e:
+        future = Future()
+        future.set_exception(e)
+      future.add_done_callback(lambda future, job=job, payload=payload: (
+          self.done.put((job.id, job.kind, payload, future)), self.wake.set()))
+
+  def _finish_done(self):
+    while True:
+      try:
+        job_id, kind, payload, future = self.done.get_nowait()
+      except queue.Empty:
+        return
+      self.running.discard(job_id)
+      self._finish(job_id, kind, payload, future)
+
+  def _finish(self, job_id, kind, payload, future):
+    now = datetime.now()
+    try:
+      result = future.result()
+      JOB_KINDS[kind][1](result, **payload['context'])
+      db.session.execute(
+          update(Job).where(Job.id == job_id).values(status='done',
+                                                     result=json.dumps(result),
+                                                     error=None,
+                                                     finished=now))
+    except Exception as e:
+      db.session.rollback()
+      if isinstance(e, BrokenProcessPool):
+        self.pool = None
+      job = db.session.get(Job, job_id)
+      job.error = f'{type(e).__name__}: {e}'
+      if isinstance(e, ValueError) or job.attempts >= self.max_attempts:
+        job.status, job.finished = 'failed', now
+      else:
+        job.status = 'queued'
+        job.run_after = now + timedelta(
+            seconds=self.retry_seconds * 2**(job.attempts - 1))
+    db.session.commit()
+
+  #wait for the running jobs briefly, called at interpreter shutdown. Jobs
+  #still running are queued again
+  def stop(self):
+    self.stopped.set()
+    self.wake.set()
+    if self.thread is not None and self.thread.is_alive():
+      self.thread.join(timeout=5)
+    if self.pool is not None:
+      self.pool.shutdown(wait=False, cancel_futures=True)
+    if self.running and self.pid == os.getpid():
+      with app.app_context():
+        db.session.execute(
+            update(Job).where(Job.id.in_(self.running)).values(
+                status='queued', run_after=datetime.now()))
+        db.session.commit()
+
+
+#duration, bitrate and checksum of an uploaded song, read from its file
+@job_kind('audio_metadata', audio_meta.probe)
+def apply_audio_metadata(result, song_id):
+  db.session.execute(
+      update(Song).where(Song.id == song_id).values(
+          duration=result['duration'],
+          bitrate=result['bitrate'],
+          checksum=result['checksum']))
+
+
+#signed in user. Pages only need the username and creator status of whoever
+#is signed in, so that is loaded once per request through a process wide LRU
+#of identities kept for IDENTITY_CACHE_SECONDS. Requests that write read it
+#from the database. Changes to a user call identity_cache.invalidate, other
+#processes see them once their entry expires
+
+Identity = namedtuple('Identity', ['username', 'creator'])
+
+
+class IdentityCache:
+
+  def __init__(self, size, seconds):
+    self.size = size
+    self.seconds = seconds
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+
+  #identity of username, None for a user that does not exist
+  def get(self, username, fresh=False):
+    if not fresh:
+      with self.lock:
+        entry = self.entries.get(username)
+        if entry is not None and entry[0] > time.monotonic():
+          self.entries.move_to_end(username)
+          return entry[1]
+    row = db.session.execute(
+        db.select(User.username, User.creator).where(
+            User.username == username)).first()
+    identity = Identity(*row) if row else None
+    with self.lock:
+      self.entries[username] = (time.monotonic() + self.seconds, identity)
+      self.entries.move_to_end(username)
+      while len(self.entries) > self.size:
+        self.entries.popitem(last=False)
+    return identity
+
+  def invalidate(self, username):
+    with self.lock:
+      self.entries.pop(username, None)
+    if has_request_context():
+      g.pop('current_user', None)
+
+
+identity_cache = IdentityCache(app.config["IDENTITY_CACHE_SIZE"],
+                               app.config["IDENTITY_CACHE_SECONDS"])
+
+
+#the signed in user of this request, None when nobody is
+def current_user():
+  if 'current_user' not in g:
+    username = session.get('username')
+    g.current_user = identity_cache.get(
+        username, fresh=request.method not in ('GET',
+                                               'HEAD')) if username else None
+  return g.current_user
+
+
+#fragment and data cache. Values are kept in an in-process LRU until their
+#ttl runs out, and also in a shared backend when CACHE_URL names one. Every
+#name, and every key under a name, has a generation that invalidate bumps;
+#entries are stored under the generations read before computing them, so a
+#value computed while a write commits is never read after it. With a backend
+#the generations live there and a write retires the entries of every
+#process, without one other processes keep theirs until the ttl runs out
+
+_MISSING = object()
+
 
-Initialization : Lines 11-17
-Models: Lines 19-100
-Utility functions: Lines 111-156
-Controllers: Lines 162-763
-Controllers-Users- Lines 162-406
-Controllers-Artists- Lines 407-607
-Controllers-Backend Lines 608-690
-Controllers-Admin Lines 691-763
+class FragmentCache:
 
-'''
-#Initialization
+  def __init__(self, size, backend=None):
+    self.size = size
+    self.backend = backend
+    self.entries = OrderedDict()
+    self.generations = {}
+    self.lock = threading.Lock()
 
-app = Flask(__name__)
-app.secret_key = 'your_secret_key_here'
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///music_app.db"
-db = SQLAlchemy(app)
+  def _generations(self, counters):
+    if self.backend is None:
+      with self.lock:
+        return [self.generations.get(counter, 0) for counter in counters]
+    return [
+        int(value or 0)
+        for value in self.backend.mget([f'gen:{c}' for c in counters])
+    ]
 
-#Models
+  #cached value of compute() for name and key, json serializable when there
+  #is a backend
+  def get(self, name, key, ttl, compute):
+    try:
+      generations = self._generations([name, f'{name}:{key}'])
+    except Exception:
+      app.logger.exception('fragment cache backend failed')
+      return compute()
+    entry = f'{name}:{key}:' + ':'.join(map(str, generations))
+    with self.lock:
+      cached = self.entries.get(entry)
+      if cached is not None and cached[0] > time.monotonic():
+        self.entries.move_to_end(entry)
+        return cached[1]
+    value = _MISSING
+    if self.backend is not None:
+      try:
+        raw = self.backend.get(f'frag:{entry}')
+        if raw is not None:
+          value = json.loads(raw)
+      except Exception:
+        app.logger.exception('fragment cache backend failed')
+    if value is _MISSING:
+      value = compute()
+      if self.backend is not None:
+        try:
+          self.backend.setex(f'frag:{entry}', max(1, int(ttl)),
+                             json.dumps(value))
+        except Exception:
+          app.logger.exception('fragment cache backend failed')
+    with self.lock:
+      self.entries[entry] = (time.monotonic() + ttl, value)
+      self.entries.move_to_end(entry)
+      while len(self.entries) > self.size:
+        self.entries.popitem(last=False)
+    return value
 
-class User(db.Model):
-  username = db.Column(db.String(80),
-                       unique=True,
-                       nullable=False,
-                       primary_key=True)
-  email = db.Column(db.String(120), unique=True, nullable=False)
-  password = db.Column(db.String(120), nullable=False)
-  creator = db.Column(db.Boolean, default=False, nullable=False)
-  profile_picture = db.Column(db.String(120))
-  artist = db.relationship("Artist",
-                           backref="user",
-                           uselist=False,
-                           cascade="all, delete-orphan")
-  playlist = db.relationship("Playlist",
-                           backref="user",
-                           cascade="all, delete-orphan")
-  time = db.Column(db.DateTime)
+  #retire every entry of name, or only the one of name and key. Call it once
+  #the write is committed
+  def invalidate(self, name, key=None):
+    counter = name if key is None else f'{name}:{key}'
+    prefix = f'{name}:' if key is None else f'{name}:{key}:'
+    with self.lock:
+      self.generations[counter] = self.generations.get(counter, 0) + 1
+      for entry in [e for e in self.entries if e.startswith(prefix)]:
+        del self.entries[entry]
+    if self.backend is not None:
+      try:
+        self.backend.incr(f'gen:{counter}')
+      except Exception:
+        app.logger.exception('fragment cache backend failed')
 
-#table for one to many relationship between playlist and songs
-playlist_song =db.Table(
-    'playlist_song',
-    db.Column('playlist_id', db.Integer, db.ForeignKey('playlist.id')),
-    db.Column('song_id', db.Integer, db.ForeignKey('song.id')))
 
+def _cache_backend():
+  if not app.config["CACHE_URL"]:
+    return None
+  if redis is None:
+    app.logger.warning('CACHE_URL is set but redis is not installed, the '
+                       'fragment cache is kept per process')
+    return None
+  return redis.Redis.from_url(app.config["CACHE_URL"])
 
-class Playlist(db.Model):
-  id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-  name = db.Column(db.String(255))
-  username = db.Column(db.String(80), db.ForeignKey('user.username'))
-  songs = db.relationship('Song', secondary='playlist_song')
-  playlist_picture = db.Column(db.String(120))
 
+fragment_cache = FragmentCache(app.config["FRAGMENT_CACHE_SIZE"],
+                               _cache_backend())
 
-class Artist(db.Model):
-  username = db.Column(db.String(80),
-                       db.ForeignKey('user.username'),
-                       primary_key=True)
-  profile_picture = db.Column(db.String(120))
-  time = db.Column(db.DateTime)
-  albums = db.relationship("Album",
-                           backref="artist",
-                           cascade="all, delete-orphan")
+#home page shelves, by the writes that change them
+SHELVES = ('popular', 'recent_albums', 'plays')
 
 
-class Album(db.Model):
-  id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-  name = db.Column(db.String(255))
-  artist_name = db.Column(db.String(80), db.ForeignKey('artist.username'))
-  album_picture = db.Column(db.String(120))
-  time = db.Column(db.DateTime)
-  songs = db.relationship('Song',
-                          backref='album',
-                          cascade='all, delete-orphan')
+def invalidate_shelves(*names):
+  for name in names or SHELVES:
+    fragment_cache.invalidate(name)
 
 
-class Song(db.Model):
-  id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-  name = db.Column(db.String(255))
-  artist_name = db.Column(db.String(80), db.ForeignKey('artist.username'))
-  album_id = db.Column(db.Integer, db.ForeignKey('album.id'))
-  path = db.Column(db.String(255))
-  song_image = db.Column(db.String(120))
-  time = db.Column(db.DateTime)
+#the home page shelves as rendered html. Popular songs and recently added
+#albums are the same for everyone, the plays shelves are per user and are
+#retired when that user's plays are written
+def home_shelves(username):
+  shared, own = (app.config["SHELF_CACHE_SECONDS"],
+                 app.config["USER_SHELF_CACHE_SECONDS"])
 
-#record of all ratings that are submitted by users
-class Ratings(db.Model):
-  id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-  song_id = db.Column(db.Integer, db.ForeignKey('song.id'))
-  username = db.Column(db.String, db.ForeignKey('user.username'))
-  rating = db.Column(db.Integer)
+  def plays():
+    played = Song.query.join(PlayCount, PlayCount.song_id == Song.id).filter(
+        PlayCount.username == username)
+    songs = played.order_by(desc(
+        PlayCount.last_played)).limit(6).all() #last played songs
+    song_favs = played.order_by(desc(PlayCount.play_count),
+                                desc(PlayCount.last_played)).limit(
+                                    6).all() #most played songs
+    recommended = recommend_songs(username)
+    return {
+        'recommended': render_template('shelf_songs.html',
+                                       songs=recommended,
+                                       empty='') if recommended else '',
+        'recent': render_template('shelf_songs.html',
+                                  songs=songs,
+                                  empty='No recent plays'),
+        'frequent': render_template('shelf_songs.html',
+                                    songs=song_favs,
+                                    empty='No plays')
+    }
 
-#record of songs played by users
-class SongLog(db.Model):
-  id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-  song_id = db.Column(db.Integer, db.ForeignKey('song.id'))
-  username = db.Column(db.String(80), db.ForeignKey('user.username'))
-  time = db.Column(db.DateTime)
+  shelves = fragment_cache.get('plays', username, own, plays)
+  #rendered from a fresh ranking, as the shelf is shared with processes whose
+  #writes this process' leaderboard has not seen
+  shelves['popular'] = fragment_cache.get(
+      'popular', '', shared, lambda: render_template(
+          'shelf_songs.html',
+          songs=leaderboard.top('song', 6, fresh=True), #highest rated songs
+          empty='Nothing to display'))
+  shelves['recent_albums'] = fragment_cache.get(
+      'recent_albums', '', shared, lambda: render_template(
+          'shelf_albums.html',
+          albums=Album.query.order_by(desc(Album.time)).limit(6).all(),
+          empty='Nothing to display'))
+  return {name: Markup(html) for name, html in shelves.items()}
 
 
-class Admin(db.Model):
-  username = db.Column(db.String(80), primary_key=True)
-  password = db.Column(db.String(80))
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_played_shelves(session):
+  for username in session.info.pop('played_by', ()):
+    fragment_cache.invalidate('plays', username)
 
 
-with app.app_context():
-  # db.drop_all()
-  db.create_all()
-  #  admin=Admin(username="ABC", password="pass")
-  #  db.session.add(admin)
-  #  db.session.commit()
+@event.listens_for(db.session, 'after_rollback')
+def _keep_played_shelves(session):
+  session.info.pop('played_by', None)
 
 
+#recommendations. Item to item collaborative filtering: every user is a row
+#of an interaction matrix with a weight per song they played or rated, and
+#songs are similar when the same users weigh them the same way. The
+#NEIGHBORS most similar songs of each song are kept in SongSimilarity, by a
+#batch rebuild (recommend.py, sparse matrix products when NumPy and SciPy
+#are installed) and for songs played since by a background thread. A user's
+#recommendations are the neighbors of what they played and rated lately
 
+#listeners of a song looked at when it is updated on its own
+RECOMMEND_SAMPLE = 500
+RECOMMEND_SEEDS = 20
+RECOMMEND_BATCH = 50000
 
-# General utility functions
 
-#function to add rating to songs
-def add_rating_songs(songs):
-  for song in songs:
-    ratings = Ratings.query.filter_by(song_id=song.id).all()
-    sum_r = sum(rating.rating for rating in ratings)
-    song.rating = round((sum_r / len(ratings)), 2) if ratings else 0
+def _interaction_weight(play_count, rating):
+  weight = math.log1p(play_count or 0)
+  if rating:
+    weight += (rating - 2.5) / 2.5
+  return max(weight, 0.0)
 
-  songs.sort(key=lambda x: x.rating, reverse=True)
-  return songs
 
-#function to add rating to albums
-def add_rating_album(album):
-  for alb in album:
-    songs = Song.query.filter_by(album_id=alb.id).all()
-    total = 0
-    leng = 0
-    for song in songs:
-      ratings = Ratings.query.filter_by(song_id=song.id).all()
-      song.rating = sum(rating.rating
-                        for rating in ratings) / len(ratings) if ratings else 0
-      if song.rating > 0:
-        total += song.rating
-        leng += 1
-    alb.rating = round(total / leng, 2) if leng else 0
-  album.sort(key=lambda x: x.rating, reverse=True)
-  return album
+#(username, song_id) -> weight of the interactions selected by the where
+#clauses for PlayCount and Ratings
+def _interactions(plays_where, ratings_where):
+  found = {}
+  for username, song_id, count in db.session.execute(
+      db.select(PlayCount.username, PlayCount.song_id,
+                PlayCount.play_count).where(*plays_where)):
+    found[(username, song_id)] = [count, None]
+  for username, song_id, rating in db.session.execute(
+      db.select(Ratings.username, Ratings.song_id,
+                Ratings.rating).where(*ratings_where)):
+    found.setdefault((username, song_id), [0, None])[1] = rating
+  return {key: _interaction_weight(*value) for key, value in found.items()}
 
-#function to add rating to artists
-def add_rating_artist(artists):
-  for art in artists:
-    songs = Song.query.filter_by(artist_name=art.username).all()
-    total = 0
-    leng = 0
-    for song in songs:
-      ratings = Ratings.query.filter_by(song_id=song.id).all()
-      song.rating = sum(rating.rating
-                        for rating in ratings) / len(ratings) if ratings else 0
-      if song.rating > 0:
-        total += song.rating
-        leng += 1
-    art.rating = round(total / leng, 2) if leng else 0
-  artists.sort(key=lambda x: x.rating, reverse=True)
-  return artists
+
+def _write_neighbors(conn, song_ids, rows):
+  table = SongSimilarity.__table__
+  for chunk in range(0, len(song_ids), 500):
+    conn.execute(
+        delete(table).where(table.c.song_id.in_(song_ids[chunk:chunk + 500])))
+  if rows:
+    conn.execute(insert(table), rows)
+
+
+def _top_neighbors(song_id, scores, n):
+  best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:n]
+  return [{
+      'song_id': song_id,
+      'similar_id': other,
+      'score': score
+  } for other, score in best if score > 0]
+
+
+#recompute the neighbors of one song from its most recent listeners and
+#raters, RECOMMEND_SAMPLE of each
+def refresh_song_neighbors(song_id):
+  listeners = [
+      username for (username, ) in db.session.execute(
+          db.select(PlayCount.username).where(
+              PlayCount.song_id == song_id).order_by(
+                  PlayCount.last_played.desc()).limit(RECOMMEND_SAMPLE))
+  ]
+  listeners += [
+      username for (username, ) in db.session.execute(
+          db.select(Ratings.username).where(Ratings.song_id == song_id).order_by(
+              Ratings.id.desc()).limit(RECOMMEND_SAMPLE))
+  ]
+  listeners = list(dict.fromkeys(listeners))
+  weights = {}
+  for chunk in range(0, len(listeners), 500):
+    users = listeners[chunk:chunk + 500]
+    weights.update(
+        _interactions([PlayCount.username.in_(users)],
+                      [Ratings.username.in_(users)]))
+  own = {u: w for (u, s), w in weights.items() if s == song_id and w > 0}
+  dots, sampled = {}, {}
+  for (username, other), weight in weights.items():
+    if other != song_id and username in own and weight > 0:
+      dots[other] = dots.get(other, 0.0) + own[username] * weight
+      sampled[other] = sampled.get(other, 0.0) + weight * weight
+  norm = math.sqrt(sum(w * w for w in own.values()))
+  norms = {}
+  others = list(dots)
+  for chunk in range(0, len(others), 500):
+    norms.update(
+        db.session.execute(
+            db.select(SongVector.song_id, SongVector.norm).where(
+                SongVector.song_id.in_(others[chunk:chunk + 500]))).all())
+  scores = {
+      other: dot / (norm * max(norms.get(other, 0.0), math.sqrt(sampled[other])))
+      for other, dot in dots.items()
+  } if norm else {}
+  conn = db.session.connection()
+  _write_neighbors(conn, [song_id],
+                   _top_neighbors(song_id, scores,
+                                  app.config["RECOMMEND_NEIGHBORS"]))
+  if len(listeners) < RECOMMEND_SAMPLE:
+    #every listener was seen, so the norm is exact
+    stmt = upsert(SongVector).values(song_id=song_id, norm=norm)
+    db.session.execute(
+        stmt.on_conflict_do_update(index_elements=['song_id'],
+                                   set_={'norm': stmt.excluded.norm}))
+
+
+#the user x song matrix (csc) of every interaction and the song id of each
+#column, read in batches into flat arrays
+def _interaction_matrix():
+  users, songs = {}, {}
+  rows, cols, values = array('q'), array('q'), array('d')
+  for stmt, weight in (
+      (db.select(PlayCount.username, PlayCount.song_id, PlayCount.play_count),
+       math.log1p),
+      (db.select(Ratings.username, Ratings.song_id, Ratings.rating),
+       lambda rating: (rating - 2.5) / 2.5 if rating else 0.0)):
+    for username, song_id, value in db.session.execute(
+        stmt.execution_options(yield_per=RECOMMEND_BATCH)):
+      rows.append(users.setdefault(username, len(users)))
+      cols.append(songs.setdefault(song_id, len(songs)))
+      values.append(weight(value or 0))
+  #plays and the rating of the same user and song add up
+  matrix = sparse.coo_matrix(
+      (numpy.frombuffer(values, dtype=numpy.float64),
+       (numpy.frombuffer(rows, dtype=numpy.int64),
+        numpy.frombuffer(cols, dtype=numpy.int64))),
+      shape=(len(users), len(songs))).tocsc()
+  matrix.data = numpy.maximum(matrix.data, 0)
+  matrix.eliminate_zeros()
+  return matrix, numpy.array(list(songs), dtype=numpy.int64)
+
+
+#rebuild SongVector and SongSimilarity from every interaction, block songs
+#at a time so memory stays bounded by a block of the similarity matrix
+def rebuild_recommendations(block=1000):
+  n = app.config["RECOMMEND_NEIGHBORS"]
+  if numpy is None:
+    song_ids = db.session.execute(
+        db.select(PlayCount.song_id).union(db.select(
+            Ratings.song_id))).scalars().all()
+    for song_id in song_ids:
+      refresh_song_neighbors(song_id)
+      db.session.commit()
+    return len(song_ids)
+  matrix, song_ids = _interaction_matrix()
+  norms = numpy.sqrt(numpy.asarray(matrix.multiply(matrix).sum(axis=0)).ravel())
+  with db.engine.begin() as conn:
+    conn.execute(delete(SongVector.__table__))
+    for start in range(0, len(song_ids), RECOMMEND_BATCH):
+      conn.execute(insert(SongVector.__table__), [{
+          'song_id': int(song_id),
+          'norm': float(norm)
+      } for song_id, norm in zip(song_ids[start:start + RECOMMEND_BATCH],
+                                 norms[start:start + RECOMMEND_BATCH],
+                                 strict=True)])
+  normalized = (matrix @ sparse.diags(1 / numpy.where(norms > 0, norms, 1))
+               ).tocsc()
+  transposed = normalized.T.tocsr()
+  for start in range(0, len(song_ids), block):
+    scores = (transposed[start:start + block] @ normalized).tocsr()
+    rows = []
+    for i in range(scores.shape[0]):
+      lo, hi = scores.indptr[i], scores.indptr[i + 1]
+      others, values = scores.indices[lo:hi], scores.data[lo:hi]
+      keep = (others != start + i) & (values > 0)
+      others, values = others[keep], values[keep]
+      if len(values) > n:
+        best = numpy.argpartition(-values, n)[:n]
+        others, values = others[best], values[best]
+      rows += [{
+          'song_id': int(song_ids[start + i]),
+          'similar_id': int(song_ids[other]),
+          'score': float(value)
+      } for other, value in zip(others, values, strict=True)]
+    with db.engine.begin() as conn:
+      _write_neighbors(conn, [int(s) for s in song_ids[start:start + block]],
+                       rows)
+  #songs nobody plays or rates any more
+  table = SongSimilarity.__table__
+  with db.engine.begin() as conn:
+    conn.execute(
+        delete(table).where(~exists().where(
+            SongVector.song_id == table.c.song_id)))
+  return len(song_ids)
+
+
+#songs to recommend to a user, the neighbors of their recent plays and
+#ratings weighted by how much they liked each, leaving out what they played
+def recommend_songs(username, n=6):
+  seeds = {}
+  for song_id, count in db.session.execute(
+      db.select(PlayCount.song_id, PlayCount.play_count).where(
+          PlayCount.username == username).order_by(
+              PlayCount.last_played.desc()).limit(RECOMMEND_SEEDS)):
+    seeds[song_id] = [count, None]
+  for song_id, rating in db.session.execute(
+      db.select(Ratings.song_id, Ratings.rating).where(
+          Ratings.username == username, Ratings.rating >= 4).limit(
+              RECOMMEND_SEEDS)):
+    seeds.setdefault(song_id, [0, None])[1] = rating
+  if not seeds:
+    return []
+  scores = {}
+  for seed, other, score in db.session.execute(
+      db.select(SongSimilarity.song_id, SongSimilarity.similar_id,
+                SongSimilarity.score).where(
+                    SongSimilarity.song_id.in_(list(seeds)))):
+    if other not in seeds:
+      scores[other] = scores.get(other, 0.0) + score * _interaction_weight(
+          *seeds[seed])
+  if scores:
+    for (played, ) in db.session.execute(
+        db.select(PlayCount.song_id).where(
+            PlayCount.username == username,
+            PlayCount.song_id.in_(list(scores)))):
+      del scores[played]
+  best = sorted(scores, key=scores.get, reverse=True)[:n]
+  if not best:
+    return []
+  found = {song.id: song for song in Song.query.filter(Song.id.in_(best))}
+  return [found[song_id] for song_id in best if song_id in found]
+
+
+#songs played since the last round, refreshed by a background thread every
+#update_seconds. The next batch rebuild supersedes what it misses
+class RecommendationUpdater:
+
+  def __init__(self, update_seconds, batch_size=200):
+    self.update_seconds = update_seconds
+    self.batch_size = batch_size
+    self.dirty = set()
+    self.lock = threading.Lock()
+    self.wake = threading.Event()
+    self.stopped = threading.Event()
+    self.thread = None
+    self.pid = None
+
+  def touch(self, song_ids):
+    with self.lock:
+      self.dirty.update(song_ids)
+    if self.thread is None or self.pid != os.getpid():
+      with self.lock:
+        if self.thread is None or self.pid != os.getpid():
+          self.pid = os.getpid()
+          self.thread = threading.Thread(target=self._run,
+                                         name='recommendations',
+                                         daemon=True)
+          self.thread.start()
+
+  def _run(self):
+    while not self.stopped.is_set():
+      self.wake.wait(self.update_seconds)
+      self.wake.clear()
+      self.refresh()
+
+  def refresh(self):
+    with self.lock:
+      songs = sorted(self.dirty)[:self.batch_size]
+      self.dirty.difference_update(songs)
+    with app.app_context():
+      for song_id in songs:
+        try:
+          refresh_song_neighbors(song_id)
+          db.session.commit()
+        except Exception:
+          db.session.rollback()
+          app.logger.exception('could not refresh the neighbors of song %s',
+                               song_id)
+    return len(songs)
+
+  def stop(self):
+    self.stopped.set()
+    self.wake.set()
+
+
+recommendation_updater = RecommendationUpdater(
+    app.config["RECOMMEND_UPDATE_SECONDS"])
+atexit.register(recommendation_updater.stop)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _update_played_neighbors(session):
+  played = session.info.pop('played_songs', None)
+  if played:
+    recommendation_updater.touch(played)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _keep_played_neighbors(session):
+  session.info.pop('played_songs', None)
+
+
+#admin timeline
+
+TIMELINE_BUCKETS = '12h,1d,1w,3w'
+_TIME_UNITS = {'m': 'minutes', 'h': 'hours', 'd': 'days', 'w': 'weeks'}
+_timeline_cache = {}
+
+
+def timeline_categories():
+  return {
+      "User": User,
+      "Artist": Artist,
+      "Album": Album,
+      "Song": Song,
+      "SongLog": SongLog,
+      "Ratings": Ratings
+  }
+
+
+#parse "12h,1d,1w" into increasing timedeltas, None if it is malformed
+def parse_buckets(spec):
+  edges = []
+  for part in spec.split(','):
+    match = re.fullmatch(r'(\d+)([mhdw])', part.strip())
+    if not match:
+      return None
+    edges.append(timedelta(**{_TIME_UNITS[match[2]]: int(match[1])}))
+  if not edges or edges != sorted(set(edges)):
+    return None
+  return edges
+
+
+def bucket_labels(spec):
+  parts = [part.strip() for part in spec.split(',')]
+  labels = ['Within ' + parts[0]]
+  labels += [f'{newer}-{older}' for newer, older in itertools.pairwise(parts)]
+  labels.append('More than ' + parts[-1])
+  return labels
+
+
+#one column per bucket of the times in column, newest bucket first and
+#everything older than the last edge at the end, counting the rows or
+#summing amount
+def _bucket_totals(column, edges, amount=None):
+  now = datetime.now()
+  bounds = [now - edge for edge in edges] + [None]
+  totals, newer = [], None
+  for bound in bounds:
+    conditions = []
+    if newer is not None:
+      conditions.append(column < newer)
+    if bound is not None:
+      conditions.append(column >= bound)
+    if amount is None:
+      totals.append(func.count(case((and_(*conditions), 1))))
+    else:
+      totals.append(
+          func.coalesce(func.sum(case((and_(*conditions), amount))), 0))
+    newer = bound
+  return totals
+
+
+#number of rows of a model created inside each bucket, in a single query
+def count_time_buckets(model, edges):
+  return list(
+      db.session.execute(
+          db.select(*_bucket_totals(model.time, edges)).select_from(
+              model).where(model.time.isnot(None))).one())
+
+
+#plays compacted out of SongLog inside each bucket, by the day they were on
+def count_compacted_buckets(edges):
+  return list(
+      db.session.execute(
+          db.select(*_bucket_totals(DailySongPlays.day, edges,
+                                    DailySongPlays.plays))).one())
+
+
+def time_buckets(category, edges):
+  counts = count_time_buckets(timeline_categories()[category], edges)
+  if category == 'SongLog':
+    counts = [
+        live + compacted
+        for live, compacted in zip(
+            counts, count_compacted_buckets(edges), strict=True)
+    ]
+  return counts
+
+
+#only the default buckets are cached, ?buckets= is up to the client and
+#caching every spec asked for would grow the cache without bound
+def cached_time_buckets(category, spec, edges):
+  if spec != TIMELINE_BUCKETS:
+    return time_buckets(category, edges)
+  cached = _timeline_cache.get(category)
+  if cached is None or cached[0] < datetime.now():
+    counts = time_buckets(category, edges)
+    cached = (datetime.now() +
+              timedelta(seconds=app.config["TIMELINE_CACHE_SECONDS"]),
+              counts)
+    _timeline_cache[category] = cached
+  return cached[1]
+
+
+#totals shown on the admin dashboard, counted in one query and cached like
+#the timeline
+def catalog_counts():
+  cached = _timeline_cache.get('counts')
+  if cached is None or cached[0] < datetime.now():
+    models = {
+        'users': User,
+        'artists': Artist,
+        'albums': Album,
+        'songs': Song,
+        'playlists': Playlist,
+        'streams': SongLog
+    }
+    counts = db.session.execute(
+        db.select(*[
+            db.select(func.count()).select_from(model).scalar_subquery().label(
+                name) for name, model in models.items()
+        ],
+                  db.select(func.coalesce(func.sum(
+                      DailySongPlays.plays), 0)).scalar_subquery().label(
+                          'compacted'))).one()._asdict()
+    #plays compacted out of SongLog are streams too
+    counts['streams'] += counts.pop('compacted')
+    cached = (datetime.now() +
+              timedelta(seconds=app.config["TIMELINE_CACHE_SECONDS"]),
+              counts)
+    _timeline_cache['counts'] = cached
+  return cached[1]
+
+
+#trending charts. Each play counts towards its song, album and artist in
+#every window of TRENDING_WINDOWS with a weight of exp(-age / window), so a
+#play a window ago counts for a third of one now. All the weights decay at
+#the same rate and the order of two entries only changes when one of them is
+#played, which lets a score be kept as the log of the sum of
+#exp((played - TRENDING_EPOCH) / window) over its plays: a play adds to the
+#rows of what was played and leaves every other row alone. A chart is read
+#from the ranking index however long the play log is, and an entry's
+#decayed play count now is exp(score - (now - TRENDING_EPOCH) / window)
+
+TRENDING_EPOCH = datetime(2020, 1, 1)
+TRENDING_KINDS = ('song', 'album', 'artist')
+TRENDING_BATCH = 50000
+TRENDING_LIMIT = 100
+
+
+def _trending_spans(spec):
+  edges = parse_buckets(spec)
+  if edges is None:
+    raise ValueError(f'TRENDING_WINDOWS is malformed: {spec!r}')
+  return {
+      part.strip(): edge.total_seconds()
+      for part, edge in zip(spec.split(','), edges, strict=True)
+  }
+
+
+#span -> length of the window in seconds
+TRENDING_SPANS = _trending_spans(app.config["TRENDING_WINDOWS"])
+
+
+#log(exp(a) + exp(b)), None standing for no plays
+def _log_add(a, b):
+  if a is None:
+    return b
+  if a < b:
+    a, b = b, a
+  return a + math.log1p(math.exp(b - a))
+
+
+#(kind, span, ref) -> score of the given plays ((song_id, time) pairs) alone.
+#Songs are added up first and rolled into their albums and artists after
+def _trending_points(plays):
+  songs = {}
+  for song_id, played in plays:
+    age = (played - TRENDING_EPOCH).total_seconds()
+    for span, seconds in TRENDING_SPANS.items():
+      key = ('song', span, str(song_id))
+      songs[key] = _log_add(songs.get(key), age / seconds)
+  owners = {}
+  song_ids = list({int(ref) for _, _, ref in songs})
+  for x in range(0, len(song_ids), TRENDING_BATCH):
+    owners.update(
+        (song_id, (album_id, artist_name))
+        for song_id, album_id, artist_name in db.session.execute(
+            db.select(Song.id, Song.album_id, Song.artist_name).where(
+                Song.id.in_(song_ids[x:x + TRENDING_BATCH]))))
+  points = {}
+  for (_, span, ref), score in songs.items():
+    if int(ref) not in owners:
+      continue
+    points[('song', span, ref)] = score
+    album_id, artist_name = owners[int(ref)]
+    for kind, owner in (('album', album_id), ('artist', artist_name)):
+      if owner is not None:
+        key = (kind, span, str(owner))
+        points[key] = _log_add(points.get(key), score)
+  return points
+
+
+def _write_trending(points):
+  if not points:
+    return
+  stmt = upsert(TrendingScore)
+  stmt = stmt.on_conflict_do_update(
+      index_elements=['kind', 'span', 'ref'],
+      set_={'score': stmt.excluded.score})
+  db.session.execute(stmt, [{
+      'kind': kind,
+      'span': span,
+      'ref': ref,
+      'score': score
+  } for (kind, span, ref), score in points.items()])
+
+
+#add a batch of play events to the scores, in the transaction logging them.
+#The rows are read for update, and on sqlite the SongLog insert before this
+#already holds the write lock, so concurrent batches add up
+def record_trending(events):
+  points = _trending_points(
+      (play['song_id'], play['time']) for play in events)
+  if not points:
+    return
+  refs = {}
+  for kind, _, ref in points:
+    refs.setdefault(kind, set()).add(ref)
+  for kind, kind_refs in refs.items():
+    for _, span, ref, score in db.session.execute(
+        db.select(TrendingScore.kind, TrendingScore.span, TrendingScore.ref,
+                  TrendingScore.score).where(
+                      TrendingScore.kind == kind,
+                      TrendingScore.span.in_(TRENDING_SPANS),
+                      TrendingScore.ref.in_(kind_refs)).with_for_update()):
+      key = (kind, span, ref)
+      points[key] = _log_add(points[key], score)
+  _write_trending(points)
+
+
+#rebuild every score from the whole of SongLog. Plays compacted out of it
+#are left out, they are SONG_LOG_RETENTION_DAYS old and count for next to
+#nothing in windows much shorter than that
+def rebuild_trending():
+  TrendingScore.query.delete()
+  plays = db.session.execute(
+      db.select(SongLog.song_id, SongLog.time).where(
+          SongLog.song_id.isnot(None),
+          SongLog.time.isnot(None)).execution_options(yield_per=TRENDING_BATCH))
+  _write_trending(_trending_points(plays))
+  db.session.commit()
+
+
+#deleted songs, albums and artists leave the charts in the same transaction
+@event.listens_for(db.session, 'after_flush')
+def discard_trending(session, _flush_context):
+  gone = {}
+  for obj in session.deleted:
+    if isinstance(obj, Song):
+      gone.setdefault('song', set()).add(str(obj.id))
+    elif isinstance(obj, Album):
+      gone.setdefault('album', set()).add(str(obj.id))
+    elif isinstance(obj, (Artist, User)):
+      gone.setdefault('artist', set()).add(obj.username)
+  for kind, refs in gone.items():
+    session.connection().execute(
+        delete(TrendingScore).where(TrendingScore.kind == kind,
+                                    TrendingScore.span.in_(TRENDING_SPANS),
+                                    TrendingScore.ref.in_(refs)))
+
+
+#the n entries of a kind trending most over a span, highest first, as
+#(ref, decayed play count) pairs
+def trending(kind, span, n=10):
+  now = (datetime.now() - TRENDING_EPOCH).total_seconds() / TRENDING_SPANS[span]
+  rows = db.session.execute(
+      db.select(TrendingScore.ref, TrendingScore.score).where(
+          TrendingScore.kind == kind, TrendingScore.span == span).order_by(
+              desc(TrendingScore.score)).limit(n))
+  return [(ref, math.exp(score - now)) for ref, score in rows]
+
+
+#a trending chart as dicts for the api, in chart order
+def read_trending(kind, span, n=10):
+  chart = trending(kind, span, n)
+  if kind == 'artist':
+    return [{'username': ref, 'plays': round(plays, 3)} for ref, plays in chart]
+  model = Song if kind == 'song' else Album
+  columns = [model.id, model.name, model.artist_name]
+  if kind == 'song':
+    columns += [Song.album_id, Song.song_image]
+  else:
+    columns.append(Album.album_picture)
+  found = {
+      row.id: row._asdict()
+      for row in db.session.execute(
+          db.select(*columns).where(model.id.in_([int(ref) for ref, _ in chart])))
+  }
+  return [
+      dict(found[int(ref)], plays=round(plays, 3)) for ref, plays in chart
+      if int(ref) in found
+  ]
+
+
+#deletes. delete_catalog removes a song, album, artist or user and
+#everything hanging off it with set based DELETE statements, the rows being
+#picked by subqueries, in one transaction: the songs and albums, their
+#playlist entries, ratings, plays and the rows derived from them, and for a
+#user their own playlists, ratings and plays. Nothing is loaded through the
+#ORM, so what the after_flush hooks do for ORM deletes (search entries,
+#trending scores, audio references, autocomplete) is done here too. Audio
+#and artwork files no row uses any more, in the stores or the folders they
+#were saved in before them, are removed by a background thread once the
+#transaction commits
+
+#artwork files stored or stored again this recently are left in place, an
+#upload of the same picture may be about to point a row at them
+CLEANUP_GRACE_SECONDS = 3600
+_cleanup_pool = ThreadPoolExecutor(max_workers=1,
+                                   thread_name_prefix='cleanup')
+
+
+def _delete(model, *where):
+  db.session.execute(
+      delete(model).where(*where).execution_options(
+          synchronize_session=False))
+
+
+def _forget_refs(kind, refs):
+  _delete(SearchEntry, SearchEntry.kind == kind, SearchEntry.ref.in_(refs))
+  _delete(TrendingScore, TrendingScore.kind == kind,
+          TrendingScore.span.in_(TRENDING_SPANS), TrendingScore.ref.in_(refs))
+
+
+#recompute the rating aggregates of songs from Ratings
+def _recount_song_ratings(song_ids):
+  for i in range(0, len(song_ids), 500):
+    chunk = song_ids[i:i + 500]
+    _delete(SongRating, SongRating.song_id.in_(chunk))
+    db.session.execute(
+        insert(SongRating).from_select(
+            ['song_id', 'rating_sum', 'rating_count', 'rating'],
+            db.select(Ratings.song_id, func.sum(Ratings.rating), func.count(),
+                      func.round(func.avg(Ratings.rating), 2)).where(
+                          Ratings.song_id.in_(chunk)).group_by(
+                              Ratings.song_id)))
+
+
+#delete the song (id), album (id), artist or user (username) in the current
+#transaction. False when there is no such entry
+def delete_catalog(kind, key):
+  entry = {
+      'song': Song,
+      'album': Album,
+      'artist': Artist,
+      'user': User
+  }[kind]
+  if db.session.get(entry, key) is None:
+    return False
+  if kind == 'song':
+    songs = db.select(Song.id).where(Song.id == key)
+  elif kind == 'album':
+    albums = db.select(Album.id).where(Album.id == key)
+    songs = db.select(Song.id).where(Song.album_id == key)
+  else:
+    #the songs on the artist's albums, whoever they are credited to, as the
+    #album cascade deleted them, and the artist's songs on other artists'
+    #albums, which would otherwise be left crediting nobody
+    albums = db.select(Album.id).where(Album.artist_name == key)
+    songs = db.select(Song.id).where(
+        or_(Song.artist_name == key, Song.album_id.in_(albums)))
+  album_ids = [] if kind == 'song' else db.session.execute(
+      albums).scalars().all()
+  playlist_ids = db.session.execute(
+      db.select(Playlist.id).where(
+          Playlist.username == key)).scalars().all() if kind == 'user' else []
+  song_ids = db.session.execute(songs).scalars().all()
+  in_songs = Song.id.in_(songs)
+  owners = db.session.execute(
+      db.select(Song.album_id, Song.artist_name).where(in_songs).distinct()).all()
+  rollup_albums = set(album_ids) | {album_id for album_id, _ in owners}
+  rollup_artists = {artist_name for _, artist_name in owners}
+  if kind in ('artist', 'user'):
+    rollup_artists.add(key)
+
+  #files, given up here and removed once this commits
+  pictures = set(db.session.execute(
+      db.select(Song.song_image).where(in_songs)).scalars())
+  pictures.update(
+      db.session.execute(
+          db.select(Album.album_picture).where(
+              Album.id.in_(album_ids))).scalars())
+  pictures.update(
+      db.session.execute(
+          db.select(Playlist.playlist_picture).where(
+              Playlist.id.in_(playlist_ids))).scalars())
+  if kind in ('artist', 'user'):
+    pictures.update(
+        db.session.execute(
+            db.select(Artist.profile_picture).where(
+                Artist.username == key)).scalars())
+  if kind == 'user':
+    pictures.add(db.session.get(User, key).profile_picture)
+  db.session.info.setdefault('released_artwork', set()).update(
+      picture for picture in pictures if picture)
+  db.session.info.setdefault('released_files', set()).update(
+      db.session.execute(
+          db.select(Song.path).where(in_songs, Song.audio_digest.is_(None),
+                                     Song.path != '')).scalars())
+  released = db.session.execute(
+      db.select(Song.audio_digest, func.count()).where(
+          in_songs, Song.audio_digest.isnot(None)).group_by(
+              Song.audio_digest)).all()
+  if released:
+    db.session.execute(
+        update(AudioBlob.__table__).where(
+            AudioBlob.__table__.c.digest == bindparam('blob')).values(
+                ref_count=AudioBlob.__table__.c.ref_count -
+                bindparam('released')), [{
+                    'blob': digest,
+                    'released': count
+                } for digest, count in released])
+    db.session.info.setdefault('released_audio', set()).update(
+        digest for digest, _ in released)
+
+  #rows of the songs
+  _delete(playlist_song, playlist_song.c.song_id.in_(songs))
+  for model in (Ratings, SongLog, PlayCount, DailySongPlays, SongRating,
+                SongVector):
+    _delete(model, model.song_id.in_(songs))
+  _delete(SongSimilarity,
+          or_(SongSimilarity.song_id.in_(songs),
+              SongSimilarity.similar_id.in_(songs)))
+  _forget_refs('song', db.select(cast(Song.id, db.String)).where(in_songs))
+  _forget_refs('album', [str(album_id) for album_id in album_ids])
+
+  #a user's own rows. Ratings they gave songs that stay are taken out of
+  #those songs' aggregates
+  rated = []
+  if kind == 'user':
+    rated = db.session.execute(
+        db.select(Ratings.song_id).where(Ratings.username == key).distinct()
+    ).scalars().all()
+    _delete(Ratings, Ratings.username == key)
+    _delete(SongLog, SongLog.username == key)
+    _delete(PlayCount, PlayCount.username == key)
+    _delete(DailyUserPlays, DailyUserPlays.username == key)
+    _delete(playlist_song, playlist_song.c.playlist_id.in_(playlist_ids))
+    _forget_refs('playlist', [str(playlist_id) for playlist_id in playlist_ids])
+    _delete(Playlist, Playlist.id.in_(playlist_ids))
+  if kind in ('artist', 'user'):
+    _forget_refs('artist', [key])
+
+  changes = db.session.info.setdefault('autocomplete', [])
+  changes.extend(('drop', ('song', song_id)) for song_id in song_ids)
+  changes.extend(('drop', ('album', album_id)) for album_id in album_ids)
+  changes.extend(
+      ('drop', ('playlist', playlist_id)) for playlist_id in playlist_ids)
+  if kind in ('artist', 'user'):
+    changes.append(('drop', ('artist', key)))
+
+  #the entries themselves
+  _delete(Song, in_songs)
+  _delete(Album, Album.id.in_(album_ids))
+  if kind in ('artist', 'user'):
+    _delete(Artist, Artist.username == key)
+  if kind == 'artist':
+    db.session.execute(
+        update(User).where(User.username == key).values(creator=False))
+  if kind == 'user':
+    _delete(User, User.username == key)
+
+  if rated:
+    rated = db.session.execute(
+        db.select(Song.id).where(Song.id.in_(rated))).scalars().all()
+    _recount_song_ratings(rated)
+    for album_id, artist_name in db.session.execute(
+        db.select(Song.album_id, Song.artist_name).where(
+            Song.id.in_(rated)).distinct()):
+      rollup_albums.add(album_id)
+      rollup_artists.add(artist_name)
+  refresh_rating_rollups(rollup_albums, rollup_artists)
+  return True
+
+
+def _artwork_stem(picture):
+  return picture[len('../artwork/'):].split('.')[0].split('-')[0]
+
+
+#remove the stored files of pictures no row shows any more, renditions and
+#all
+def remove_unused_artwork(pictures):
+  stems = {
+      _artwork_stem(picture)
+      for picture in pictures
+      if picture and picture.startswith('../artwork/')
+  }
+  for stem in stems:
+    prefix = '../artwork/' + stem
+    #every name of a picture is its stem followed by "." or "-", which both
+    #sort before "/", so this is a range read on each column's index
+    if any(
+        db.session.execute(
+            db.select(col).where(col > prefix, col < prefix + '/').limit(
+                1)).first()
+        for cols in _artwork_columns().values() for col in cols):
+      continue
+    for path in glob.glob(
+        os.path.join(ARTWORK_DIR, glob.escape(stem) + '[.-]*')):
+      if time.time() - os.path.getmtime(path) > CLEANUP_GRACE_SECONDS:
+        os.remove(path)
+
+
+#folders under static that audio and pictures were saved in before the
+#audio and artwork stores, as static/audio/<artist>/<song id>.mp3,
+#static/albums/<artist>/<album id>.png and so on
+LEGACY_FOLDERS = ('audio', 'albums', 'playlists', 'profile')
+
+
+#the file in a legacy folder a reference ("../static/albums/x/1.png") is
+#to, None for anything else
+def legacy_file(reference):
+  if not reference or not reference.startswith('../static/'):
+    return None
+  static = os.path.join(app.root_path, 'static')
+  path = os.path.normpath(os.path.join(static, reference[len('../static/'):]))
+  folder = os.path.relpath(path, static).split(os.sep)[0]
+  if folder not in LEGACY_FOLDERS or path.startswith(AUDIO_DIR + os.sep):
+    return None
+  return path
+
+
+#columns that can point at a file in a legacy folder
+def _legacy_columns():
+  return [Song.path] + [
+      col for cols in _artwork_columns().values() for col in cols
+  ]
+
+
+#remove the legacy files of these references that no row points at any more
+def remove_unused_legacy_files(references):
+  for reference in references:
+    path = legacy_file(reference)
+    if path is None or not os.path.isfile(path):
+      continue
+    if any(
+        db.session.execute(db.select(col).where(col == reference).limit(
+            1)).first() for col in _legacy_columns()):
+      continue
+    os.remove(path)
+
+
+def _remove_files(audio, artwork, files):
+  with app.app_context():
+    try:
+      if audio:
+        remove_unused_audio(audio)
+      if artwork:
+        remove_unused_artwork(artwork)
+      if artwork or files:
+        remove_unused_legacy_files(set(artwork or ()) | set(files or ()))
+    except Exception:
+      app.logger.exception('could not remove unused files')
+
+
+#deleted ORM objects give up their pictures like delete_catalog does
+@event.listens_for(db.session, 'after_flush')
+def release_artwork(session, _flush_context):
+  for obj in session.deleted:
+    for cols in _artwork_columns().values():
+      for col in cols:
+        if isinstance(obj, col.class_) and getattr(obj, col.key):
+          session.info.setdefault('released_artwork', set()).add(
+              getattr(obj, col.key))
+
+
+@event.listens_for(db.session, 'after_commit')
+def _remove_released_files(session):
+  audio = session.info.pop('released_audio', None)
+  artwork = session.info.pop('released_artwork', None)
+  files = session.info.pop('released_files', None)
+  if audio or artwork or files:
+    _cleanup_pool.submit(_remove_files, audio, artwork, files)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _keep_released_files(session):
+  session.info.pop('released_audio', None)
+  session.info.pop('released_artwork', None)
+  session.info.pop('released_files', None)
+
+
+#SQL profiling
+
+#counts the statements each request runs and how long they take. Totals are
+#kept per endpoint with the slowest statements, and a statement repeated
+#n_plus_one times or more within a request is reported as an N+1 pattern
+class SQLProfiler:
+
+  def __init__(self, slowest=5, n_plus_one=5):
+    self.slowest = slowest
+    self.n_plus_one = n_plus_one
+    self.lock = threading.Lock()
+    self.endpoints = {}
+
+  def install(self, app, engines):
+    for engine in engines:
+      event.listen(engine, 'before_cursor_execute', self._before_execute)
+      event.listen(engine, 'after_cursor_execute', self._after_execute)
+    app.before_request(self._start_request)
+    app.after_request(self._finish_request)
+
+  def _before_execute(self, conn, _cursor, _statement, _parameters, _context,
+                      _executemany):
+    conn.info.setdefault('profile_start', []).append(time.perf_counter())
+
+  def _after_execute(self, conn, _cursor, statement, _parameters, _context,
+                     _executemany):
+    elapsed = time.perf_counter() - conn.info['profile_start'].pop()
+    if has_request_context() and 'sql_queries' in g:
+      g.sql_queries.append((statement, elapsed))
+
+  def _start_request(self):
+    g.sql_queries = []
+
+  def _finish_request(self, response):
+    queries = g.pop('sql_queries', None)
+    if queries is None:
+      return response
+    total = sum(elapsed for _, elapsed in queries)
+    counts = {}
+    for statement, _ in queries:
+      counts[statement] = counts.get(statement, 0) + 1
+    repeated = {
+        statement: count
+        for statement, count in counts.items() if count >= self.n_plus_one
+    }
+    response.headers['X-SQL-Profile'] = (
+        f'queries={len(queries)}; time={total * 1000:.2f}ms; '
+        f'repeated={len(repeated)}')
+    self._record(request.endpoint or request.path, queries, total, repeated)
+    return response
+
+  def _record(self, endpoint, queries, total, repeated):
+    with self.lock:
+      stats = self.endpoints.setdefault(
+          endpoint, {
+              'requests': 0,
+              'queries': 0,
+              'max_queries': 0,
+              'sql_time_ms': 0.0,
+              'slowest': [],
+              'n_plus_one': {}
+          })
+      stats['requests'] += 1
+      stats['queries'] += len(queries)
+      stats['max_queries'] = max(stats['max_queries'], len(queries))
+      stats['sql_time_ms'] += total * 1000
+      slowest = stats['slowest'] + [{
+          'statement': statement,
+          'time_ms': elapsed * 1000
+      } for statement, elapsed in queries]
+      slowest.sort(key=lambda x: x['time_ms'], reverse=True)
+      stats['slowest'] = slowest[:self.slowest]
+      for statement, count in repeated.items():
+        stats['n_plus_one'][statement] = max(
+            stats['n_plus_one'].get(statement, 0), count)
+
+  def report(self):
+    with self.lock:
+      report = {}
+      for endpoint, stats in self.endpoints.items():
+        report[endpoint] = dict(stats,
+                                avg_queries=stats['queries'] /
+                                stats['requests'],
+                                avg_sql_time_ms=stats['sql_time_ms'] /
+                                stats['requests'])
+      return report
+
+  def reset(self):
+    with self.lock:
+      self.endpoints.clear()
+
+
+sql_profiler = SQLProfiler()
+
+play_log = PlayLogBuffer(app.config["PLAY_LOG_BATCH_SIZE"],
+                         app.config["PLAY_LOG_FLUSH_SECONDS"],
+                         app.config["PLAY_LOG_MAX_QUEUE"])
+atexit.register(play_log.stop)
+
+job_runner = JobRunner(app.config["JOB_WORKERS"],
+                       app.config["JOB_POLL_SECONDS"],
+                       app.config["JOB_MAX_ATTEMPTS"],
+                       app.config["JOB_RETRY_SECONDS"],
+                       app.config["JOB_TIMEOUT"])
+atexit.register(job_runner.stop)
+#jobs queued before this process started are picked up once it serves
+app.before_request(job_runner.start)
+
+with app.app_context():
+  init_search_index()
+  if not SearchEntry.query.first() and (Song.query.first() or Album.query.first()
+                                        or Playlist.query.first()
+                                        or Artist.query.first()):
+    rebuild_search_index()
+  if Ratings.query.first() and not SongRating.query.first():
+    rebuild_rating_aggregates()
+  if SongLog.query.first() and not PlayCount.query.first():
+    rebuild_play_counts()
+  if SongLog.query.first() and not TrendingScore.query.first():
+    rebuild_trending()
+  autocomplete.rebuild()
+  if app.config["SQL_PROFILE"]:
+    sql_profiler.install(app, db.engines.values())
 
 
 #Controllers 
@@ -240,36 +3763,11 @@ def home():
                 current_username=session.get('username')))
   else:
     username = session.get('username')
-    user = User.query.filter_by(username=username).first()
-    creator = user.creator
-    songlog = SongLog.query.filter_by(username=username).order_by(
-        desc(SongLog.time)).limit(6).all() #last played songs
-    songs = []
-    for log in songlog:
-      x = Song.query.filter_by(id=log.song_id).first()
-      if x in songs or not x:
-        continue
-      songs.append(x)
-    songlog = (SongLog.query.filter_by(username=username).group_by(
-        SongLog.song_id).order_by(desc(func.count(
-            SongLog.song_id))).limit(6).all()) #most played songs
-    song_favs = []
-    for log in songlog:
-      x = Song.query.filter_by(id=log.song_id).first()
-      if not x:
-        continue
-      song_favs.append(x)
-    highest_rated = Song.query.all()
-    highest_rated = add_rating_songs(highest_rated)[:6] if len(
-        highest_rated) > 6 else add_rating_songs(highest_rated) #highest rated songs
-    recents = Album.query.order_by(desc(Album.time)).limit(6).all() #recently added albums
+    creator = current_user().creator
     return render_template('home.html',
                            username=username,
                            creator=creator,
-                           songlog=songs,
-                           song_favs=song_favs,
-                           highest_rated=highest_rated,
-                           recents=recents)
+                           shelves=home_shelves(username))
 
 
 @app.route('/search_results/<string:search_term>', methods=['GET', 'POST'])
@@ -281,24 +3779,24 @@ def search_results(search_term):
                 search_term=search_results,
                 current_username=session.get('username')))
   else:
-    songs = Song.query.filter(Song.name.like(f"%{search_term}%")).all()
-    songs = add_rating_songs(songs)
-    album = Album.query.filter(Album.name.like(f"%{search_term}%")).all()
-    album = add_rating_album(album)
-    playlist = Playlist.query.filter(
-        Playlist.name.like(f"%{search_term}%")).all()
-    artist = Artist.query.filter(
-        Artist.username.like(f"%{search_term}%")).all()
-    artist = add_rating_artist(artist)
+    page = max(request.args.get('page', 1, type=int), 1)
+    hits, totals = search_catalog(search_term, page)
+    songs = add_rating_songs(hits['song'], sort=False)
+    album = add_rating_album(hits['album'], sort=False)
+    playlist = hits['playlist']
+    artist = add_rating_artist(hits['artist'], sort=False)
+    has_more = any(total > page * SEARCH_PAGE_SIZE for total in totals.values())
     username = session.get('username')
-    user = User.query.filter_by(username=username).first()
-    creator = user.creator
+    creator = current_user().creator
     return render_template('search_results.html',
                            search_term=search_term,
                            songs=songs,
                            album=album,
                            playlist=playlist,
                            artist=artist,
+                           totals=totals,
+                           page=page,
+                           has_more=has_more,
                            username=username,
                            current_username=session.get('username'),
                            creator=creator)
@@ -308,7 +3806,6 @@ def search_results(search_term):
 def profile(username):
   logged_in_user = session.get("username")
   user = User.query.filter_by(username=username).first()
-  print(user.creator)
   if request.method == 'POST':
     if "search" in request.form:
       search_results = request.form["search"]
@@ -318,30 +3815,27 @@ def profile(username):
                   current_username=session.get('username')))
     else:
       profile_pic = request.files["profile_pic"]
-      path = os.path.join('static/profile', f'{username}.png')
-      user.profile_picture = '../' + path
-      db.session.commit()
-      if user.creator:
-        user.artist.profile_picture = '../' + path
+      if profile_pic:
+        picture = store_artwork(profile_pic.read(), profile_pic.filename)
+        user.profile_picture = picture
+        if user.creator:
+          user.artist.profile_picture = picture
         db.session.commit()
-      profile_pic.save(path)
+        identity_cache.invalidate(user.username)
+        render_artwork_later(picture, 'profile')
       return redirect(url_for('profile', username=username))
   else:
     if user.creator:
-      songs = Song.query.filter_by(artist_name=user.username).all()
-      songs = add_rating_songs(songs)
-      albums = Album.query.filter_by(artist_name=user.username).all()
-      albums = add_rating_album(albums)
-      playlists = Playlist.query.filter_by(username=user.username).all()
-      user = add_rating_artist([user])[0]
+      artist = read_artist(user.username)
+      user.rating = artist['rating']
       return render_template('profile.html',
                              user=user,
                              current_user=logged_in_user,
-                             songs=songs,
-                             albums=albums,
-                             playlists=playlists)
+                             songs=artist['songs'],
+                             albums=artist['albums'],
+                             playlists=artist['playlists'])
     else:
-      playlists = Playlist.query.filter_by(username=user.username).all()
+      playlists = read_playlists(user.username)
 
       return render_template('profile.html',
                              user=user,
@@ -352,22 +3846,23 @@ def profile(username):
 @app.route('/creator', methods=['GET', 'POST'])
 def reg_creator():
   username = session.get('username')
-  user = User.query.filter_by(username=username).first()
   if request.method == 'POST':
     action = request.form.get('action')
     if action == 'register':
+      user = User.query.filter_by(username=username).first()
       user.creator = True
       new_art = Artist(username=username,
                        profile_picture=user.profile_picture,
                        time=datetime.now())
       db.session.add(new_art)
       db.session.commit()
+      identity_cache.invalidate(username)
       return redirect(url_for("home"))
 
     elif action == 'redirect':
       return redirect(url_for("home"))
   else:
-    if user.creator:
+    if current_user().creator:
       return redirect(url_for('home'))
     return render_template('creator.html', username=session.get('username'))
 
@@ -382,16 +3877,14 @@ def view_album(album):
                 current_username=session.get('username')))
   else:
     logged_in_user = session.get('username')
-    album = Album.query.filter_by(id=album).first()
-    songs = Song.query.filter_by(album_id=album.id).all()
-    songs = add_rating_songs(songs)
-    album = add_rating_album([album])[0]
-    user = User.query.filter_by(username=logged_in_user).first()
-    creator = user.creator
+    album = read_album(album)
+    if album is None:
+      abort(404)
+    creator = current_user().creator
     return (render_template('view_album.html',
                             logged_in_user=logged_in_user,
                             album=album,
-                            songs=songs,creator=creator))
+                            songs=album['songs'],creator=creator))
 
 
 @app.route("/playlist/<playlist>", methods=['GET', 'POST'])
@@ -403,15 +3896,14 @@ def view_playlist(playlist):
                 search_term=search_results,
                 current_username=session.get('username')))
   logged_in_user = session.get('username')
-  ply = Playlist.query.filter_by(id=playlist).first()
-  songs = ply.songs
-  songs = add_rating_songs(songs)
-  user = User.query.filter_by(username=logged_in_user).first()
-  creator = user.creator
+  ply = read_playlist(playlist)
+  if ply is None:
+    abort(404)
+  creator = current_user().creator
   return (render_template('view_playlist.html',
                           logged_in_user=logged_in_user,
                           playlist=ply,
-                          songs=songs,creator=creator))
+                          songs=ply['songs'],creator=creator))
 
 
 # Controllers-Artists
@@ -422,34 +3914,30 @@ def create_song(username):
   logged_in_user = session.get("username")
   if logged_in_user != username:
     return redirect(url_for("home"))
-  user = User.query.filter_by(username=username).first()
-  if not user.creator:
+  if not current_user().creator:
     return redirect(url_for("reg_creator"))
   if request.method == 'POST':
     song_name = request.form.get('song_title')
     song_album = request.form.get('album_title')
-    print(song_album)
     song_mp3 = request.files["mp3File"]
-    song_pic = Album.query.get(song_album).album_picture if Album.query.get(
-        song_album
-    ).album_picture != '../static/album_icon.png' else "../static/music_icon.png"
+    album_picture = db.session.get(Album, song_album).album_picture
+    song_pic = (album_picture if album_picture != '../static/album_icon.png'
+                else "../static/music_icon.png")
 
+    digest = store_audio(song_mp3)
     new_song = Song(name=song_name,
                     artist_name=username,
                     album_id=song_album,
-                    path="",
+                    path=audio_reference(digest),
+                    audio_digest=digest,
                     song_image=song_pic,
                     time=datetime.now())
     db.session.add(new_song)
+    db.session.flush()
+    enqueue_job('audio_metadata', _audio_file(digest), song_id=new_song.id)
     db.session.commit()
-    song_id = new_song.id
-    directory_path = os.path.join('static/audio', username)
-    if not os.path.exists(directory_path):
-      os.makedirs(directory_path)
-    path = os.path.join(directory_path, f'{song_id}.mp3')
-    new_song.path = '../' + path
-    db.session.commit()
-    song_mp3.save(path)
+    leaderboard.invalidate()
+    invalidate_shelves('popular')
     return redirect(url_for("home"))
   else:
     alb = Album.query.filter_by(artist_name=username).all()
@@ -465,8 +3953,7 @@ def create_album(username):
   logged_in_user = session.get("username")
   if logged_in_user != username:
     return redirect(url_for("home"))
-  user = User.query.filter_by(username=username).first()
-  if not user.creator:
+  if not current_user().creator:
     return redirect(url_for("reg_creator"))
   if request.method == 'POST':
     album_name = request.form.get('album_name')
@@ -478,13 +3965,11 @@ def create_album(username):
     db.session.add(new_alb)
     db.session.commit()
     if album_picture:
-      directory_path = os.path.join('static/albums', username)
-      if not os.path.exists(directory_path):
-        os.makedirs(directory_path)
-      path = os.path.join(directory_path, f'{new_alb.id}.png')
-      new_alb.album_picture = '../' + path
+      new_alb.album_picture = store_artwork(album_picture.read(),
+                                            album_picture.filename)
       db.session.commit()
-      album_picture.save(path)
+      render_artwork_later(new_alb.album_picture, 'album')
+    invalidate_shelves('recent_albums')
     return redirect(url_for("create_song", username=username))
   else:
     return (render_template('create_album.html', username=username))
@@ -504,29 +3989,25 @@ def create_playlist(username):
       if key.startswith('song'):
         song_id = request.form.get(key)
         songs.append(int(song_id))
-    print(songs)
     new_ply = Playlist(name=ply_name,
                        username=username,
                        playlist_picture="../static/playlist_icon.png")
     db.session.add(new_ply)
-    db.session.commit()
-    songs = Song.query.filter(Song.id.in_(songs)).all()
-    new_ply.songs.extend(songs)
+    db.session.flush()
+    append_playlist_songs(new_ply.id, songs)
     db.session.commit()
     if playlist_picture:
-      directory_path = os.path.join('static/playlists', username)
-      if not os.path.exists(directory_path):
-        os.makedirs(directory_path)
-      path = os.path.join(directory_path, f'{new_ply.id}.png')
-      new_ply.playlist_picture = '../' + path
+      new_ply.playlist_picture = store_artwork(playlist_picture.read(),
+                                               playlist_picture.filename)
       db.session.commit()
-      playlist_picture.save(path)
+      render_artwork_later(new_ply.playlist_picture, 'playlist')
     return redirect(url_for("home"))
   else:
-    songs = Song.query.all()
+    picker = requested_page('song', 'name')
     return (render_template('create_playlist.html',
                             username=username,
-                            songs=songs))
+                            songs=picker['rows'],
+                            next_cursor=picker['next_cursor']))
 
 
 @app.route("/<username>/edit/playlist/<playlist>", methods=['GET', 'POST'])
@@ -544,28 +4025,31 @@ def edit_playlist(username, playlist):
         if key.startswith('song'):
           song_id = request.form.get(key)
           songs.append(int(song_id))
-      songs = Song.query.filter(Song.id.in_(songs)).all()
-      playlist.songs.clear()
-      playlist.songs.extend(songs)
+      #only the songs deselected and selected since are written, the ones
+      #kept stay where they are
+      current = set(
+          db.session.execute(
+              db.select(playlist_song.c.song_id).where(
+                  playlist_song.c.playlist_id == playlist.id)).scalars())
+      remove_playlist_songs(playlist.id, current.difference(songs))
+      append_playlist_songs(playlist.id, songs)
       db.session.commit()
       if playlist_picture:
-        directory_path = os.path.join('static/playlists', username)
-        if not os.path.exists(directory_path):
-          os.makedirs(directory_path)
-        path = os.path.join(directory_path, f'{playlist.id}.png')
-        playlist.playlist_picture = '../' + path
+        playlist.playlist_picture = store_artwork(playlist_picture.read(),
+                                                  playlist_picture.filename)
         db.session.commit()
-        playlist_picture.save(path)
+        render_artwork_later(playlist.playlist_picture, 'playlist')
       return redirect(url_for("view_playlist", playlist=playlist.id))
     elif 'delete' in request.form:
       db.session.delete(playlist)
       db.session.commit()
       return redirect(url_for("home"))
   else:
-    songs = Song.query.all()
+    picker = requested_page('song', 'name')
     return (render_template('edit_playlist.html',
                             username=username,
-                            songs=songs,
+                            songs=picker['rows'],
+                            next_cursor=picker['next_cursor'],
                             playlist=playlist))
 
 
@@ -580,34 +4064,38 @@ def edit_album(username, album):
     if 'edit' in request.form:
       album_picture = request.files["album_picture"]
       if album_picture:
-        directory_path = os.path.join('static/albums', username)
-        if not os.path.exists(directory_path):
-          os.makedirs(directory_path)
-        path = os.path.join(directory_path, f'{curr_album.id}.png')
-        curr_album.album_picture = '../' + path
+        curr_album.album_picture = store_artwork(album_picture.read(),
+                                                 album_picture.filename)
         db.session.commit()
-        album_picture.save(path)
       songs = []
       for key in request.form:
         if key.startswith('song'):
           song_id = request.form.get(key)
           songs.append(int(song_id))
       songs = Song.query.filter(Song.id.in_(songs)).all()
+      moved_from = [song.album_id for song in songs]
       for song in songs:
-        song.album_id = album
+        song.album_id = curr_album.id
+      db.session.flush()
+      refresh_rating_rollups(moved_from + [curr_album.id])
       album_songs = Song.query.filter_by(album_id=curr_album.id).all()
       for song in album_songs:
         song.song_image = curr_album.album_picture
         db.session.commit()
+      leaderboard.invalidate()
+      invalidate_shelves()
+      if album_picture:
+        render_artwork_later(curr_album.album_picture, 'album')
       return redirect(url_for("view_album", album=curr_album.id))
     elif 'delete' in request.form:
-      db.session.delete(curr_album)
+      delete_catalog('album', curr_album.id)
       db.session.commit()
+      leaderboard.invalidate()
+      invalidate_shelves()
       return redirect(url_for("home"))
   else:
     songs = Song.query.filter_by(artist_name=curr_album.artist_name).all()
     album_songs = Song.query.filter_by(album_id=curr_album.id).all()
-    print(songs)
     return (render_template('edit_album.html',
                             username=username,
                             songs=songs,
@@ -618,83 +4106,256 @@ def edit_album(username, album):
 #Controllers-Backend
 
 # To add rating, username and songid to ratings table
-@app.route("/rating/<songId>/<username>/<rating>", methods=['GET', 'POST'])
+@app.route("/rating/<int:songId>/<username>/<int:rating>",
+           methods=['GET', 'POST'])
 def song_rating(songId, username, rating):
+  if not 1 <= rating <= 5:
+    abort(400)
+  song = Song.query.filter_by(id=songId).first()
+  if not song:
+    abort(404)
   ex_rating = Ratings.query.filter_by(song_id=songId,
                                       username=username).first()
   if ex_rating:
+    old_rating = ex_rating.rating
     ex_rating.rating = rating
+    ex_rating.time = datetime.now()
+    record_rating(song, rating, old_rating)
     db.session.commit()
-    print(ex_rating.rating, ex_rating.song_id, ex_rating.username)
+    leaderboard.invalidate()
   else:
-    new_rating = Ratings(song_id=songId, username=username, rating=rating)
+    new_rating = Ratings(song_id=songId,
+                         username=username,
+                         rating=rating,
+                         time=datetime.now())
     db.session.add(new_rating)
+    record_rating(song, rating)
     db.session.commit()
-    print(new_rating.rating, new_rating.song_id, new_rating.username)
+    leaderboard.invalidate()
+  invalidate_shelves('popular')
   return "sucess"
 
 # to record songlog
-@app.route('/song_clicked/<song_id>/<username>', methods=['GET', 'POST'])
+@app.route('/song_clicked/<int:song_id>/<username>', methods=['GET', 'POST'])
 def song_clicked(song_id, username):
+  play = {'song_id': song_id, 'username': username, 'time': datetime.now()}
+  if app.config["PLAY_LOG_DURABILITY"] == "sync":
+    record_plays([play])
+    db.session.commit()
+  else:
+    play_log.add(play)
+  return ({'message': 'Song Click Logged!'})
+
+# stream the audio of a song. send_file answers Range requests with 206
+# partial content, sets ETag/Last-Modified so revalidations get a 304, and
+# hands the file to the server's sendfile through wsgi.file_wrapper
+@app.route('/stream/<int:song_id>', methods=['GET'])
+def stream_song(song_id):
+  song = Song.query.filter_by(id=song_id).first()
+  if not song or not song.path:
+    abort(404)
+  path = os.path.join(app.root_path, song.path.removeprefix('../'))
+  if not os.path.isfile(path):
+    abort(404)
+  response = send_file(path,
+                       mimetype='audio/mpeg',
+                       conditional=True,
+                       etag=True,
+                       max_age=app.config["AUDIO_MAX_AGE"])
+  response.cache_control.public = True
+  return response
+
+# artwork is served with a long max-age since a name never changes content
+@app.route('/artwork/<name>', methods=['GET'])
+def artwork(name):
+  response = send_from_directory(ARTWORK_DIR,
+                                 name,
+                                 max_age=app.config["ARTWORK_MAX_AGE"])
+  response.cache_control.public = True
+  response.cache_control.immutable = True
+  return response
+
+# state of a background job, for signed in users and admins
+@app.route('/jobs/<int:job_id>', methods=['GET'])
+def job_status(job_id):
+  if not session.get('username') and not session.get('admin'):
+    abort(403)
+  job = db.session.get(Job, job_id)
+  if job is None:
+    abort(404)
+  return jsonify(job_info(job))
+
+# number of jobs in each state and the latest failures, for admins
+@app.route('/jobs', methods=['GET'])
+def job_overview():
+  if not session.get('admin'):
+    abort(403)
+  counts = dict(
+      db.session.execute(
+          db.select(Job.status, func.count()).group_by(Job.status)).all())
+  failed = Job.query.filter_by(status='failed').order_by(
+      Job.finished.desc()).limit(20)
+  return jsonify({
+      'counts': counts,
+      'failed': [job_info(job) for job in failed]
+  })
+
+# SQL profile of every endpoint since startup, for local requests only and
+# when SQL_PROFILE is on. DELETE clears it
+@app.route('/_profile', methods=['GET', 'DELETE'])
+def sql_profile_report():
+  if not app.config["SQL_PROFILE"] or request.remote_addr not in ('127.0.0.1',
+                                                                   '::1'):
+    abort(404)
+  if request.method == 'DELETE':
+    sql_profiler.reset()
+  return jsonify(sql_profiler.report())
+
+#pages of the song picker used when creating and editing playlists, with
+#?after=<cursor> from the previous page
+@app.route('/api/songs', methods=['GET'])
+def song_picker():
+  picker = requested_page('song', 'name')
+  return jsonify({
+      'songs': [{
+          'id': song.id,
+          'name': song.name,
+          'artist_name': song.artist_name
+      } for song in picker['rows']],
+      'next': picker['next_cursor']
+  })
 
-  log = SongLog(song_id=song_id, username=username, time=datetime.now())
-  db.session.add(log)
+#albums, playlists and artist profiles with their songs and ratings as json
+@app.route('/api/album/<int:album_id>', methods=['GET'])
+def api_album(album_id):
+  album = read_album(album_id)
+  if album is None:
+    abort(404)
+  return cached_json(album)
+
+
+@app.route('/api/playlist/<int:playlist_id>', methods=['GET'])
+def api_playlist(playlist_id):
+  playlist = read_playlist(playlist_id)
+  if playlist is None:
+    abort(404)
+  return cached_json(playlist)
+
+
+#edit the songs of a playlist with a json list of operations, see
+#edit_playlist_songs. They are applied together or not at all
+@app.route('/api/playlist/<int:playlist_id>/songs', methods=['POST'])
+def api_playlist_songs(playlist_id):
+  playlist = db.session.get(Playlist, playlist_id)
+  if playlist is None:
+    abort(404)
+  if session.get('username') != playlist.username and not session.get('admin'):
+    abort(403)
+  data = request.get_json(silent=True)
+  ops = data.get('ops') if isinstance(data, dict) else None
+  try:
+    edit_playlist_songs(playlist_id, ops)
+  except ValueError as e:
+    db.session.rollback()
+    return ({'error': str(e)}, 400)
   db.session.commit()
-  print(log.time, log.song_id, log.username)
-  return ({'message': 'Song Click Logged!'})
+  return ({'message': 'Playlist updated', 'applied': len(ops)})
+
+
+@app.route('/api/artist/<username>', methods=['GET'])
+def api_artist(username):
+  artist = read_artist(username)
+  if artist is None:
+    abort(404)
+  return cached_json(artist)
+
+#songs, albums or artists trending most over ?window= (24h by default) as
+#json, the top ?limit= of them
+@app.route('/api/trending/<kind>', methods=['GET'])
+def api_trending(kind):
+  span = request.args.get('window', next(iter(TRENDING_SPANS)))
+  if kind not in TRENDING_KINDS or span not in TRENDING_SPANS:
+    abort(404)
+  limit = min(request.args.get('limit', 10, type=int), TRENDING_LIMIT)
+  return cached_json({
+      'kind': kind,
+      'window': span,
+      kind + 's': read_trending(kind, span, max(limit, 1))
+  })
+
+#type-ahead suggestions for the search box, ?q= being what was typed so far.
+#Answered from the in-memory index without a query
+@app.route('/api/autocomplete', methods=['GET'])
+def api_autocomplete():
+  limit = min(request.args.get('limit', 8, type=int), AUTOCOMPLETE_LIMIT)
+  return jsonify({
+      'suggestions': [{
+          'kind': kind,
+          'id': ref,
+          'name': name
+      } for kind, ref, name in autocomplete.suggest(
+          request.args.get('q', ''), max(limit, 1))]
+  })
 
 # retreive information for admin dashboard
+# several categories can be asked for at once as /time/User,Song and the
+# buckets changed with ?buckets=6h,1d,30d
 @app.route('/time/<category>', methods=['GET', 'POST'])
 def retrieve_time(category):
-  table_dict = {"User": User, "Artist": Artist, "Album": Album, "Song": Song}
-  category = table_dict[category]
-  twelve_hours_ago = datetime.now() - timedelta(hours=12)
-  one_day_ago = datetime.now() - timedelta(days=1)
-  one_week_ago = datetime.now() - timedelta(weeks=1)
-  three_weeks_ago = datetime.now() - timedelta(weeks=3)
-  within_12hrs = len(
-      category.query.filter(category.time >= twelve_hours_ago).all())
-  within_1day = len(
-      category.query.filter(category.time <= twelve_hours_ago,
-                            category.time >= one_day_ago).all())
-  within_1week = len(
-      category.query.filter(category.time <= one_day_ago,
-                            category.time >= one_week_ago).all())
-  within_3weeks = len(
-      category.query.filter(category.time <= one_week_ago,
-                            category.time >= three_weeks_ago).all())
-  more_than3weeks = len(
-      category.query.filter(category.time <= three_weeks_ago).all())
-  data = [
-      within_12hrs, within_1day, within_1week, within_3weeks, more_than3weeks
-  ]
-  data = {'data': data}
-  print(data)
+  categories = category.split(',')
+  if any(name not in timeline_categories() for name in categories):
+    abort(404)
+  spec = request.args.get('buckets', TIMELINE_BUCKETS)
+  edges = parse_buckets(spec)
+  if edges is None:
+    abort(400)
+  counts = {name: cached_time_buckets(name, spec, edges) for name in categories}
+  data = counts[category] if len(categories) == 1 else counts
+  data = {'data': data, 'labels': bucket_labels(spec)}
   status_code = 200
 
   response = make_response(jsonify(data), status_code)
   return response
 
+# plays per day for admins, of every song or of ?song=<id> or ?user=<name>,
+# from ?start= up to ?end= (YYYY-MM-DD, the last 30 days by default)
+@app.route('/plays/daily', methods=['GET'])
+def plays_daily():
+  if not session.get('admin'):
+    abort(403)
+  try:
+    end = request.args.get('end')
+    end = (datetime.strptime(end, '%Y-%m-%d').date()
+           if end else datetime.now().date() + timedelta(days=1))
+    start = request.args.get('start')
+    start = (datetime.strptime(start, '%Y-%m-%d').date()
+             if start else end - timedelta(days=30))
+    days = daily_plays(start,
+                       end,
+                       song_id=request.args.get('song', type=int),
+                       username=request.args.get('user'))
+  except ValueError:
+    abort(400)
+  return jsonify({
+      'start': start.isoformat(),
+      'end': end.isoformat(),
+      'days': [[day.isoformat(), plays] for day, plays in days]
+  })
+
 # to delete artist, song,album or user
 @app.route('/delete/<category>/<id>', methods=['DELETE'])
 def delete_entry(category, id):
-  if category == "Artist":
-    entry = Artist.query.filter_by(username=id).first()
-    user = User.query.filter_by(username=id).first()
-    user.creator = False
-    db.session.commit()
-
-  elif category == "Album":
-    entry = Album.query.filter_by(id=id).first()
-
-  elif category == "Song":
-    entry = Song.query.filter_by(id=id).first()
-
-  elif category == "User":
-    entry = User.query.filter_by(username=id).first()
-  print(entry)
-  db.session.delete(entry)
+  kind = category.lower()
+  if kind not in ('song', 'album', 'artist', 'user') or (
+      kind in ('song', 'album') and not id.isdigit()):
+    abort(404)
+  if not delete_catalog(kind, int(id) if kind in ('song', 'album') else id):
+    abort(404)
   db.session.commit()
+  leaderboard.invalidate()
+  invalidate_shelves()
+  if kind in ('artist', 'user'):
+    identity_cache.invalidate(id)
   return ({'message': 'Deleted'})
 
 
@@ -721,56 +4382,49 @@ def admin_login():
 @app.route('/admin', methods=['GET'])
 def admin_dashboard():
   if session['admin']:
-    users = User.query.all()
-    artists = Artist.query.all()
-    artists = add_rating_artist(artists)
-    songs = Song.query.all()
-    songs = add_rating_songs(songs)
-    albums = Album.query.all()
-    albums = add_rating_album(albums)
-    songlog = SongLog.query.all()
-    playlists = Playlist.query.all()
+    counts = catalog_counts()
+    artists = leaderboard.top('artist', 1)
+    albums = leaderboard.top('album', 1)
+    songs = leaderboard.top('song', 1)
     return render_template('admin_dashboard.html',
-                           playlists=playlists,
-                           users=users,
-                           artists=artists,
-                           songs=songs,
-                           albums=albums,
-                           songlog=songlog)
+                           counts=counts,
+                           artist=artists[0] if artists else None,
+                           album=albums[0] if albums else None,
+                           song=songs[0] if songs else None)
 
 
 @app.route('/detail/artist', methods=['GET'])
 def detail_artist():
   if session['admin']:
-    artists = Artist.query.all()
-    artists = add_rating_artist(artists)
-    return render_template("detailed_view_artist.html", artists=artists)
+    page = requested_page('artist', 'rating')
+    return render_template("detailed_view_artist.html", page=page)
 
 
 @app.route('/detail/album', methods=['GET'])
 def detail_album():
   if session['admin']:
-    albums = Album.query.all()
-    albums = add_rating_album(albums)
-    return render_template("detailed_view_album.html", albums=albums)
+    page = requested_page('album', 'rating')
+    album_ids = [album.id for album in page['rows']]
+    song_counts = dict(
+        db.session.query(Song.album_id, func.count()).filter(
+            Song.album_id.in_(album_ids)).group_by(Song.album_id))
+    for album in page['rows']:
+      album.song_count = song_counts.get(album.id, 0)
+    return render_template("detailed_view_album.html", page=page)
 
 
 @app.route('/detail/user', methods=['GET'])
 def detail_user():
   if session['admin']:
-    users = User.query.all()
-    return render_template("detailed_view_user.html", users=users)
+    page = requested_page('user', 'name')
+    return render_template("detailed_view_user.html", page=page)
 
 
 @app.route('/detail/song', methods=['GET'])
 def detail_song():
   if session['admin']:
-    songs = Song.query.all()
-    songs = add_rating_songs(songs)
-    # for song in songs:
-    #   album=Album.query.filter_by(id=song.album_id).first()
-    #   song.album = album.name
-    return render_template("detailed_view_song.html", songs=songs)
+    page = requested_page('song', 'rating', options=[joinedload(Song.album)])
+    return render_template("detailed_view_song.html", page=page)
 
 
 if __name__ == '__main__':
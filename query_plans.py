@@ -0,0 +1,267 @@
+'''
+Query plan checks for the routes in main.py.
+
+Every route is driven through Flask's test client against a small scratch
+database. The statements it issues are captured and EXPLAIN QUERY PLAN is
+run on each of them. A plan step that reads a whole table without an index
+("SCAN <table>") fails the check, unless the statement is listed in
+ALLOWED_SCANS with the reason the scan is expected.
+
+Run with: python query_plans.py
+'''
+import io
+import os
+import re
+import sys
+import tempfile
+
+DB_DIR = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(DB_DIR, "plans.db")
+os.environ["PLAY_LOG_DURABILITY"] = "sync"
+
+from datetime import datetime  # noqa: E402
+
+from sqlalchemy import event  # noqa: E402
+
+from main import (  # noqa: E402
+  Album,
+  Artist,
+  Playlist,
+  Ratings,
+  Song,
+  User,
+  app,
+  append_playlist_songs,
+  db,
+  rebuild_play_counts,
+  rebuild_rating_aggregates,
+  record_plays,
+)
+
+# (route, fragment of the statement, why a full scan is expected there)
+ALLOWED_SCANS = [
+    ('/home', 'WHERE NOT (EXISTS (SELECT * FROM song_rating',
+     'leaderboard padding, only runs while fewer songs than the '
+     'leaderboard size are rated and stops after the padding it needs'),
+    ('/time/', 'count(CASE WHEN',
+     'the timeline puts every row in a bucket, counts are cached'),
+    ('/time/', 'sum(CASE WHEN',
+     'compacted plays are put in the buckets by day, counts are cached'),
+    ('/admin', 'WHERE NOT (EXISTS (SELECT * FROM',
+     'leaderboard padding, as on /home'),
+    ('/admin', 'count(*) AS count_1',
+     'the dashboard totals count every table, counts are cached'),
+    ('/detail/', 'WHERE NOT (EXISTS (SELECT * FROM',
+     'unrated rows follow the rated ones in key order, the scan stops once '
+     'the page is full'),
+    ('/api/songs?sort=rating', 'WHERE NOT (EXISTS (SELECT * FROM',
+     'unrated rows follow the rated ones in key order, the scan stops once '
+     'the page is full'),
+]
+
+# (method, url, logged in user, admin, form data or {'json': body})
+ROUTES = [
+    ('POST', '/login', None, False, {'username': 'User0', 'password': 'pass'}),
+    ('POST', '/register', None, False, {
+        'username': 'New',
+        'password': 'pass',
+        'conf_password': 'pass',
+        'email': 'new@x'
+    }),
+    ('GET', '/home', 'User0', False, None),
+    ('GET', '/search_results/song', 'User0', False, None),
+    ('GET', '/profile/User1', 'User0', False, None),
+    ('GET', '/profile/User0', 'User0', False, None),
+    ('GET', '/creator', 'User2', False, None),
+    ('GET', '/album/1', 'User0', False, None),
+    ('GET', '/playlist/1', 'User0', False, None),
+    ('GET', '/User1/create/song', 'User1', False, None),
+    ('GET', '/User1/create/album', 'User1', False, None),
+    ('GET', '/User1/create/playlist', 'User1', False, None),
+    ('GET', '/User1/edit/playlist/1', 'User1', False, None),
+    ('GET', '/User1/edit/album/1', 'User1', False, None),
+    ('POST', '/User1/create/album', 'User1', False, {
+        'album_name': 'Fresh',
+        'album_picture': (io.BytesIO(b''), '')
+    }),
+    ('POST', '/User1/edit/album/1', 'User1', False, {
+        'edit': '1',
+        'album_picture': (io.BytesIO(b''), ''),
+        'song2': '2'
+    }),
+    ('POST', '/User1/edit/playlist/1', 'User1', False, {
+        'edit': '1',
+        'playlist_picture': (io.BytesIO(b''), ''),
+        'song1': '1'
+    }),
+    ('POST', '/rating/1/User0/4', 'User0', False, None),
+    ('POST', '/rating/1/User0/5', 'User0', False, None),
+    ('POST', '/song_clicked/1/User0', 'User0', False, None),
+    ('GET', '/stream/1', 'User0', False, None),
+    ('GET', '/api/album/1', None, False, None),
+    ('GET', '/api/playlist/1', None, False, None),
+    ('POST', '/api/playlist/1/songs', 'User0', False, {
+        'json': {
+            'ops': [{
+                'op': 'add',
+                'song_id': 9,
+                'after': 1
+            }, {
+                'op': 'move',
+                'song_id': 3,
+                'after': None
+            }, {
+                'op': 'remove',
+                'song_id': 2
+            }, {
+                'op': 'append',
+                'song_ids': [10, 11]
+            }]
+        }
+    }),
+    ('GET', '/api/artist/User1', None, False, None),
+    ('GET', '/api/trending/song', None, False, None),
+    ('GET', '/api/trending/album?window=7d', None, False, None),
+    ('GET', '/api/trending/artist?limit=3', None, False, None),
+    ('GET', '/api/autocomplete?q=so', None, False, None),
+    ('GET', '/time/User,Artist,Album,Song,SongLog,Ratings', None, True, None),
+    ('GET', '/plays/daily', None, True, None),
+    ('GET', '/plays/daily?song=1&start=2000-01-01', None, True, None),
+    ('GET', '/plays/daily?user=User0', None, True, None),
+    ('GET', '/admin', None, True, None),
+    ('GET', '/jobs', None, True, None),
+    ('GET', '/jobs/1', 'User0', False, None),
+    ('GET', '/detail/artist', None, True, None),
+    ('GET', '/detail/album', None, True, None),
+    ('GET', '/detail/user', None, True, None),
+    ('GET', '/detail/song', None, True, None),
+    ('GET', '/detail/song?sort=name', None, True, None),
+    ('GET', '/detail/album?sort=newest', None, True, None),
+    ('GET', '/detail/user?sort=newest', None, True, None),
+    ('GET', '/detail/artist?sort=newest', None, True, None),
+    ('GET', '/api/songs?after=WyJTb25nIDEiLCAyXQ==', None, False, None),
+    ('GET', '/api/songs?sort=newest&after=WyIyMDAwLTAxLTAxVDAwOjAwOjAwIiwgMV0=',
+     None, False, None),
+    ('GET', '/api/songs?sort=rating&after=WzMuMCwgMl0=', None, False, None),
+    ('DELETE', '/delete/Song/3', None, True, None),
+    ('DELETE', '/delete/Album/2', None, True, None),
+    ('DELETE', '/delete/Artist/User3', None, True, None),
+    ('DELETE', '/delete/User/User5', None, True, None),
+]
+
+BARE_SCAN = re.compile(r'SCAN (\w+)( AS \w+)?$')
+
+
+def seed():
+  now = datetime.now()
+  for x in range(6):
+    creator = x % 2 == 1
+    db.session.add(
+        User(username=f'User{x}',
+             password='pass',
+             email=f'email@{x}',
+             creator=creator,
+             profile_picture='../static/artist.png',
+             time=now))
+    if creator:
+      db.session.add(
+          Artist(username=f'User{x}',
+                 profile_picture='../static/artist.png',
+                 time=now))
+  for x in range(6):
+    db.session.add(
+        Album(name=f'Album {x}',
+              artist_name=f'User{x // 2 * 2 + 1}',
+              album_picture='../static/album_icon.png',
+              time=now))
+  db.session.flush()
+  for x in range(18):
+    album = db.session.get(Album, x % 6 + 1)
+    db.session.add(
+        Song(name=f'Song {x}',
+             artist_name=album.artist_name,
+             album_id=album.id,
+             path='',
+             song_image='../static/music_icon.png',
+             time=now))
+  db.session.flush()
+  for x in range(4):
+    playlist = Playlist(name=f'Playlist {x}',
+                        username=f'User{x}',
+                        playlist_picture='../static/playlist_icon.png')
+    db.session.add(playlist)
+    db.session.flush()
+    append_playlist_songs(playlist.id, list(range(1, x + 4)))
+  for x in range(36):
+    db.session.add(
+        Ratings(song_id=x % 18 + 1,
+                username=f'User{x % 6}',
+                rating=x % 5 + 1,
+                time=now))
+  record_plays([{
+      'song_id': x % 18 + 1,
+      'username': f'User{x % 6}',
+      'time': now
+  } for x in range(60)])
+  db.session.commit()
+  rebuild_rating_aggregates()
+  rebuild_play_counts()
+
+
+def allowed(url, statement):
+  statement = ' '.join(statement.split())
+  return any(
+      url.startswith(route) and fragment in statement
+      for route, fragment, _ in ALLOWED_SCANS)
+
+
+def main():
+  captured = []
+  failures = []
+
+  def capture(_conn, _cursor, statement, parameters, _context, executemany):
+    captured.append((statement, parameters[0] if executemany else parameters))
+
+  with app.app_context():
+    seed()
+    engine = db.engine
+    #GET requests read through the read engine
+    engines = list(db.engines.values())
+  client = app.test_client()
+  for method, url, username, admin, data in ROUTES:
+    with client.session_transaction() as sess:
+      sess['username'] = username
+      sess['admin'] = admin
+    captured.clear()
+    for each in engines:
+      event.listen(each, 'before_cursor_execute', capture)
+    try:
+      if data and 'json' in data:
+        response = client.open(url, method=method, json=data['json'])
+      else:
+        response = client.open(url, method=method, data=data)
+    finally:
+      for each in engines:
+        event.remove(each, 'before_cursor_execute', capture)
+    if response.status_code >= 500:
+      failures.append((url, f'status {response.status_code}', ''))
+      continue
+    with engine.connect() as conn:
+      for statement, parameters in captured:
+        if not statement.lstrip().upper().startswith(
+            ('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'WITH')):
+          continue
+        plan = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement,
+                                    tuple(parameters or ())).all()
+        for row in plan:
+          if BARE_SCAN.match(row[-1]) and not allowed(url, statement):
+            failures.append((url, row[-1], ' '.join(statement.split())))
+    print(f'{method} {url}: {len(captured)} statements')
+  for url, step, statement in failures:
+    print(f'FAIL {url}: {step}\n    {statement}')
+  print(f'{len(failures)} full table scans')
+  return 1 if failures else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,37 @@
+'''
+Rebuild the song similarity table behind the "Recommended for you" shelf.
+
+Every play count and rating is read into a sparse user x song matrix and the
+most similar songs of each song are written to SongSimilarity, a block of
+songs at a time. Songs played between rebuilds are kept up to date by the
+web processes. Run it from cron, nightly for instance.
+
+Needs NumPy and SciPy (the recommendations extra) to scale, without them
+every song is recomputed on its own.
+
+Run with: python recommend.py [--block 1000]
+'''
+import argparse
+import sys
+import time
+
+from main import app, invalidate_shelves, numpy, rebuild_recommendations
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument('--block', type=int, default=1000,
+                      help='songs whose similarities are computed together')
+  args = parser.parse_args()
+  if numpy is None:
+    print('NumPy/SciPy not installed, recomputing song by song')
+  start = time.perf_counter()
+  with app.app_context():
+    songs = rebuild_recommendations(args.block)
+    invalidate_shelves('plays')
+  print(f'{songs} songs in {time.perf_counter() - start:.1f}s')
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,240 @@
+'''
+Find and purge what deleted songs, albums and users left behind.
+
+Rows of songs, users and playlists that no longer exist (ratings, plays,
+play counts, daily plays, playlist entries, rating aggregates, similarities,
+search entries and trending scores) are deleted with set based statements,
+and the rating aggregates and play counts rebuilt when any were. The
+reference counts of stored audio are recounted from the songs, and audio and
+artwork files no row uses are removed, in the stores and in the folders
+files were saved in before them (static/audio, albums, playlists and
+profile), as are upload and import temporary files left by crashed writers.
+Files younger than CLEANUP_GRACE_SECONDS are kept, a write in progress may be
+about to use them.
+
+Run with: python reconcile.py [--dry-run]
+'''
+import argparse
+import os
+import sys
+import time
+
+from sqlalchemy import cast, delete, func, update
+
+from main import (
+  ARTWORK_DIR,
+  AUDIO_DIR,
+  AUDIO_TYPES,
+  CLEANUP_GRACE_SECONDS,
+  LEGACY_FOLDERS,
+  Album,
+  Artist,
+  AudioBlob,
+  DailySongPlays,
+  DailyUserPlays,
+  PlayCount,
+  Playlist,
+  Ratings,
+  SearchEntry,
+  Song,
+  SongLog,
+  SongRating,
+  SongSimilarity,
+  SongVector,
+  TrendingScore,
+  User,
+  _artwork_columns,
+  _artwork_stem,
+  _audio_file,
+  _legacy_columns,
+  app,
+  db,
+  legacy_file,
+  playlist_song,
+  rebuild_play_counts,
+  rebuild_rating_aggregates,
+)
+
+
+# (name, table, where) of the orphaned rows
+def orphans():
+  song, user = Song.id, User.username
+  rows = [
+      ('ratings', Ratings, Ratings.song_id.notin_(db.select(song))),
+      ('ratings', Ratings, Ratings.username.notin_(db.select(user))),
+      ('plays', SongLog, SongLog.song_id.notin_(db.select(song))),
+      ('plays', SongLog, SongLog.username.notin_(db.select(user))),
+      ('play counts', PlayCount, PlayCount.song_id.notin_(db.select(song))),
+      ('play counts', PlayCount, PlayCount.username.notin_(db.select(user))),
+      ('daily plays', DailySongPlays,
+       DailySongPlays.song_id.notin_(db.select(song))),
+      ('daily plays', DailyUserPlays,
+       DailyUserPlays.username.notin_(db.select(user))),
+      ('song ratings', SongRating, SongRating.song_id.notin_(db.select(song))),
+      ('song vectors', SongVector, SongVector.song_id.notin_(db.select(song))),
+      ('similarities', SongSimilarity,
+       SongSimilarity.song_id.notin_(db.select(song))),
+      ('similarities', SongSimilarity,
+       SongSimilarity.similar_id.notin_(db.select(song))),
+      ('playlists', Playlist, Playlist.username.notin_(db.select(user))),
+      ('playlist entries', playlist_song,
+       playlist_song.c.song_id.notin_(db.select(song))),
+      ('playlist entries', playlist_song,
+       playlist_song.c.playlist_id.notin_(db.select(Playlist.id))),
+  ]
+  refs = {
+      'song': Song.id,
+      'album': Album.id,
+      'artist': Artist.username,
+      'playlist': Playlist.id
+  }
+  for kind, column in refs.items():
+    for name, model in (('search entries', SearchEntry), ('trending scores',
+                                                           TrendingScore)):
+      if kind == 'playlist' and model is TrendingScore:
+        continue
+      rows.append(
+          (name, model,
+           (model.kind == kind) & model.ref.notin_(
+               db.select(cast(column, db.String)))))
+  return rows
+
+
+def purge_rows(dry_run):
+  found = {}
+  for name, table, where in orphans():
+    if dry_run:
+      count = db.session.execute(
+          db.select(func.count()).select_from(table).where(where)).scalar()
+    else:
+      count = db.session.execute(
+          delete(table).where(where).execution_options(
+              synchronize_session=False)).rowcount
+    if count:
+      found[name] = found.get(name, 0) + count
+  if not dry_run:
+    db.session.commit()
+    if found.keys() & {'ratings', 'song ratings'}:
+      rebuild_rating_aggregates()
+    if found.keys() & {'plays', 'play counts'}:
+      rebuild_play_counts()
+  return found
+
+
+def _old(path):
+  return time.time() - os.path.getmtime(path) > CLEANUP_GRACE_SECONDS
+
+
+def _remove(path, dry_run):
+  print(f'{"would remove" if dry_run else "removed"} {path}')
+  if not dry_run:
+    os.remove(path)
+
+
+#ref counts recounted from the songs, then blobs and files nothing uses
+def purge_audio(dry_run):
+  refs = dict(
+      db.session.execute(
+          db.select(Song.audio_digest, func.count()).where(
+              Song.audio_digest.isnot(None)).group_by(
+                  Song.audio_digest)).all())
+  table = AudioBlob.__table__
+  blobs = dict(
+      db.session.execute(db.select(table.c.digest, table.c.ref_count)).all())
+  recounted = [{
+      'blob': digest,
+      'refs': refs.get(digest, 0)
+  } for digest, count in blobs.items() if count != refs.get(digest, 0)]
+  unused = {digest for digest in blobs if not refs.get(digest)}
+  if not dry_run:
+    if recounted:
+      db.session.execute(
+          update(table).where(table.c.digest == db.bindparam('blob')).values(
+              ref_count=db.bindparam('refs')), recounted)
+    if unused:
+      db.session.execute(
+          delete(table).where(table.c.digest.in_(unused), table.c.ref_count
+                              <= 0))
+    db.session.commit()
+  removed = 0
+  if not os.path.isdir(AUDIO_DIR):
+    return len(recounted), removed
+  kept = set(blobs) - unused
+  for folder, _, names in os.walk(AUDIO_DIR):
+    for name in names:
+      path = os.path.join(folder, name)
+      digest = os.path.splitext(name)[0]
+      if name.startswith(('.upload-', '.import-')) or (
+          path == _audio_file(digest) and digest not in kept):
+        if not _old(path):
+          continue
+        _remove(path, dry_run)
+        removed += 1
+  return len(recounted), removed
+
+
+#artwork files, renditions and all, of pictures no row shows
+def purge_artwork(dry_run):
+  shown = set()
+  for cols in _artwork_columns().values():
+    for col in cols:
+      shown.update(
+          _artwork_stem(picture)
+          for (picture, ) in db.session.execute(
+              db.select(col).where(col.like('../artwork/%')).distinct()))
+  removed = 0
+  if not os.path.isdir(ARTWORK_DIR):
+    return removed
+  for name in sorted(os.listdir(ARTWORK_DIR)):
+    path = os.path.join(ARTWORK_DIR, name)
+    if not os.path.isfile(path) or _artwork_stem('../artwork/' +
+                                                 name) in shown:
+      continue
+    if _old(path):
+      _remove(path, dry_run)
+      removed += 1
+  return removed
+
+
+#files in the folders used before the stores that no row points at
+def purge_legacy(dry_run):
+  used = set()
+  for col in _legacy_columns():
+    used.update(
+        legacy_file(reference)
+        for (reference, ) in db.session.execute(
+            db.select(col).where(col.like('../static/%')).distinct()))
+  removed = 0
+  for folder in LEGACY_FOLDERS:
+    root = os.path.join(app.root_path, 'static', folder)
+    for parent, dirs, names in os.walk(root):
+      dirs[:] = [d for d in dirs if os.path.join(parent, d) != AUDIO_DIR]
+      for name in sorted(names):
+        path = os.path.join(parent, name)
+        if folder == 'audio' and not name.lower().endswith(AUDIO_TYPES):
+          continue
+        if path not in used and _old(path):
+          _remove(path, dry_run)
+          removed += 1
+  return removed
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument('--dry-run', action='store_true')
+  args = parser.parse_args()
+  with app.app_context():
+    found = purge_rows(args.dry_run)
+    for name, count in sorted(found.items()):
+      print(f'{count} orphaned {name}')
+    recounted, audio = purge_audio(args.dry_run)
+    artwork = purge_artwork(args.dry_run)
+    legacy = purge_legacy(args.dry_run)
+  print(f'{sum(found.values())} orphaned rows, {recounted} audio reference '
+        f'counts fixed, {audio} audio, {artwork} artwork and {legacy} older '
+        f'files {"to remove" if args.dry_run else "removed"}')
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())